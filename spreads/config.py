@@ -84,6 +84,16 @@ CORE_OPTIONS = {
         value=False,
         docstring=("Convert workflows from older spreads version to the new "
                    "directory layout."),
+        advanced=True),
+    'online_processing': OptionTemplate(
+        value=False,
+        docstring=("Process pages with plugins that work on single pages "
+                   "while capturing"),
+        advanced=True),
+    'progress_rate': OptionTemplate(
+        value=5,
+        docstring=("Maximum number of progress updates per second, 0 for "
+                   "no limit"),
         advanced=True)
 }
 
@@ -216,9 +216,15 @@ class DeviceDriver(SpreadsPlugin):  # pragma: no cover
     def capture(self, path):
         """ Capture a single image with the device.
 
+        Drivers that write the image to `path` in the background (e.g. to
+        transform it first) may return a
+        :py:class:`concurrent.futures.Future` for the write, the workflow
+        waits for it before using the image.
+
         :param path:    Path for the image
         :type path:     :py:class:`pathlib.Path`
-
+        :returns:       None or a future that completes once the image was
+                        written
         """
         raise NotImplementedError
 
@@ -341,6 +347,11 @@ class ProcessHooksMixin(object):
     """
     __metaclass__ = abc.ABCMeta
 
+    #: Whether the plugin processes every page independently of the others,
+    #: which allows it to be run on pages while they are still being
+    #: captured (see the `online_processing` setting)
+    per_page = False
+
     @abc.abstractmethod
     def process(self, pages, target_path):
         """ Perform one or more actions that either modify the captured images
@@ -22,6 +22,7 @@ Various utility functions and classes.
 from __future__ import division, unicode_literals, print_function
 
 import abc
+import errno
 import glob
 import json
 import logging
@@ -29,6 +30,7 @@ import os
 import pkg_resources
 import platform
 import re
+import shutil
 import subprocess
 from unicodedata import normalize
 
@@ -131,6 +133,88 @@ def get_free_space(path):
     return psutil.disk_usage(unicode(path)).free
 
 
+#: ``FICLONE`` ioctl request number from ``linux/fs.h``, used for creating
+#: copy-on-write clones of files on file systems that support it (e.g. btrfs
+#: or XFS).
+_FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    """ Create a copy-on-write clone of `src` at `dst`.
+
+    :param src:     Source file
+    :type src:      unicode
+    :param dst:     Destination file, must not exist
+    :type dst:      unicode
+    :raises:        :py:class:`IOError` or :py:class:`OSError` if the
+                    platform or file system does not support it
+    """
+    if not is_os('linux'):
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are only supported on Linux")
+    import fcntl
+    with open(src, 'rb') as src_fp:
+        with open(dst, 'wb') as dst_fp:
+            try:
+                fcntl.ioctl(dst_fp.fileno(), _FICLONE, src_fp.fileno())
+            except (IOError, OSError):
+                dst_fp.close()
+                os.unlink(dst)
+                raise
+
+
+def place_file(src, dst, move=False):
+    """ Place a file at a new location with as little I/O as possible.
+
+    If `move` is set, the file is renamed, which only works within the same
+    file system. Otherwise (or if renaming fails), we try to create a
+    copy-on-write clone (reflink) and then a hardlink, before falling back to
+    copying the file's contents.
+
+    Note that for a hardlink, source and destination share their data, so
+    this should only be used for files that are not modified in place
+    afterwards.
+
+    :param src:     Source file
+    :type src:      :py:class:`pathlib.Path` or unicode
+    :param dst:     Destination file, will be overwritten if it exists
+    :type dst:      :py:class:`pathlib.Path` or unicode
+    :param move:    Remove the source file afterwards
+    :type move:     bool
+    :return:        The method used to place the file, one of `rename`,
+                    `reflink`, `hardlink` or `copy`
+    :rtype:         unicode
+    """
+    src, dst = unicode(src), unicode(dst)
+    if move:
+        try:
+            os.rename(src, dst)
+            return 'rename'
+        except OSError:
+            # Probably different file systems or an existing destination on
+            # Windows, continue with the other methods
+            pass
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    method = None
+    try:
+        _reflink(src, dst)
+        method = 'reflink'
+    except (IOError, OSError):
+        pass
+    if method is None and hasattr(os, 'link'):
+        try:
+            os.link(src, dst)
+            method = 'hardlink'
+        except OSError:
+            pass
+    if method is None:
+        shutil.copyfile(src, dst)
+        method = 'copy'
+    if move:
+        os.unlink(src)
+    return method
+
+
 def get_subprocess(cmdline, **kwargs):
     """ Get a :py:class:`subprocess.Popen` instance.
 
@@ -346,9 +430,9 @@ def get_data_dir(create=False):
             base_dir = os.environ[unix_dir_var]
         else:
             base_dir = unix_dir_fallback
-    app_path = Path(base_dir)/'spreads'
+    app_path = Path(os.path.expanduser(base_dir))/'spreads'
     if create and not app_path.exists():
-        app_path.mkdir()
+        app_path.mkdir(parents=True)
     return unicode(app_path)
 
 
@@ -23,11 +23,14 @@ entities.
 from __future__ import division, unicode_literals
 
 import copy
+import functools
 import logging
 import shutil
 import threading
+import time
 import uuid
 from datetime import datetime
+from io import BytesIO
 
 import concurrent.futures as concfut
 import spreads.vendor.bagit as bagit
@@ -68,6 +71,21 @@ Sent by the removing code when a workflow was deleted.
 :keyword unicode senderId: the ID of the :class:`Workflow` that was removed
 """)
 
+on_pages_changed = signals.signal('workflow:pages-changed', doc="""\
+Sent by a :class:`Workflow` when changes to its pages were saved.
+
+Receivers can apply the changes to their copy of the pages, as long as it is
+at ``previous_version``, otherwise they have to fetch all pages again.
+
+:argument :class:`Workflow`:    the Workflow whose pages changed
+:keyword int version:           the new version of the pages
+:keyword int previous_version:  the version the changes apply to
+:keyword list<Page> added:      the pages that were added
+:keyword list<int> removed:     the capture numbers of the removed pages
+:keyword list<dict> updated:    the changed fields of the modified pages,
+                                along with their ``capture_num``
+""")
+
 on_capture_triggered = signals.signal('workflow:capture-triggered', doc="""\
 Sent by a :class:`Workflow` after a capture was triggered.
 
@@ -90,6 +108,105 @@ Sent by a :class:`Workflow` after a capture failed.
                                 failure
 """)
 
+on_pages_processed = signals.signal('workflow:pages-processed', doc="""\
+Sent by a :class:`Workflow` after a postprocessing plugin is done with its
+pages.
+
+:argument :class:`Workflow`:    the Workflow that is being processed
+:keyword list<Page> pages:      the pages that were processed
+:keyword unicode plugin:        name of the plugin that processed the pages
+""")
+
+
+def transform_image(img, transforms):
+    """ Apply a list of transforms to an in-memory image.
+
+    Supported transforms are ``rotate`` (with an ``angle`` that is a multiple
+    of 90, clockwise), ``flip`` (with a ``direction`` of either ``horizontal``
+    or ``vertical``) and ``crop`` (with ``left``, ``top``, ``width`` and
+    ``height``, the latter two being optional). Crop boxes that exceed the
+    image's boundaries are clamped to them.
+
+    :param img:         Image to transform
+    :type img:          :py:class:`jpegtran.JPEGImage` if :py:mod:`jpegtran`
+                        is available, else :py:class:`PIL.Image.Image`
+    :param transforms:  Transforms to apply, in order
+    :type transforms:   list of dict
+    :returns:           The transformed image
+    :rtype:             Same type as `img`
+    """
+    for transform in transforms:
+        if transform['type'] == 'rotate':
+            angle = transform['angle'] % 360
+            if HAS_JPEGTRAN:
+                img = img.rotate(angle)
+            else:
+                # PIL rotates counter-clockwise
+                img = img.transpose({90: Image.ROTATE_270,
+                                     180: Image.ROTATE_180,
+                                     270: Image.ROTATE_90}[angle])
+        elif transform['type'] == 'flip':
+            if HAS_JPEGTRAN:
+                img = img.flip(transform['direction'])
+            elif transform['direction'] == 'horizontal':
+                img = img.transpose(Image.FLIP_LEFT_RIGHT)
+            else:
+                img = img.transpose(Image.FLIP_TOP_BOTTOM)
+        elif transform['type'] == 'crop':
+            img_width, img_height = (
+                (img.width, img.height) if HAS_JPEGTRAN else img.size)
+            left = min(transform['left'], img_width-1)
+            top = min(transform['top'], img_height-1)
+            width = min(transform.get('width') or img_width,
+                        img_width - left)
+            height = min(transform.get('height') or img_height,
+                         img_height - top)
+            if (left, top, width, height) == (0, 0, img_width, img_height):
+                continue
+            if HAS_JPEGTRAN:
+                img = img.crop(left, top, width, height)
+            else:
+                img = img.crop((left, top, left+width, top+height))
+        else:
+            raise ValueError("Unknown transform type: '{0}'"
+                             .format(transform['type']))
+    if (HAS_JPEGTRAN and img.exif_orientation not in (None, 1) and
+            any(t['type'] in ('rotate', 'flip') for t in transforms)):
+        # The orientation was applied to the pixels, so the EXIF tag would
+        # only lead viewers to rotate the image a second time
+        img.exif_orientation = 1
+    return img
+
+
+def apply_transforms(in_path, transforms, out_path=None):
+    """ Apply a list of transforms to an image file in a single pass.
+
+    With :py:mod:`jpegtran`, all transformations are performed losslessly
+    on the compressed image data and the result is only encoded once.
+
+    :param in_path:     Path to the image to transform
+    :type in_path:      :py:class:`pathlib.Path`
+    :param transforms:  Transforms to apply, see :py:func:`transform_image`
+    :type transforms:   list of dict
+    :param out_path:    Path to write the transformed image to. If omitted,
+                        the image is returned as a JPEG bytestring.
+    :type out_path:     :py:class:`pathlib.Path`
+    :returns:           The transformed image if no `out_path` was passed
+    :rtype:             bytestring or None
+    """
+    if HAS_JPEGTRAN:
+        img = transform_image(JPEGImage(unicode(in_path)), transforms)
+        if out_path is None:
+            return img.as_blob()
+        img.save(unicode(out_path))
+    else:
+        img = transform_image(Image.open(unicode(in_path)), transforms)
+        if out_path is None:
+            fp = BytesIO()
+            img.save(fp, format='JPEG', quality=95)
+            return fp.getvalue()
+        img.save(unicode(out_path), quality=95)
+
 
 def _signal_on_error(signal):
     """ Decorator for emitting a signal when a function throws an exception.
@@ -145,17 +262,25 @@ class Page(object):
     :attr page_label:       A label for the page. Must be an integer, a string
                             of digits or a roman numeral (e.g. 12, '12',
                             'XII'). Defaults to the sequence number.
+    :attr transforms:       Non-destructive transforms (rotation, flipping,
+                            cropping) that are to be applied to the raw image,
+                            see :py:func:`transform_image`.
     """
     # FIXME: This type is insufficient for the case where the raw images
     # contain two individual pages, i.e. the whole bookspreads was captured in
     # a single image. How would we deal with that scenario?
     __slots__ = ["sequence_num", "capture_num", "raw_image", "page_label",
-                 "processed_images"]
+                 "processed_images", "transforms"]
+
+    #: Key in :py:attr:`processed_images` under which the raw image with all
+    #: transforms applied is stored once it was materialized.
+    TRANSFORMED_KEY = 'transformed'
 
     def __init__(self, raw_image, sequence_num=None, capture_num=None,
-                 page_label=None, processed_images=None):
+                 page_label=None, processed_images=None, transforms=None):
         self.raw_image = raw_image
         self.processed_images = processed_images or {}
+        self.transforms = transforms or []
         if capture_num:
             self.capture_num = capture_num
         else:
@@ -195,6 +320,44 @@ class Page(object):
         except IndexError:
             return None
 
+    def add_transform(self, transform_type, **params):
+        """ Add a transform that is to be applied to the raw image.
+
+        A previously materialized version of the transformed raw image is
+        discarded, since it no longer reflects all transforms.
+
+        :param transform_type:  Type of the transform, see
+                                :py:func:`transform_image`
+        :type transform_type:   unicode
+        :param params:          Parameters for the transform
+        """
+        params['type'] = transform_type
+        self.transforms.append(params)
+        stale = self.processed_images.pop(self.TRANSFORMED_KEY, None)
+        if stale is not None and stale.exists():
+            stale.unlink()
+
+    def materialize_transforms(self, target_path):
+        """ Get the path to the raw image with all transforms applied.
+
+        The transforms are only written to disk once, when the pixels are
+        first needed, and the resulting file is re-used afterwards. If there
+        are no transforms, this is simply the raw image.
+
+        :param target_path: Directory to write the transformed image to
+        :type target_path:  :py:class:`pathlib.Path`
+        :returns:           Path to the transformed image
+        :rtype:             :py:class:`pathlib.Path`
+        """
+        if not self.transforms:
+            return self.raw_image
+        out_path = self.processed_images.get(self.TRANSFORMED_KEY)
+        if out_path is None or not out_path.exists():
+            out_path = target_path/(self.raw_image.stem + "_transformed.jpg")
+            apply_transforms(self.raw_image, self.transforms, out_path)
+            self.processed_images[self.TRANSFORMED_KEY] = out_path
+        return out_path
+
     def to_dict(self):
         """ Serialize entity to a dict.
 
@@ -206,6 +369,7 @@ class Page(object):
             'page_label': self.page_label,
             'raw_image': self.raw_image,
             'processed_images': self.processed_images,
+            'transforms': self.transforms,
         }
 
 
@@ -279,6 +443,8 @@ class Workflow(object):
     """
     # Class-wide cache of :py:class:`Workflow` instances
     _cache = {}
+    # Guards the cache, workflows are looked up from concurrent requests
+    _cache_lock = threading.RLock()
 
     def __new__(cls, *args, **kwargs):
         """ Automatically cache every new :py:class:`Workflow` instance. """
@@ -316,10 +482,11 @@ class Workflow(object):
     @classmethod
     def _add_to_cache(cls, workflow):
         location = workflow.path.parent
-        if location not in cls._cache:
-            cls._cache[location] = [workflow]
-        elif workflow not in Workflow._cache[location]:
-            cls._cache[location].append(workflow)
+        with cls._cache_lock:
+            if location not in cls._cache:
+                cls._cache[location] = [workflow]
+            elif workflow not in Workflow._cache[location]:
+                cls._cache[location].append(workflow)
 
     @classmethod
     def find_all(cls, location, key='slug', reload=False):
@@ -338,28 +505,32 @@ class Workflow(object):
             location = Path(location)
         if key not in ('slug', 'id'):
             raise ValueError("'key' must be one of ('id', 'slug')")
-        if location in cls._cache and not reload:
-            found = cls._cache[location]
-        else:
-            found = []
-        for candidate in location.iterdir():
-            is_workflow = (location.is_dir() and
-                           ((candidate/'bagit.txt').exists or
-                            (candidate/'raw').exists))
-            if not is_workflow:
-                continue
-            if not next((wf for wf in found if wf.path == candidate), None):
-                logging.debug(
-                    "Cache missed, instantiating workflow from {0}."
-                    .format(candidate))
+        with cls._cache_lock:
+            if location in cls._cache and not reload:
+                found = cls._cache[location]
+            else:
+                found = []
+            for candidate in location.iterdir():
+                # Hidden directories are used for staging (e.g. uploads)
+                if candidate.name.startswith('.'):
+                    continue
+                is_workflow = (location.is_dir() and
+                               ((candidate/'bagit.txt').exists or
+                                (candidate/'raw').exists))
+                if not is_workflow:
+                    continue
+                if any(wf.path == candidate for wf in found):
+                    continue
+                logging.debug("Cache missed, instantiating workflow from {0}."
+                              .format(candidate))
                 try:
                     workflow = cls(candidate)
                 except bagit.BagError as e:
                     logging.warn(e.message)
                     continue
                 found.append(workflow)
-        cls._cache[location] = found
-        return {getattr(wf, key): wf for wf in cls._cache[location]}
+            cls._cache[location] = found
+            return {getattr(wf, key): wf for wf in cls._cache[location]}
 
     @classmethod
     def find_by_id(cls, location, id):
@@ -396,6 +567,24 @@ class Workflow(object):
         except KeyError:
             return None
 
+    @classmethod
+    def reload(cls, workflow):
+        """ Load a workflow from the disk again, e.g. after its files were
+        replaced, and replace the old instance in the cache.
+
+        :param workflow:    Workflow to be reloaded
+        :type workflow:     :py:class:`Workflow`
+        :returns:           The new instance
+        :rtype:             :py:class:`Workflow`
+        """
+        with cls._cache_lock:
+            cached = cls._cache.get(workflow.path.parent, [])
+            if workflow in cached:
+                cached.remove(workflow)
+            new_workflow = cls(workflow.path)
+            cls._add_to_cache(new_workflow)
+        return new_workflow
+
     @classmethod
     def remove(cls, workflow):
         """ Delete a workflow from the disk and cache.
@@ -409,8 +598,9 @@ class Workflow(object):
             raise util.SpreadsException(
                 "Cannot remove a workflow while it is busy."
                 " (active step: '{0}')".format(workflow.status['step']))
-        shutil.rmtree(unicode(workflow.path))
-        cls._cache[workflow.path.parent].remove(workflow)
+        with cls._cache_lock:
+            shutil.rmtree(unicode(workflow.path))
+            cls._cache[workflow.path.parent].remove(workflow)
         on_removed.send(senderId=workflow.id)
 
     def __init__(self, path, config=None, metadata=None):
@@ -422,11 +612,24 @@ class Workflow(object):
             'step_progress': None,
             'prepared': False
         }
+        self._status_lock = threading.RLock()
+        #: Time the last status update was sent out
+        self._status_sent = 0
+        #: Timer that sends out the most recent, rate-limited status update
+        self._status_timer = None
         if not isinstance(path, Path):
             path = Path(path)
         self.path = path
         is_new = not self.path.exists()
 
+        #: Version of the pages, incremented whenever changes to them are
+        #: saved. It starts at the current time in milliseconds, so versions
+        #: keep increasing across restarts.
+        self.pages_version = int(time.time()*1000)
+        #: Serialized pages as of the last save, used to determine changes
+        self._saved_pages = {}
+        self._pages_lock = threading.RLock()
+
         # See if supplied `config` is already a valid ConfigView object
         if isinstance(config, confit.ConfigView):
             self.config = config
@@ -471,6 +674,14 @@ class Workflow(object):
         self._threadpool = concfut.ThreadPoolExecutor(max_workers=1)
         # List of unfinished :py:class:`concurrent.futures.Future` instances
         self._pending_tasks = []
+        # Thread pool for processing pages while capturing, only created
+        # when the `online_processing` setting is enabled and shut down
+        # once capturing is finished
+        self._online_executor = None
+        # Unfinished futures for pages that are processed while capturing
+        self._online_tasks = []
+        # Plugin name -> pages that were processed while capturing
+        self._online_processed = {}
 
         # Filter out subcommand plugins, since these are not workflow-specific
         plugin_classes = [
@@ -483,6 +694,7 @@ class Workflow(object):
         self._save_config()
 
         self.pages = self._load_pages()
+        self._saved_pages = self._snapshot_pages()
         self.table_of_contents = self._load_toc()
 
         if is_new:
@@ -601,54 +813,27 @@ class Workflow(object):
         self._save_pages()
         self.bag.update_payload(fast=True)
 
-    def crop_page(self, page, left, top, width=None, height=None, async=False):
+    def crop_page(self, page, left, top, width=None, height=None):
         """ Crop a page's raw image.
 
+        The raw image itself is left untouched, instead the crop box is
+        recorded in the page's :py:attr:`Page.transforms` and applied by
+        consumers of the image.
+
         :param page:    Page the raw image of which should be cropped
         :param left:    X coordinate of crop boundary
         :param top:     Y coordinate of crop boundary
         :param width:   Width of crop box
         :param height:  Height of crop box
-        :param async:   Perform the cropping in a background thread
-        :return:        The Future object when ``async`` was ``True``
-        :rtype:         :py:class:`concurrent.futures.Future`
         """
-        # FIXME: Does this really have to be a Workflow method?
-        def do_crop(fname, left, top, width, height):
-            if HAS_JPEGTRAN:
-                img = JPEGImage(fname)
-            else:
-                img = Image(filename=fname)
-            width = (img.width - left) if width is None else width
-            height = (img.height - top) if height is None else height
-            if width > (img.width - left):
-                width = img.width - left
-            if height > (img.height - top):
-                width = img.height - top
-            if (left, top, width, height) == (0, 0, img.width, img.height):
-                self._logger.warn("No-op crop parameters, skipping!")
-                return
-            self._logger.debug("Cropping \"{0}\" to x:{1} y:{2} w:{3} h:{4}"
-                               .format(fname, left, top, width, height))
-            try:
-                cropped = img.crop(left, top, width=width, height=height)
-                if HAS_JPEGTRAN:
-                    cropped.save(fname)
-                else:
-                    img.save(filename=fname)
-                    img.close()
-            except Exception as e:
-                self._logger.error("Cropping failed")
-                self._logger.exception(e)
-
-        fname = unicode(page.raw_image)
-        if async:
-            future = self._threadpool.submit(do_crop, fname, left, top, width,
-                                             height)
-            self._pending_tasks.append(future)
-            return future
-        else:
-            do_crop(fname, left, top, width, height)
+        if (left, top, width, height) == (0, 0, None, None):
+            self._logger.warn("No-op crop parameters, skipping!")
+            return
+        self._logger.debug("Cropping \"{0}\" to x:{1} y:{2} w:{3} h:{4}"
+                           .format(page.raw_image, left, top, width, height))
+        page.add_transform('crop', left=left, top=top, width=width,
+                           height=height)
+        self._save_pages()
 
     @property
     def out_files(self):
@@ -679,24 +864,45 @@ class Workflow(object):
         self._save_pages()
 
     def _update_status(self, **kwargs):
-        """ Update :py:attr:`status` and emit a ``on_modified``  signal. """
-        trigger_event = True
-        if 'step_progress' in kwargs and kwargs['step_progress'] is not None:
-            # Don't trigger event if we only made very little progress
-            old_progress = self.status['step_progress']
-            if old_progress is not None:
-                prog_diff = kwargs['step_progress'] - old_progress
-                trigger_event = (prog_diff >= 0.01 or   # Noticeable progress?
-                                 prog_diff == -1 or     # New step?
-                                 (old_progress < 1 and  # Completion?
-                                     (old_progress + prog_diff) == 1))
-                if not trigger_event:
-                    kwargs.pop('step_progress', None)
-        for key, value in kwargs.items():
-            self.status[key] = value
-        if trigger_event:
-            # We really want to pass the status by value...
-            on_modified.send(self, changes={'status': copy.copy(self.status)})
+        """ Update :py:attr:`status` and emit a ``on_modified``  signal.
+
+        Updates that only change the progress within a step are limited to
+        the ``progress_rate`` setting (updates per second), the most recent
+        of them is sent out once the interval has passed. The start and the
+        end of a step, as well as all other changes, are always sent out
+        immediately. A rate of zero or less disables the limit.
+        """
+        with self._status_lock:
+            self.status.update(kwargs)
+            rate = self.config['core']['progress_rate'].get(int)
+            is_intermediate = (kwargs.keys() == ['step_progress'] and
+                               kwargs['step_progress'] not in (None, 0, 1))
+            if is_intermediate and rate > 0:
+                delay = self._status_sent + 1.0/rate - time.time()
+                if delay > 0:
+                    if self._status_timer is None:
+                        self._status_timer = threading.Timer(
+                            delay, self._send_delayed_status)
+                        self._status_timer.daemon = True
+                        self._status_timer.start()
+                    return
+            if self._status_timer is not None:
+                self._status_timer.cancel()
+                self._status_timer = None
+            self._send_status()
+
+    def _send_delayed_status(self):
+        with self._status_lock:
+            if self._status_timer is None:
+                # Was superseded by an immediate update
+                return
+            self._status_timer = None
+            self._send_status()
+
+    def _send_status(self):
+        self._status_sent = time.time()
+        # We really want to pass the status by value...
+        on_modified.send(self, changes={'status': copy.copy(self.status)})
 
     def _load_config(self, value):
         """ Load configuartion from file in bag and optionally overlay it with
@@ -791,7 +997,8 @@ class Workflow(object):
                         capture_num=dikt['capture_num'],
                         processed_images=processed_images,
                         page_label=dikt['page_label'],
-                        sequence_num=dikt['sequence_num'])
+                        sequence_num=dikt['sequence_num'],
+                        transforms=dikt.get('transforms'))
         fpath = self.path / 'pagemeta.json'
         if not fpath.exists():
             return []
@@ -799,39 +1006,139 @@ class Workflow(object):
             return sorted([from_dict(p) for p in json.load(fp)],
                           key=lambda p: p.sequence_num)
 
-    def _save_pages(self):
-        """ Write pages to ``pagemeta.json`` in bag. """
-        fpath = self.path / 'pagemeta.json'
-        with fpath.open('wb') as fp:
-            json.dump([x.to_dict() for x in self.pages], fp,
-                      cls=util.CustomJSONEncoder, indent=2, ensure_ascii=False)
-        self.bag.add_tagfiles(unicode(fpath))
-        on_modified.send(self, changes={'pages': self.pages})
+    def _snapshot_pages(self):
+        """ Get a copy of the serialized pages, keyed by their capture
+            number.
+        """
+        return {page.capture_num: copy.deepcopy(page.to_dict())
+                for page in self.pages}
 
-    def _run_hook(self, hook_name, *args):
+    def _save_pages(self):
+        """ Write pages to ``pagemeta.json`` in bag and emit a
+            ``on_pages_changed`` signal with the changes since the last save.
+        """
+        with self._pages_lock:
+            fpath = self.path / 'pagemeta.json'
+            with fpath.open('wb') as fp:
+                json.dump([x.to_dict() for x in self.pages], fp,
+                          cls=util.CustomJSONEncoder, indent=2,
+                          ensure_ascii=False)
+            self.bag.add_tagfiles(unicode(fpath))
+
+            snapshot = self._snapshot_pages()
+            added = [page for page in self.pages
+                     if page.capture_num not in self._saved_pages]
+            removed = sorted(num for num in self._saved_pages
+                             if num not in snapshot)
+            updated = []
+            for num, data in sorted(snapshot.iteritems()):
+                old_data = self._saved_pages.get(num)
+                if old_data is None or old_data == data:
+                    continue
+                changes = {k: v for k, v in data.iteritems()
+                           if old_data.get(k) != v}
+                changes['capture_num'] = num
+                updated.append(changes)
+            self._saved_pages = snapshot
+            if not (added or removed or updated):
+                return
+            previous_version = self.pages_version
+            self.pages_version += 1
+            on_pages_changed.send(self, version=self.pages_version,
+                                  previous_version=previous_version,
+                                  added=added, removed=removed,
+                                  updated=updated)
+
+    def _run_hook(self, hook_name, *args, **kwargs):
         """ Run a specific hook method on all activated plugins.
 
         :param hook_name:   Name of hook method to run
         :param *args:       Arguments to pass to hook method
+        :param callback:    Optional function that is called with each plugin
+                            after its hook method was run
+        :param get_args:    Optional function that is called with each plugin
+                            and returns the arguments for its hook method
+                            instead of `*args`, or None to skip the plugin
         """
+        callback = kwargs.pop('callback', None)
+        get_args = kwargs.pop('get_args', None)
         self._logger.debug("Running '{0}' hooks".format(hook_name))
         plugins = [x for x in self._plugins if hasattr(x, hook_name)]
 
-        def update_progress(idx, plug_progress):
+        def update_progress(idx, sender, progress, **kwargs):
             """ Signal callback that updates the status and converts from
                 per-plugin progress to per-workflow progress. """
             step_progress = float(idx) / len(plugins)
-            internal_progress = plug_progress * (1.0 / len(plugins))
+            internal_progress = progress * (1.0 / len(plugins))
             self._update_status(
                 step_progress=(step_progress + internal_progress))
 
         for (idx, plug) in enumerate(plugins):
-            # FIXME: This should really be disconnected once we're done here
-            plug.on_progressed.connect(
-                lambda s, **kwargs: update_progress(idx, kwargs['progress']),
-                sender=plug, weak=False)
-            getattr(plug, hook_name)(*args)
+            plug_args = args if get_args is None else get_args(plug)
+            if plug_args is None:
+                self._update_status(step_progress=float(idx+1)/len(plugins))
+                continue
+            receiver = functools.partial(update_progress, idx)
+            plug.on_progressed.connect(receiver, sender=plug, weak=False)
+            try:
+                getattr(plug, hook_name)(*plug_args)
+            finally:
+                plug.on_progressed.disconnect(receiver, sender=plug)
             self._update_status(step_progress=float(idx+1)/len(plugins))
+            if callback is not None:
+                callback(plug)
+
+    def _get_online_plugins(self):
+        """ Get the postprocessing plugins that can be run while capturing.
+
+        These are the plugins that process every page on its own (see
+        :py:attr:`spreads.plugin.ProcessHooksMixin.per_page`), up to the
+        first plugin that needs all pages, since the plugins after it work
+        on its results.
+
+        :rtype:     list of :py:class:`spreads.plugin.ProcessHooksMixin`
+        """
+        online_plugins = []
+        for plug in self._plugins:
+            if not hasattr(plug, 'process'):
+                continue
+            if not getattr(plug, 'per_page', False):
+                break
+            online_plugins.append(plug)
+        return online_plugins
+
+    def _process_online(self, pages):
+        """ Run the plugins from :py:meth:`_get_online_plugins` on newly
+            captured pages.
+
+        :param pages:   Captured pages
+        :type pages:    list of :py:class:`Page`
+        """
+        # Pages might have been removed by a retake in the meantime
+        pages = [p for p in pages if p in self.pages]
+        if not pages:
+            return
+        processed_path = self.path/'data'/'done'
+        if not processed_path.exists():
+            processed_path.mkdir()
+        for plug in self._get_online_plugins():
+            try:
+                plug.process(pages, processed_path)
+            except Exception:
+                # The pages will be processed with the rest of the book
+                self._logger.error("Could not process pages with {0} while "
+                                   "capturing".format(plug.__name__),
+                                   exc_info=True)
+                break
+            self._online_processed.setdefault(plug.__name__, set()).update(
+                pages)
+            on_pages_processed.send(self, pages=pages, plugin=plug.__name__)
+        processed_files = [unicode(fpath) for page in pages
+                           for fpath in page.processed_images.values()
+                           if fpath.exists()]
+        if processed_files:
+            self.bag.add_payload(*processed_files)
+        self._save_pages()
 
     def _get_next_capture_page(self, target_page=None):
         """ Get next page that a capture should be stored as.
@@ -893,6 +1200,11 @@ class Workflow(object):
                                              self.devices[0].target_page)
         self._run_hook('prepare_capture', self.devices)
         self._run_hook('start_trigger_loop', self.capture)
+        process_online = (self._online_executor is None and
+                          self.config['core']['online_processing'].get(bool)
+                          and self._get_online_plugins())
+        if process_online:
+            self._online_executor = concfut.ThreadPoolExecutor(max_workers=1)
         self._update_status(prepared=True)
 
     @_signal_on_error(on_capture_failed)
@@ -929,6 +1241,9 @@ class Workflow(object):
                     futures.append(executor.submit(dev.capture,
                                                    page.raw_image))
             util.check_futures_exceptions(futures)
+            # Drivers can finish writing their images in the background
+            write_futures = [f.result() for f in futures
+                             if isinstance(f.result(), concfut.Future)]
 
             if retake:
                 # Remove previous n pages, where n == len(self.devices)
@@ -938,14 +1253,69 @@ class Workflow(object):
                 page.sequence_num = len(self.pages)
                 self.pages.append(page)
             self._run_hook('capture', self.devices, self.path)
-            # Queue new images for hashing
-            future = self._threadpool.submit(self.bag.add_payload,
-                                             *(unicode(p.raw_image)
-                                               for p in captured_pages))
-            self._pending_tasks.append(future)
+            # Done once the images are written and hashed for the bag
+            completed = concfut.Future()
+            self._pending_tasks.append(completed)
 
-        self._save_pages()
+        if not write_futures:
+            self._complete_capture(completed, write_futures, captured_pages,
+                                   retake)
+            return
+        # Announce the capture once the last image has been written, so the
+        # next capture can already be triggered
+        unwritten = set(write_futures)
+        unwritten_lock = threading.Lock()
+
+        def on_written(future):
+            with unwritten_lock:
+                unwritten.discard(future)
+                if unwritten:
+                    return
+            try:
+                self._complete_capture(completed, write_futures,
+                                       captured_pages, retake)
+            except Exception as e:
+                self._logger.error("Could not write captured images")
+                self._logger.exception(e)
+                on_capture_failed.send(self, message=e.message)
+        for future in write_futures:
+            future.add_done_callback(on_written)
+
+    def _complete_capture(self, completed, write_futures, captured_pages,
+                          retake):
+        """ Save and announce captured pages and queue their images for
+            hashing, once all of them have been written.
+
+        :param completed:       Future to resolve once the images were added
+                                to the bag
+        :type completed:        :py:class:`concurrent.futures.Future`
+        :param write_futures:   Writes of the images by the drivers
+        :type write_futures:    list of :py:class:`concurrent.futures.Future`
+        :param captured_pages:  Pages that were captured
+        :type captured_pages:   list of :py:class:`Page`
+        :param retake:          Whether the capture was a retake
+        :type retake:           bool
+        """
+        try:
+            util.check_futures_exceptions(write_futures)
+            self._save_pages()
+        except Exception as e:
+            completed.set_exception(e)
+            raise
         on_capture_succeeded.send(self, pages=captured_pages, retake=retake)
+        if self._online_executor is not None:
+            self._online_tasks.append(self._online_executor.submit(
+                self._process_online, captured_pages))
+        future = self._threadpool.submit(
+            self.bag.add_payload,
+            *(unicode(p.raw_image) for p in captured_pages))
+
+        def copy_result(future):
+            if future.exception() is not None:
+                completed.set_exception(future.exception())
+            else:
+                completed.set_result(future.result())
+        future.add_done_callback(copy_result)
 
     def finish_capture(self):
         """ Wrap up capture process. """
@@ -963,16 +1333,41 @@ class Workflow(object):
         self._save_pages()
         self._run_hook('finish_capture', self.devices, self.path)
         self._run_hook('stop_trigger_loop')
+        if self._online_executor is not None:
+            # Pages that are still queued are processed in the background,
+            # :py:meth:`process` waits for them
+            self._online_executor.shutdown(wait=False)
+            self._online_executor = None
         self._update_status(step=None, prepared=False)
 
     def process(self):
-        """ Run all captured pages through post-processing. """
+        """ Run all captured pages through post-processing.
+
+        Pages that were already processed by a plugin while capturing (see
+        the `online_processing` setting) are not passed to it again.
+        """
         self._update_status(step='process', step_progress=0)
         self._logger.info("Starting postprocessing...")
         processed_path = self.path/'data'/'done'
         if not processed_path.exists():
             processed_path.mkdir()
-        self._run_hook('process', self.pages, processed_path)
+        # Wait for pages that are still being processed
+        concfut.wait(self._online_tasks)
+        self._online_tasks = []
+        online_processed, self._online_processed = self._online_processed, {}
+
+        def get_args(plug):
+            if plug.__name__ not in online_processed:
+                return (self.pages, processed_path)
+            done = online_processed[plug.__name__]
+            pages = [p for p in self.pages if p not in done]
+            return (pages, processed_path) if pages else None
+
+        self._run_hook(
+            'process', self.pages, processed_path,
+            callback=lambda plug: on_pages_processed.send(
+                self, pages=self.pages, plugin=plug.__name__),
+            get_args=get_args)
         self.bag.add_payload(unicode(processed_path))
         self._save_pages()
         self._logger.info("Done with postprocessing!")
@@ -984,6 +1379,19 @@ class Workflow(object):
         out_path = self.path / 'data' / 'out'
         if not out_path.exists():
             out_path.mkdir()
+        # Output plugins work on the most recent image of a page, so pages
+        # that were never processed need their transforms applied first
+        untransformed = [p for p in self.pages
+                         if p.transforms and
+                         p.get_latest_processed(image_only=True) is None]
+        if untransformed:
+            processed_path = self.path/'data'/'done'
+            if not processed_path.exists():
+                processed_path.mkdir()
+            for page in untransformed:
+                page.materialize_transforms(processed_path)
+            self.bag.add_payload(unicode(processed_path))
+            self._save_pages()
         self._run_hook('output', self.pages, out_path, self.metadata,
                        self.table_of_contents)
         self.bag.add_payload(str(out_path))
@@ -19,12 +19,16 @@
 
 """ Postprocessing plugin that rotates images according to their EXIF
     orientation tag.
+
+The rotation is not applied to the image data right away, instead it is
+recorded as a non-destructive transform on the page (see
+:py:attr:`spreads.workflow.Page.transforms`), which is applied by the
+consumers of the image.
 """
 
 from __future__ import unicode_literals
 
 import logging
-import shutil
 
 from concurrent.futures import ProcessPoolExecutor
 
@@ -32,80 +36,58 @@ from spreads.plugin import HookPlugin, ProcessHooksMixin
 
 logger = logging.getLogger('spreadsplug.autorotate')
 
+#: Mapping from EXIF orientation values to the transforms that bring an image
+#: with that orientation upright, in the order they have to be applied.
+ORIENTATION_TRANSFORMS = {
+    1: (),
+    2: (('flip', {'direction': 'horizontal'}),),
+    3: (('rotate', {'angle': 180}),),
+    4: (('flip', {'direction': 'vertical'}),),
+    5: (('rotate', {'angle': 90}), ('flip', {'direction': 'horizontal'})),
+    6: (('rotate', {'angle': 90}),),
+    7: (('rotate', {'angle': 270}), ('flip', {'direction': 'horizontal'})),
+    8: (('rotate', {'angle': 270}),),
+}
+
 # We provide two implementations, one with the fast :py:module:`jpegtran`
 # library and one with :py:module:`pyexiv2`, that is also compatible with
 # Windows systems
 try:
     from jpegtran import JPEGImage
 
-    def autorotate_image(in_path, out_path):
-        """ Rotate an image according to its EXIF orientation tag.
+    def get_exif_orientation(in_path):
+        """ Read the EXIF orientation tag from an image.
 
-        :param in_path:     Path to image that should be rotated
+        :param in_path:     Path to image
         :type in_path:      unicode
-        :param out_path:    Path where rotated image should be written to
-        :type out_path:     unicode
+        :returns:           The orientation or None if the image did not have
+                            an orientation tag
+        :rtype:             int or None
         """
-        img = JPEGImage(in_path)
-        if img.exif_orientation is None:
-            logger.warn(
-                "Image {0} did not have any EXIF rotation, did not rotate."
-                .format(in_path))
-            return
-        elif img.exif_orientation in (0, 1):
-            logger.info("Image {0} is already rotated.".format(in_path))
-            shutil.copyfile(in_path, out_path)
-        else:
-            rotated = img.exif_autotransform()
-            rotated.save(out_path)
+        return JPEGImage(in_path).exif_orientation
 except ImportError:
     import pyexiv2
-    from wand.image import Image
 
-    def autorotate_image(in_path, out_path):
-        """ Rotate an image according to its EXIF orientation tag.
+    def get_exif_orientation(in_path):
+        """ Read the EXIF orientation tag from an image.
 
-        :param in_path:     Path to image that should be rotated
+        :param in_path:     Path to image
         :type in_path:      unicode
-        :param out_path:    Path where rotated image should be written to
-        :type out_path:     unicode
+        :returns:           The orientation or None if the image did not have
+                            an orientation tag
+        :rtype:             int or None
         """
+        metadata = pyexiv2.ImageMetadata(in_path)
+        metadata.read()
         try:
-            metadata = pyexiv2.ImageMetadata(in_path)
-            metadata.read()
-            orient = int(metadata['Exif.Image.Orientation'].value)
-        except:
-            logger.warn(
-                "Image {0} did not have any EXIF rotation, did not rotate."
-                .format(in_path))
-            return
-
-        img = Image(filename=in_path)
-        if orient == 1:
-            logger.info("Image {0} is already rotated.".format(in_path))
-            shutil.copyfile(in_path, out_path)
-            return
-        elif orient == 2:
-            img.flip()
-        elif orient == 3:
-            img.rotate(180)
-        elif orient == 4:
-            img.flop()
-        elif orient == 5:
-            img.rotate(90)
-            img.flip()
-        elif orient == 6:
-            img.rotate(90)
-        elif orient == 7:
-            img.rotate(270)
-            img.flip()
-        elif orient == 8:
-            img.rotate(270)
-        img.save(filename=out_path)
+            return int(metadata['Exif.Image.Orientation'].value)
+        except KeyError:
+            return None
 
 
 class AutoRotatePlugin(HookPlugin, ProcessHooksMixin):
     __name__ = 'autorotate'
+    per_page = True
 
     def _get_progress_callback(self, idx, num_total):
         """ Get a callback that sends out a :py:attr:`on_progressed` signal.
@@ -122,27 +104,38 @@ class AutoRotatePlugin(HookPlugin, ProcessHooksMixin):
             self,
             progress=float(idx)/num_total)
 
-    def _get_update_callback(self, page, out_path):
-        """ Get a callback that updates the list of processed images for a page
+    def _get_update_callback(self, page):
+        """ Get a callback that records the transforms for the orientation
+            that was read from an image on its page.
 
         :param page:        Page for which the
-                            :py:attr:`spreads.workflow.Page.processed_images`
-                            mapping should be updated
+                            :py:attr:`spreads.workflow.Page.transforms`
+                            should be updated
         :type page:         :py:class:`spreads.workflow.Page`
-        :param out_path:    Path where the rotated image is located
-        :type out_path:     :py:class:`pathlib.Path`
         """
-        return lambda x: page.processed_images.update(
-            {self.__name__: out_path})
+        def update_transforms(future):
+            orientation = future.result()
+            if orientation is None:
+                logger.warn(
+                    "Image {0} did not have any EXIF rotation, did not rotate."
+                    .format(page.raw_image))
+            elif orientation in (0, 1):
+                logger.info("Image {0} is already rotated."
+                            .format(page.raw_image))
+            else:
+                for transform_type, params in (
+                        ORIENTATION_TRANSFORMS[orientation]):
+                    page.add_transform(transform_type, **params)
+        return update_transforms
 
     def process(self, pages, target_path):
-        """ For each page, rotate the most recent image according to its EXIF
-            orientation tag.
+        """ For each page, record the transforms needed to rotate the raw
+            image according to its EXIF orientation tag.
 
         :param pages:       Pages to be processed
         :type pages:        list of :py:class:`spreads.workflow.Page`
-        :param target_path: Base directory where rotated images are to be
-                            stored
+        :param target_path: Base directory where processed images are to be
+                            stored (unused, since no images are written)
         :type target_path:  :py:class:`pathlib.Path`
         """
         logger.info("Rotating images")
@@ -151,25 +144,23 @@ class AutoRotatePlugin(HookPlugin, ProcessHooksMixin):
         with ProcessPoolExecutor() as executor:
             num_total = len(pages)
             for (idx, page) in enumerate(pages):
-                in_path = page.get_latest_processed(image_only=True)
-                if self.__name__ in page.processed_images:
+                in_path = page.raw_image
+                is_rotated = (
+                    self.__name__ in page.processed_images or
+                    any(t['type'] in ('rotate', 'flip')
+                        for t in page.transforms))
+                if is_rotated:
                     logger.info(
                         "Image was previously rotated already, skipping.")
                     continue
-                if in_path is None:
-                    in_path = page.raw_image
                 if in_path.suffix.lower() not in ('.jpg', '.jpeg'):
                     logger.warn("Image {0} is not a JPG file, cannot be "
                                 "rotated".format(in_path))
                     continue
-                out_path = target_path/(in_path.stem + "_rotated.jpg")
-                future = executor.submit(autorotate_image,
-                                         unicode(in_path),
-                                         unicode(out_path))
+                future = executor.submit(get_exif_orientation,
+                                         unicode(in_path))
                 future.add_done_callback(
                     self._get_progress_callback(idx, num_total)
                 )
-                future.add_done_callback(
-                    self._get_update_callback(page, out_path)
-                )
+                future.add_done_callback(self._get_update_callback(page))
                 futures.append(future)
@@ -6,18 +6,32 @@ import time
 from fractions import Fraction
 
 import chdkptp
+from concurrent.futures import ThreadPoolExecutor
 
 from spreads.config import OptionTemplate
 from spreads.plugin import DeviceDriver, DeviceFeatures, DeviceException
 
 try:
     from jpegtran import JPEGImage
+    HAS_JPEGTRAN = True
 
     def update_exif_orientation(data, orientation):
         img = JPEGImage(blob=data)
         img.exif_orientation = orientation
         return img.as_blob()
+
+    def rotate_image(data, orientation):
+        """ Losslessly rotate JPEG data so that it is upright for the given
+            EXIF orientation.
+        """
+        img = JPEGImage(blob=data)
+        img.exif_orientation = orientation
+        img = img.exif_autotransform()
+        # The image is upright now, make sure viewers don't rotate it again
+        img.exif_orientation = 1
+        return img.as_blob()
 except ImportError:
+    HAS_JPEGTRAN = False
     import pyexiv2
 
     def update_exif_orientation(data, orientation):
@@ -76,6 +90,10 @@ class CHDKCameraDevice(DeviceDriver):
                  value=sorted(WHITEBALANCE_MODES),
                  docstring='White balance mode', selectable=True,
                  advanced=True),
+             'rotate_on_capture': OptionTemplate(
+                 False, "Rotate images while capturing instead of during "
+                        "postprocessing (requires jpegtran-cffi)",
+                 advanced=True),
              })
         return conf
 
@@ -119,6 +137,7 @@ class CHDKCameraDevice(DeviceDriver):
 
         """
         self._device = device
+        self._write_executor = None
         self.logger = logging.getLogger("{0}[{1}]".format(
             self.__class__.__name__,
             self._device.info.serial_num[:4]))
@@ -213,7 +232,9 @@ class CHDKCameraDevice(DeviceDriver):
         # switching back to play mode (`self._run("play")`), but due to a bug
         # in a majority of CHDK devices, we currently cannot do that, so we
         # just do nothing here. See issue #114 on GitHub for more details
-        pass
+        if self._write_executor is not None:
+            self._write_executor.shutdown()
+            self._write_executor = None
 
     def get_preview_image(self):
         return next(self._device.get_frames())
@@ -256,13 +277,36 @@ class CHDKCameraDevice(DeviceDriver):
                 self.logger.exception(e)
                 raise e
 
-        # Set EXIF orientation
-        self.logger.debug("Setting EXIF orientation on captured image")
         upside_down = self.config["upside_down"].get(bool)
         if self.target_page == 'odd':
-            data = update_exif_orientation(data, 8 if upside_down else 6)
+            orientation = 8 if upside_down else 6
         else:
-            data = update_exif_orientation(data, 6 if upside_down else 8)
+            orientation = 6 if upside_down else 8
+        rotate = (self.config['rotate_on_capture'].get(bool) and
+                  not options['dng'])
+        if rotate and not HAS_JPEGTRAN:
+            self.logger.warn("jpegtran-cffi is not installed, cannot rotate "
+                             "image while capturing.")
+            rotate = False
+        if not rotate:
+            # Set EXIF orientation
+            self.logger.debug("Setting EXIF orientation on captured image")
+            self._write_image(update_exif_orientation(data, orientation),
+                              path)
+            return
+        # Rotate and write the image in the background, so the next shot can
+        # be triggered right away. A single worker per device keeps the
+        # memory usage in check and the writes in order.
+        if self._write_executor is None:
+            self._write_executor = ThreadPoolExecutor(max_workers=1)
+        return self._write_executor.submit(self._rotate_and_write, data,
+                                           orientation, path)
+
+    def _rotate_and_write(self, data, orientation, path):
+        self.logger.debug("Rotating captured image")
+        self._write_image(rotate_image(data, orientation), path)
+
+    def _write_image(self, data, path):
         with path.open('wb') as fp:
             fp.write(data)
 
@@ -85,14 +85,13 @@ class PDFBeadsPlugin(HookPlugin, OutputHooksMixin):
                 fpath = page.raw_image
             link_path = (tmpdir/fpath.name)
             if IS_WIN:
-                shutil.copy(unicode(fpath), unicode(link_path))
+                util.place_file(fpath, link_path)
             else:
                 link_path.symlink_to(fpath.absolute())
             if 'tesseract' in page.processed_images:
                 ocr_path = page.processed_images['tesseract']
                 if IS_WIN:
-                    shutil.copy(unicode(ocr_path),
-                                unicode(tmpdir/ocr_path.name))
+                    util.place_file(ocr_path, tmpdir/ocr_path.name)
                 else:
                     (tmpdir/ocr_path.name).symlink_to(ocr_path.absolute())
             images.append(link_path.absolute())
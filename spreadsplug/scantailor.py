@@ -276,7 +276,8 @@ class ScanTailorPlugin(HookPlugin, ProcessHooksMixin):
         for page in pages:
             fpath = page.get_latest_processed(image_only=True)
             if fpath is None:
-                fpath = page.raw_image
+                # Apply pending rotations and crops to the raw image
+                fpath = page.materialize_transforms(target_path)
             in_paths[unicode(fpath)] = page
 
         logger.info("Generating ScanTailor configuration")
@@ -304,7 +305,7 @@ class ScanTailorPlugin(HookPlugin, ProcessHooksMixin):
             for in_path, page in in_paths.iteritems():
                 if Path(in_path).stem == out_stem:
                     target_fname = target_path/fname.name
-                    shutil.copyfile(unicode(fname), unicode(target_fname))
+                    util.place_file(fname, target_fname, move=True)
                     page.processed_images[self.__name__] = target_fname
                     break
             else:
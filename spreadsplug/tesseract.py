@@ -28,7 +28,6 @@ import logging
 import multiprocessing
 import os
 import re
-import shutil
 import subprocess
 import tempfile
 import time
@@ -68,6 +67,7 @@ logger = logging.getLogger('spreadsplug.tesseract')
 
 class TesseractPlugin(HookPlugin, ProcessHooksMixin):
     __name__ = 'tesseract'
+    per_page = True
 
     @classmethod
     def configuration_template(cls):
@@ -96,7 +96,8 @@ class TesseractPlugin(HookPlugin, ProcessHooksMixin):
         for page in pages:
             fpath = page.get_latest_processed(image_only=True)
             if fpath is None:
-                fpath = page.raw_image
+                # Apply pending rotations and crops to the raw image
+                fpath = page.materialize_transforms(target_path)
             in_paths[fpath] = page
 
         out_dir = Path(tempfile.mkdtemp(prefix='tess-out'))
@@ -114,7 +115,7 @@ class TesseractPlugin(HookPlugin, ProcessHooksMixin):
             for in_path, page in in_paths.iteritems():
                 if in_path.stem == out_stem:
                     target_fname = target_path/fname.name
-                    shutil.copyfile(unicode(fname), unicode(target_fname))
+                    util.place_file(fname, target_fname, move=True)
                     page.processed_images[self.__name__] = target_fname
                     break
             else:
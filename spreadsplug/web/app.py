@@ -18,23 +18,23 @@
 """ Core web application code. """
 
 import logging
-import logging.handlers
 import os
 import sys
 from itertools import chain
 from threading import Thread
 
+from concurrent.futures import ThreadPoolExecutor
+
 from spreads.vendor.confit import ConfigError
 from spreads.vendor.huey import SqliteHuey
 from spreads.vendor.huey.consumer import Consumer
 from flask import Flask
-from tornado.wsgi import WSGIContainer
 from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.web import FallbackHandler, Application
 
 import spreads.workflow
 import spreads.plugin as plugin
-from spreads.util import is_os
+from spreads.util import is_os, get_data_dir
 from spreads.config import OptionTemplate
 from spreads.main import add_argument_from_template, should_show_argument
 
@@ -151,6 +151,11 @@ class WebCommands(plugin.HookPlugin, plugin.SubcommandHooksMixin):
                             # option parser
                 docstring="Address of the postprocessing server",
                 selectable=False),
+            'live_submit': OptionTemplate(
+                value=False,
+                docstring="Submit captured images to the postprocessing "
+                          "server while capturing",
+                selectable=False),
             'standalone_device': OptionTemplate(
                 value=False,
                 docstring="Server runs on a standalone device dedicated to "
@@ -160,6 +165,49 @@ class WebCommands(plugin.HookPlugin, plugin.SubcommandHooksMixin):
                 value=5000,
                 docstring="TCP-Port to listen on",
                 selectable=False),
+            'worker_threads': OptionTemplate(
+                value=4,
+                docstring="Number of threads that handle API requests",
+                selectable=False,
+                advanced=True),
+            'image_cache_size': OptionTemplate(
+                value=512,
+                docstring="Maximum size of the on-disk cache for thumbnails "
+                          "and scaled images (in MiB)",
+                selectable=False,
+                advanced=True),
+            'image_cache_dir': OptionTemplate(
+                value=u"",  # Cannot be None because of type deduction in
+                            # option parser
+                docstring="Directory for the cache of thumbnails and scaled "
+                          "images (default: 'cache' in the data directory)",
+                selectable=False,
+                advanced=True),
+            'upload_rate_limit': OptionTemplate(
+                value=0,
+                docstring="Maximum rate for uploads to the postprocessing "
+                          "server in KiB/s (0 for no limit)",
+                selectable=False,
+                advanced=True),
+            'transfer_rate_limit': OptionTemplate(
+                value=0,
+                docstring="Maximum rate for transfers to USB storage in "
+                          "KiB/s (0 for no limit)",
+                selectable=False,
+                advanced=True),
+            'download_rate_limit': OptionTemplate(
+                value=0,
+                docstring="Maximum rate for workflow downloads in KiB/s "
+                          "(0 for no limit)",
+                selectable=False,
+                advanced=True),
+            'capture_rate_limit': OptionTemplate(
+                value=0,
+                docstring="Maximum rate for uploads, transfers and downloads "
+                          "while a capture is in progress in KiB/s (0 "
+                          "pauses them)",
+                selectable=False,
+                advanced=True),
         }
 
     @staticmethod
@@ -233,10 +281,40 @@ class WebApplication(object):
         app.config['standalone'] = self.config['standalone_device'].get()
         app.config['postprocessing_server'] = (
             self.config['postprocessing_server'].get() or None)
+        cache_dir = (
+            os.path.expanduser(self.config['image_cache_dir'].get()) or
+            os.path.join(get_data_dir(create=True), 'cache'))
+        app.config['image_cache'] = util.DiskCache(
+            cache_dir, self.config['image_cache_size'].get(int)*1024**2)
+        app.config['workflow_cache'] = util.WorkflowJSONCache()
+        app.config['workflow_index'] = util.WorkflowIndex(project_dir)
+        app.config['rate_limiters'] = self._get_rate_limiters(mode)
         if not self._debug:
             app.error_handler_spec[None][500] = (
                 endpoints.handle_general_exception)
 
+    def _get_rate_limiters(self, mode):
+        """ Create limiters for the throughput of uploads, USB transfers and
+            downloads.
+
+        In modes that capture, every kind of transfer is limited, so it can
+        back off while capturing. Otherwise only the kinds of transfers that
+        have a limit configured are.
+
+        :param mode:    Mode the server runs in
+        :type mode:     unicode
+        :returns:       Mapping from kind of transfer to its limiter
+        :rtype:         dict
+        """
+        can_capture = mode in ('scanner', 'full')
+        capture_rate = self.config['capture_rate_limit'].get(int)*1024
+        rate_limiters = {}
+        for kind in ('upload', 'transfer', 'download'):
+            rate = self.config['{0}_rate_limit'.format(kind)].get(int)*1024
+            if rate or can_capture:
+                rate_limiters[kind] = util.RateLimiter(rate, capture_rate)
+        return rate_limiters
+
     def setup_task_queue(self):
         """ Configure task queue and consumer. """
         # Initialize huey task queue
@@ -247,10 +325,13 @@ class WebApplication(object):
 
     def setup_logging(self):
         """ Configure loggers. """
-        # Add in-memory log handler
-        memoryhandler = logging.handlers.BufferingHandler(1024*10)
-        memoryhandler.setLevel(logging.DEBUG)
-        logger.root.addHandler(memoryhandler)
+        # Add in-memory log store, replacing a previously configured one
+        if app.config.get('log_store') is not None:
+            logger.root.removeHandler(app.config['log_store'])
+        log_store = util.LogStore()
+        log_store.setLevel(logging.DEBUG)
+        logger.root.addHandler(log_store)
+        app.config['log_store'] = log_store
 
         # Silence some rather annoying loggers
         logging.getLogger('huey.consumer').setLevel(logging.INFO)
@@ -284,34 +365,92 @@ class WebApplication(object):
         # Register event handlers
         import tasks
         signals_ = chain(*(x.signals.values()
-                           for x in (spreads.workflow, util.EventHandler,
-                                     tasks, handlers)))
+                           for x in (spreads.workflow, tasks, handlers)))
 
         for signal in signals_:
             signal.connect(get_signal_callback_http(signal), weak=False)
             signal.connect(get_signal_callback_websockets(signal), weak=False)
 
+        # Log records are only sent to clients that subscribed to them
+        util.EventHandler.on_log_emit.connect(handlers.log_forwarder.forward)
+        handlers.log_forwarder.update_level()
+
+        # Drop cached JSON of workflows when they change
+        app.config['workflow_cache'].connect_signals()
+        # Keep the workflows sorted for listing them
+        app.config['workflow_index'].connect_signals()
+
+        # Back off with transfers while capturing
+        if app.config['mode'] in ('scanner', 'full'):
+            for rate_limiter in app.config['rate_limiters'].values():
+                rate_limiter.connect_signals()
+
+        # Submit captures to the postprocessing server while capturing
+        live_submit = (app.config['mode'] == 'scanner' and
+                       app.config['postprocessing_server'] and
+                       self.config['live_submit'].get(bool))
+        live_submitter = None
+        if live_submit:
+            live_submitter = tasks.LiveSubmitter(
+                'http://{0}'.format(app.config['postprocessing_server']),
+                app.config['rate_limiters'].get('upload'))
+            live_submitter.connect_signals()
+        app.config['live_submitter'] = live_submitter
+
+    def setup_thumbnails(self):
+        """ Pre-generate thumbnails for newly captured and processed images
+            in the background.
+        """
+        # A single worker, so the generation does not compete with capturing
+        # and processing for too many resources
+        executor = ThreadPoolExecutor(max_workers=1)
+
+        def generate_thumbnails(sender, pages, **kwargs):
+            executor.submit(util.generate_thumbnails,
+                            app.config['image_cache'], pages)
+
+        for signal in (spreads.workflow.on_capture_succeeded,
+                       spreads.workflow.on_pages_processed):
+            signal.connect(generate_thumbnails, weak=False)
+
     def setup_tornado(self):
         """ Configure Tornado web application. """
         if self._debug:
             # Exposes Werkzeug's interactive debugger for WSGI endpoints.
             logger.info("Starting server in debugging mode")
             from werkzeug.debug import DebuggedApplication
-            container = WSGIContainer(DebuggedApplication(app, evalex=True))
+            wsgi_app = DebuggedApplication(app, evalex=True)
         else:
-            container = WSGIContainer(app)
+            wsgi_app = app
+        # Run the WSGI endpoints in a thread pool, so slow requests don't
+        # block the IOLoop
+        num_workers = self.config['worker_threads'].get(int)
+        container = util.ThreadPoolWSGIContainer(
+            wsgi_app, max_workers=num_workers, max_queued=num_workers*16)
         self.application = Application([
             (r"/ws", handlers.WebSocketHandler),
             (r"/api/workflow/([0-9a-z-]+)/download/(.*)\.zip",
              handlers.ZipDownloadHandler,
-             dict(base_path=app.config['base_path'])),
+             dict(base_path=app.config['base_path'],
+                  rate_limiter=app.config['rate_limiters'].get('download'))),
             (r"/api/workflow/([0-9a-z-]+)/download/(.*).\.tar",
              handlers.TarDownloadHandler,
-             dict(base_path=app.config['base_path'])),
+             dict(base_path=app.config['base_path'],
+                  rate_limiter=app.config['rate_limiters'].get('download'))),
             (r"/api/workflow/upload",
              handlers.StreamingUploadHandler,
              dict(base_path=app.config['base_path'])),
+            # Serve (potentially large) workflow files without going through
+            # the WSGI container
+            (r"/api/workflow/([0-9a-z-]+)/output/([^/]+)",
+             handlers.WorkflowFileHandler,
+             dict(base_path=app.config['base_path'], subdirectory='out')),
+            (r"/api/workflow/([0-9a-z-]+)/data/((?:raw|done|out)/[^/]+)",
+             handlers.WorkflowFileHandler,
+             dict(base_path=app.config['base_path'])),
             (r"/api/poll", handlers.EventLongPollingHandler),
+            (r"/api/stats/wsgi", handlers.WSGIStatsHandler,
+             dict(container=container)),
             # Fall back to WSGI endpoints
             (r".*", FallbackHandler, dict(fallback=container))
         ], debug=self._debug)
@@ -335,6 +474,7 @@ class WebApplication(object):
         self.setup_logging()
         self.setup_task_queue()
         self.setup_signals()
+        self.setup_thumbnails()
         self.setup_tornado()
 
         self._listening_port = self.config['port'].get(int)
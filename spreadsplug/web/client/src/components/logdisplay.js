@@ -202,10 +202,15 @@
     componentWillMount: function() {
       this.loadMessages();
       // Initialize polling
+      window.router.events.subscribeLogs('logdisplay', this.state.loglevel);
       window.router.events.on('logrecord', function(message) {
         if (!this.isMounted()) {
           return;
         }
+        if (message.suppressed) {
+          message.message += " (" + message.suppressed +
+                             " similar messages suppressed)";
+        }
         if (!isMoreVerbose(message.level, this.state.loglevel)) {
           this.setState({
             messages: [message].concat(this.state.messages)
@@ -217,9 +222,11 @@
     },
     componentWillUnmount: function() {
       window.router.events.off('logrecord', null, this);
+      window.router.events.unsubscribeLogs('logdisplay');
     },
     /** Callback when loglevel filter is changed */
     handleSetLevel: function(event) {
+      window.router.events.subscribeLogs('logdisplay', event.target.value);
       this.setState({loglevel: event.target.value}, this.loadMessages);
     },
     /** Callback when page was changed */
@@ -57,6 +57,8 @@
 
     /** Register message change listeners */
     componentDidMount: function() {
+      // Warnings and errors are displayed as messages
+      window.router.events.subscribeLogs('messages', 'warning');
       window.router.events.on('logrecord', function(record) {
         if (_.contains(["WARNING", "ERROR"], record.level && record.origin !== 'tornado.access')) {
           var error = {
@@ -78,6 +80,7 @@
 
     componentWillUnmount: function() {
       window.router.events.off('logrecord', null, this);
+      window.router.events.unsubscribeLogs('messages');
       window.router.off(null, null, this);
     },
 
@@ -109,7 +109,7 @@
                   <li>
                     <a style={clientIsMacOS() ? {'color': 'red'} : {}}
                        data-bypass={true} onClick={this.props.onDownload}
-                       href={'/api/workflow/' + this.props.workflowSlug + '/download?fmt=zip'}
+                       href={'/api/workflow/' + this.props.workflowSlug + '/download?fmt=zip&compression=auto'}
                        title={clientIsMacOS() ? 'Due to a bug in the OSX Archive tool it is unable to extract archives created from spreads. Please use a third-party software instead.' :
                               'Download as a ZIP archive' }>
                       .zip
@@ -35,6 +35,7 @@
 
       var args = {};
       if (this.cursor) args.cursor = this.cursor;
+      if (this.logLevel) args.loglevel = this.logLevel;
       jQuery.ajax({url: "/api/poll", type: "POST", dataType: "text",
               data: jQuery.param(args), success: this.onSuccess.bind(this),
               error: this.onError.bind(this)});
@@ -51,10 +52,18 @@
       window.setTimeout(this.poll.bind(this), 0);
     },
 
-    onError: function(response) {
+    onError: function(xhr) {
+      if (xhr && xhr.status === 410) {
+        // The events following our cursor are no longer available on the
+        // server, so our state has to be refreshed before continuing
+        this.cursor = JSON.parse(xhr.responseText).cursor;
+        this.trigger('events:resync');
+        window.setTimeout(this.poll.bind(this), 0);
+        return;
+      }
       this.errorSleepTime *= 2;
       console.log("Poll error; sleeping for", this.errorSleepTime, "ms");
-      window.setTimeout(this.poll, this.errorSleepTime);
+      window.setTimeout(this.poll.bind(this), this.errorSleepTime);
     },
 
     newEvents: function(response) {
@@ -69,7 +78,7 @@
     }
   };
 
-  var EventDispatcher = _.extend(Backbone.Events, {
+  var EventDispatcher = _.extend(Backbone.Events, LongPollingMixin, {
     connect: function() {
       if (window.MozWebSocket) {
         window.WebSocket = window.MozWebSocket;
@@ -92,8 +101,10 @@
         this.websocket.onopen = function() {
           // Start listening to server events
           this.websocket.onmessage = function(messageEvent) {
-            this.emitEvent(JSON.parse(messageEvent.data));
+            // Events are sent in batches
+            _.each(JSON.parse(messageEvent.data), this.emitEvent, this);
           }.bind(this);
+          if (this.logLevel) this.updateLogSubscription();
         }.bind(this);
       } else {
         // Use AJAX long-polling as a fallback when WebSockets are not supported
@@ -102,6 +113,35 @@
       }
     },
 
+    /**
+     * Receive log records at or above the given level as 'logrecord' events.
+     * Every subscriber is identified by a name, the server sends all records
+     * that at least one of the subscribers is interested in.
+     */
+    subscribeLogs: function(name, level) {
+      this.logSubscriptions = _.extend({}, this.logSubscriptions);
+      this.logSubscriptions[name] = level.toLowerCase();
+      this.updateLogSubscription();
+    },
+
+    unsubscribeLogs: function(name) {
+      this.logSubscriptions = _.omit(this.logSubscriptions, name);
+      this.updateLogSubscription();
+    },
+
+    updateLogSubscription: function() {
+      var levels = ['debug', 'info', 'warning', 'error'],
+          subscribed = _.values(this.logSubscriptions);
+      this.logLevel = _.find(levels, function(level) {
+        return _.contains(subscribed, level);
+      }) || null;
+      if (this.websocket && this.websocket.readyState === WebSocket.OPEN) {
+        this.websocket.send(JSON.stringify(
+          this.logLevel ? {subscribe: 'logrecord', level: this.logLevel}
+                        : {unsubscribe: 'logrecord'}));
+      }
+    },
+
     emitEvent: function emitEvent(event) {
       if (event.name !== 'logrecord' && window.config.web.debug) {
         console.log(event.name, event.data);
@@ -169,6 +169,10 @@
       return -workflow.get('last_modified');
     },
     connectEvents: function(eventDispatcher) {
+      eventDispatcher.on('events:resync', function() {
+        // We missed some events, so we get all workflows again
+        this.fetch();
+      }, this);
       eventDispatcher.on('workflow:created', function(data) {
         // Check for pending workflows, if there is one, it's the one that
         // just triggered the event on the server and is about to receive
@@ -211,6 +215,30 @@
         }
         this.sort();
       }, this);
+      eventDispatcher.on('workflow:pages-changed', function(data) {
+        var workflow = this.get(data.senderId);
+        if (!workflow) return;
+        if (workflow.get('pages_version') !== data.previous_version) {
+          // We missed at least one change, so we have to get the
+          // complete workflow again
+          workflow.fetch();
+        } else {
+          var pages = _.reject(workflow.get('pages'), function(page) {
+            return _.contains(data.removed, page.capture_num);
+          });
+          pages = _.map(pages, function(page) {
+            var changes = _.findWhere(data.updated,
+                                      {capture_num: page.capture_num});
+            return changes ? _.extend({}, page, changes) : page;
+          });
+          workflow.set({
+            pages: _.sortBy(pages.concat(data.added), 'sequence_num'),
+            pages_version: data.version,
+            last_modified: new Date().getTime() / 1000
+          });
+        }
+        this.sort();
+      }, this);
     }
   });
 }());
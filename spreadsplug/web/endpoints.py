@@ -24,28 +24,39 @@ found in the :py:mod:`handlers` module.
 from __future__ import division
 
 import functools
+import hashlib
 import itertools
 import logging
-import logging.handlers
+import math
+import mimetypes
 import subprocess
 import sys
 import traceback
+import zlib
+from datetime import datetime
 from isbnlib import is_isbn10, is_isbn13
 
 import pkg_resources
 import requests
 from flask import (json, jsonify, request, send_file, render_template,
-                   redirect, make_response, Response)
+                   redirect, make_response, Response, url_for,
+                   stream_with_context)
 from werkzeug.contrib.cache import SimpleCache
+from werkzeug.http import is_resource_modified
 
 import spreads.metadata
 import spreads.plugin as plugin
 from spreads.util import is_os, get_version, DeviceException
-from spreads.workflow import Workflow, ValidationError
+from spreads.vendor.bagit import ChecksumMismatch, FileMissing
+from spreads.workflow import (Workflow, ValidationError, apply_transforms,
+                              on_created, on_removed)
 
 from spreadsplug.web.app import app
 from discovery import discover_servers
-from util import WorkflowConverter, get_thumbnail, scale_image, convert_image
+from util import (WorkflowConverter, DiskCache, get_thumbnail, scale_image,
+                  convert_image, get_dzi_descriptor, get_level_image, get_tile,
+                  is_source_level, build_sprite_sheet, SHEET_SIZE,
+                  WORKFLOW_FIELDS, UploadSession)
 
 if is_os('windows'):
     from util import find_stick_win as find_stick
@@ -178,20 +189,13 @@ def get_logs():
     """
     start = int(request.args.get('start', '0'))
     count = int(request.args.get('count', '50'))
-    level = request.args.get('level', 'INFO')
-    logbuffer = next(
-        x for x in logging.getLogger().handlers
-        if isinstance(x, logging.handlers.BufferingHandler)).buffer
-    available_levels = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
-    if level.upper() not in available_levels:
-        levels = available_levels[available_levels.index('INFO'):]
-    else:
-        levels = available_levels[available_levels.index(level.upper()):]
-    msgs = [msg for msg in sorted(logbuffer, key=lambda x: x.relativeCreated,
-                                  reverse=True)
-            if msg.levelname in levels]
-    return jsonify(total_num=len(msgs),
-                   messages=msgs[start:start+count])
+    level = request.args.get('level', 'INFO').upper()
+    if level not in ('DEBUG', 'INFO', 'WARNING', 'ERROR'):
+        level = 'INFO'
+    min_level = logging.getLevelName(level)
+    log_store = app.config['log_store']
+    return jsonify(total_num=log_store.count(min_level),
+                   messages=log_store.get_records(min_level, start, count))
 
 
 @app.route('/api/isbn')
@@ -480,6 +484,202 @@ def get_remote_config():
     return make_response(data, status, {'Content-Type': 'application/json'})
 
 
+# ================== #
+#  Upload endpoints  #
+# ================== #
+def _get_upload_session(session_id):
+    session = UploadSession.get(app.config['base_path'], session_id)
+    if session is None:
+        raise ApiException("Could not find upload session '{0}'"
+                           .format(session_id), 404, error_type='upload')
+    return session
+
+
+@app.route('/api/upload', methods=['POST'])
+@restrict_to_modes('processor', 'full')
+def create_upload_session():
+    """ Start a resumable workflow upload or resume an existing one.
+
+    If there already is a session for the same workflow, it is resumed,
+    staged files whose size or digest changed are discarded.
+    The files are then sent with `PUT` requests to
+    ``/api/upload/<session_id>/<path>`` and the upload is completed with a
+    `POST` request to ``/api/upload/<session_id>/finish``.
+
+    :reqheader Accept:          :mimetype:`application/json`
+    :<json string name:         Name of the workflow directory
+    :<json string workflow_id:  ID of the workflow on the uploading side
+    :<json string algorithm:    Algorithm used for the digests (default:
+                                ``md5``)
+    :<json object files:        Mapping from bag-relative paths to objects
+                                with the ``size`` and ``digest`` of every
+                                file in the bag
+    :<json boolean partial:     Whether only some of the files are announced
+                                (e.g. during capture), they are added to
+                                the files announced before. Refused once
+                                all files were announced. (default:
+                                ``false``)
+
+    :resheader Content-Type:    :mimetype:`application/json`
+    :>json string id:           ID of the session
+    :>json string name:         Name of the workflow directory
+    :>json object files:        Number of bytes received for every file
+    :>json array pending:       Files that were not received and verified
+                                completely
+
+    :status 200:    When the session was created or resumed
+    :status 400:    When the name, a path, a size, a digest or the
+                    algorithm is invalid or a partial announcement was made
+                    after all files were announced
+    """
+    data = json.loads(request.data)
+    try:
+        session = UploadSession.create(
+            app.config['base_path'], data.get('name'),
+            data.get('workflow_id'), data.get('files', {}),
+            data.get('algorithm', 'md5'), bool(data.get('partial')))
+    except ValueError as e:
+        raise ApiException(e.message, 400, error_type='upload')
+    return jsonify(session.get_status())
+
+
+@app.route('/api/upload/<session_id>', methods=['GET'])
+@restrict_to_modes('processor', 'full')
+def get_upload_session(session_id):
+    """ Get the state of an upload session.
+
+    :param session_id:  ID of the session
+    :type session_id:   str
+
+    :resheader Content-Type:    :mimetype:`application/json`
+    :>json string id:           ID of the session
+    :>json string name:         Name of the workflow directory
+    :>json object files:        Number of bytes received for every file
+    :>json array pending:       Files that were not received and verified
+                                completely
+
+    :status 200:    Everything OK
+    :status 404:    When there is no session with the given ID
+    """
+    return jsonify(_get_upload_session(session_id).get_status())
+
+
+@app.route('/api/upload/<session_id>/<path:fpath>', methods=['PUT'])
+@restrict_to_modes('processor', 'full')
+def upload_file_chunk(session_id, fpath):
+    """ Upload a chunk of a file.
+
+    The request body is appended to the file, which is verified once it is
+    complete. Zero-sized files have to be sent with an empty body.
+    The body may be compressed with ``Content-Encoding: deflate``, the
+    offsets always refer to the uncompressed file.
+
+    :param session_id:  ID of the session
+    :type session_id:   str
+    :param fpath:       Bag-relative path of the file
+    :type fpath:        str
+    :query offset:      Position of the chunk in the file, has to match the
+                        number of bytes received so far
+
+    :resheader Content-Type:    :mimetype:`application/json`
+    :>json string path:         Bag-relative path of the file
+    :>json int offset:          Number of bytes received for the file
+
+    :status 200:    When the chunk was written
+    :status 400:    When the complete file did not match its digest, the
+                    file has to be sent again from the start, or when the
+                    compressed body was malformed
+    :status 404:    When there is no such session or the file is not part
+                    of the session
+    :status 409:    When the offset did not match, the number of bytes
+                    received so far is returned as ``offset`` in the
+                    error payload
+    :status 415:    When the body was compressed with another encoding than
+                    ``deflate``
+    """
+    session = _get_upload_session(session_id)
+    offset = request.args.get('offset', 0, type=int)
+    data = request.get_data()
+    encoding = request.headers.get('Content-Encoding', 'identity')
+    if encoding == 'deflate':
+        # Never inflate more than fits into the file, the session rejects
+        # chunks that are too large anyway
+        max_size = session.files.get(fpath, {}).get('size', 0) - offset + 1
+        try:
+            data = zlib.decompressobj().decompress(data, max(max_size, 1))
+        except zlib.error as e:
+            raise ApiException("Malformed compressed chunk: {0}".format(e),
+                               400, error_type='upload')
+    elif encoding != 'identity':
+        raise ApiException("Unsupported content encoding: {0}"
+                           .format(encoding), 415, error_type='upload')
+    try:
+        offset = session.write(fpath, offset, data)
+    except KeyError:
+        raise ApiException("File '{0}' is not part of the upload"
+                           .format(fpath), 404, error_type='upload')
+    except ValueError as e:
+        raise ApiException(e.message, 409,
+                           {'offset': session.get_offset(fpath)}, 'upload')
+    except ChecksumMismatch as e:
+        raise ApiException(unicode(e), 400, {'offset': 0}, 'upload')
+    return jsonify(path=fpath, offset=offset)
+
+
+@app.route('/api/upload/<session_id>/finish', methods=['POST'])
+@restrict_to_modes('processor', 'full')
+def finish_upload_session(session_id):
+    """ Complete an upload and create the workflow from the received files.
+
+    If the workflow was uploaded before, it is updated in place.
+
+    :param session_id:  ID of the session
+
+    :resheader Content-Type:    :mimetype:`application/json`
+    :status 200:    When the workflow was created or updated, returns the
+                    workflow
+    :status 404:    When there is no session with the given ID
+    :status 409:    When not all files were announced, received and
+                    verified yet or the existing workflow is busy
+    """
+    session = _get_upload_session(session_id)
+    existing = Workflow.find_all(app.config['base_path'],
+                                 key='id').get(session.workflow_id)
+    if existing is not None and existing.path != session.target_path:
+        existing = None
+    if existing is not None and existing.status['step'] is not None:
+        raise ApiException("Cannot update a workflow while it is busy.",
+                           409, error_type='upload')
+    try:
+        wf_path = session.commit()
+    except ValueError as e:
+        raise ApiException(e.message, 409, session.get_status(), 'upload')
+    except FileMissing as e:
+        raise ApiException(unicode(e), 409, session.get_status(), 'upload')
+    if existing is not None:
+        workflow = Workflow.reload(existing)
+        on_removed.send(senderId=existing.id)
+    else:
+        workflow = Workflow(path=wf_path)
+    on_created.send(workflow, workflow=workflow)
+    return make_response(app.config['workflow_cache'].to_json(workflow),
+                         200, {'Content-Type': 'application/json'})
+
+
+@app.route('/api/upload/<session_id>', methods=['DELETE'])
+@restrict_to_modes('processor', 'full')
+def delete_upload_session(session_id):
+    """ Abort an upload and remove all files received so far.
+
+    :param session_id:  ID of the session
+
+    :status 200:    Everything OK
+    :status 404:    When there is no session with the given ID
+    """
+    _get_upload_session(session_id).discard()
+    return 'OK'
+
+
 # ================== #
 #  Workflow-related  #
 # ================== #
@@ -509,19 +709,139 @@ def create_workflow():
     workflow = Workflow.create(location=app.config['base_path'],
                                config=config,
                                metadata=metadata)
-    return make_response(json.dumps(workflow),
+    return make_response(app.config['workflow_cache'].to_json(workflow),
                          200, {'Content-Type': 'application/json'})
 
 
+def _get_fields(available):
+    """ Get the list of fields requested via the ``fields`` parameter.
+
+    :param available:   Names of the fields that can be requested
+    :type available:    iterable of str
+    :returns:           The requested fields or `None` if all fields should be
+                        returned
+    :rtype:             list of str or None
+    :raises:            :py:class:`spreads.workflow.ValidationError` if an
+                        unknown field was requested
+    """
+    if not request.args.get('fields'):
+        return None
+    fields = [f.strip() for f in request.args['fields'].split(',')
+              if f.strip()]
+    unknown = [f for f in fields if f not in available]
+    if unknown:
+        raise ValidationError(
+            fields="Unknown field(s): {0}".format(", ".join(unknown)))
+    return fields
+
+
+def make_listing_response(items, sort_key, parse_cursor, encode):
+    """ Build a response for a (possibly paginated) list of items.
+
+    Pagination is keyset-based: The ``cursor`` parameter holds the sort key
+    of the last item the client received, the response will only include
+    items that come after it. This way pages stay consistent when items are
+    added or removed between requests. If a ``limit`` is given and there are
+    more items left, the cursor for the next page is sent along in the
+    ``X-Next-Cursor`` header and a ``Link`` header with ``rel="next"``.
+
+    The items are returned as a JSON array by default. If the ``format``
+    parameter is ``ndjson`` or the client prefers
+    :mimetype:`application/x-ndjson`, the items are instead streamed as
+    newline-delimited JSON, one item per line, so that they are only
+    encoded as they are sent out.
+
+    :param items:           Items to list, or a function that returns the
+                            sort keys and items that come after a given sort
+                            key (or all of them, for `None`), sorted and up
+                            to a given number, see
+                            :py:meth:`util.WorkflowIndex.get_items`
+    :type items:            list or callable
+    :param sort_key:        Function that returns the sort key for an item,
+                            must return a tuple. Only needed if `items` is
+                            a list.
+    :type sort_key:         callable
+    :param parse_cursor:    Function that turns a cursor string into a sort
+                            key, raising a :py:exc:`ValueError` if it is
+                            malformed
+    :type parse_cursor:     callable
+    :param encode:          Function that encodes an item to a JSON string
+    :type encode:           callable
+    :resheader Content-Type:    :mimetype:`application/json` or
+                                :mimetype:`application/x-ndjson`
+    """
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit < 1:
+        raise ValidationError(limit="Must be a positive integer.")
+    cursor_key = None
+    if request.args.get('cursor'):
+        try:
+            cursor_key = parse_cursor(request.args['cursor'])
+        except ValueError:
+            raise ValidationError(cursor="Malformed cursor.")
+    if callable(items):
+        # Fetch one more item to see if there is a next page
+        keyed_items = items(cursor_key,
+                            None if limit is None else limit + 1)
+    else:
+        keyed_items = sorted(((sort_key(item), item) for item in items),
+                             key=lambda x: x[0])
+        if cursor_key is not None:
+            keyed_items = [x for x in keyed_items if x[0] > cursor_key]
+
+    headers = {}
+    if limit is not None and len(keyed_items) > limit:
+        keyed_items = keyed_items[:limit]
+        next_cursor = ":".join(unicode(x) for x in keyed_items[-1][0])
+        args = request.args.to_dict()
+        args['cursor'] = next_cursor
+        headers['X-Next-Cursor'] = next_cursor
+        headers['Link'] = '<{0}>; rel="next"'.format(
+            url_for(request.endpoint, **dict(request.view_args, **args)))
+
+    items = [item for _, item in keyed_items]
+    accept = request.accept_mimetypes
+    if (request.args.get('format') == 'ndjson' or
+            accept.best_match(['application/json', 'application/x-ndjson'])
+            == 'application/x-ndjson'):
+        def generate():
+            for item in items:
+                yield encode(item) + "\n"
+        return Response(stream_with_context(generate()),
+                        mimetype='application/x-ndjson', headers=headers)
+    headers['Content-Type'] = 'application/json'
+    return make_response("[{0}]".format(", ".join(encode(x) for x in items)),
+                         200, headers)
+
+
+def _parse_workflow_cursor(cursor):
+    timestamp, workflow_id = cursor.split(':', 1)
+    return (int(timestamp), workflow_id)
+
+
 @app.route('/api/workflow', methods=['GET'])
 def list_workflows():
-    """ Return a list of all workflows.
-
-    :resheader Content-Type:    :mimetype:`application/json`
+    """ Return a list of all workflows, most recently modified first.
+
+    :query fields:  Comma-separated list of fields to include for every
+                    workflow, e.g. ``id,slug,metadata,page_count``
+    :query limit:   Maximum number of workflows to return
+    :query cursor:  Cursor from the ``X-Next-Cursor`` header of the previous
+                    response
+    :query format:  ``ndjson`` to stream the workflows as newline-delimited
+                    JSON
+
+    :resheader Content-Type:    :mimetype:`application/json` or
+                                :mimetype:`application/x-ndjson`
+    :resheader X-Next-Cursor:   Cursor for the next page, if there is one
     """
-    workflows = Workflow.find_all(app.config['base_path'])
-    return make_response(json.dumps(workflows.values()),
-                         200, {'Content-Type': 'application/json'})
+    fields = _get_fields(WORKFLOW_FIELDS)
+    return make_listing_response(
+        app.config['workflow_index'].get_items,
+        sort_key=None,
+        parse_cursor=_parse_workflow_cursor,
+        encode=functools.partial(app.config['workflow_cache'].to_json,
+                                 fields=fields))
 
 
 @app.route('/api/workflow/<workflow:workflow>', methods=['GET'])
@@ -533,7 +853,7 @@ def get_workflow(workflow):
 
     :resheader Content-Type:    :mimetype:`application/json`
     """
-    return make_response(json.dumps(workflow),
+    return make_response(app.config['workflow_cache'].to_json(workflow),
                          200, {'Content-Type': 'application/json'})
 
 
@@ -562,7 +882,7 @@ def update_workflow(workflow):
         workflow.metadata = metadata
     # Persist to disk
     workflow.save()
-    return make_response(json.dumps(workflow),
+    return make_response(app.config['workflow_cache'].to_json(workflow),
                          200, {'Content-Type': 'application/json'})
 
 
@@ -590,6 +910,10 @@ def download_workflow(workflow):
     :type workflow:     str
     :queryparam fmt:    Archive format for download (`zip` or `tar`,
                         default: `tar`)
+    :queryparam compression:    Compression for ZIP archives, `auto` to
+                                compress files depending on their type
+                                (the size of the archive is not known in
+                                advance then), default: `none`
 
     :status 302:        Redirects to :http:get:`/api/workflow/\\
                         (str:workflow_id)/download/\\
@@ -598,9 +922,14 @@ def download_workflow(workflow):
     archive_format = request.args.get('fmt', 'tar')
     if archive_format not in ('zip', 'tar'):
         raise ValidationError(fmt='Must be zip or tar.')
+    compression = request.args.get('compression', 'none')
+    if compression not in ('none', 'auto'):
+        raise ValidationError(compression='Must be none or auto.')
     fname = "{0}.{1}".format(workflow.path.stem, archive_format)
-    return redirect('/api/workflow/{0}/download/{1}'.format(
-                    workflow.id, fname))
+    url = '/api/workflow/{0}/download/{1}'.format(workflow.id, fname)
+    if archive_format == 'zip' and compression != 'none':
+        url += '?compression={0}'.format(compression)
+    return redirect(url)
 
 
 @app.route('/api/workflow/<workflow:workflow>/transfer', methods=['POST'])
@@ -680,7 +1009,7 @@ def submit_workflow(workflow):
     user_config = data.get('config', {})
     from tasks import upload_workflow
     upload_workflow(workflow.id, app.config['base_path'],
-                    'http://{0}/api/workflow/upload'.format(server),
+                    'http://{0}'.format(server),
                     user_config,
                     start_process=data.get('start_process', False),
                     start_output=data.get('start_output', False))
@@ -691,6 +1020,10 @@ def submit_workflow(workflow):
 def get_output_file(workflow, fname):
     """ Download an output file.
 
+    When running inside of Tornado, this route is served by
+    :py:class:`spreadsplug.web.handlers.WorkflowFileHandler` instead, which
+    also supports `Range` requests.
+
     :param workflow:    UUID or slug for the workflow to download from
     :type workflow:     str
     :param fname:       Filename of the output file to download
@@ -705,12 +1038,18 @@ def get_output_file(workflow, fname):
         raise ApiException("Could not find file with name '{0}' amongst "
                            "output files for workflow '{1}'"
                            .format(fname, workflow.id), 404)
-    return send_file(unicode(fpath))
+    return make_file_response(
+        fpath, lambda: send_file(unicode(fpath), add_etags=False))
 
 
 # =============== #
 #  Page-related  #
 # =============== #
+#: Fields that can be requested when listing pages
+PAGE_FIELDS = ('sequence_num', 'capture_num', 'page_label', 'raw_image',
+               'processed_images', 'transforms')
+
+
 def inject_page(func):
     """ Decorator that injects a :py:class:`spreads.workflow.Page` object
         into the decorated function as the first argument.
@@ -765,6 +1104,69 @@ def inject_page_image(func):
     return inject_page(view_func)
 
 
+def get_cached_image(fpath, variant, transforms, create_func):
+    """ Get a derived version of an image from the on-disk image cache,
+        generating it if neccessary.
+
+    :param fpath:       Path to the source image
+    :type fpath:        :py:class:`pathlib.Path`
+    :param variant:     Identifier for the derived version
+    :type variant:      unicode
+    :param transforms:  Transforms applied to the source image
+    :type transforms:   list of dict
+    :param create_func: Function that generates the derived version
+    :type create_func:  callable
+    :rtype:             bytestring
+    """
+    image_cache = app.config.get('image_cache')
+    if image_cache is None:
+        return create_func()
+    key = image_cache.make_key(fpath, variant, transforms)
+    return image_cache.get_or_create(key, create_func)
+
+
+def make_file_response(fpath, create_response, variant=None,
+                       transforms=None):
+    """ Serve a file (or a version derived from it) with validators and
+        caching headers.
+
+    The ETag is derived from the file's path, modification time and size as
+    well as the variant and transforms, conditional requests are answered
+    with a 304 without generating the response body.
+    Clients can pass the ETag as the ``digest`` query parameter to obtain a
+    response that may be cached indefinitely, since any modification of the
+    file results in a different URL.
+
+    :param fpath:           Path to the file
+    :type fpath:            :py:class:`pathlib.Path`
+    :param create_response: Function that generates the full response
+    :type create_response:  callable
+    :param variant:         Identifier for the derived version
+    :type variant:          unicode
+    :param transforms:      Transforms applied to the file
+    :type transforms:       list of dict
+    :rtype:                 :py:class:`flask.Response`
+    """
+    etag = DiskCache.make_key(fpath, variant or 'original', transforms)
+    last_modified = datetime.utcfromtimestamp(int(fpath.stat().st_mtime))
+    if is_resource_modified(request.environ, etag=etag,
+                            last_modified=last_modified):
+        response = create_response()
+    else:
+        response = Response(status=304)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # Superseded by Cache-Control
+    response.expires = None
+    if request.args.get('digest') == etag:
+        response.headers['Cache-Control'] = (
+            'public, max-age=31536000, immutable')
+    else:
+        # Clients may store the response, but have to revalidate it
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
 @app.route('/api/workflow/<workflow:workflow>/page/<int:number>')
 @inject_page
 def get_single_page(workflow, number, page):
@@ -787,11 +1189,158 @@ def get_all_pages(workflow):
     :param workflow:    UUID or slug for a workflow
     :type workflow:     str
 
+    :query fields:  Comma-separated list of fields to include for every page
+    :query limit:   Maximum number of pages to return
+    :query cursor:  Cursor from the ``X-Next-Cursor`` header of the previous
+                    response
+    :query format:  ``ndjson`` to stream the pages as newline-delimited JSON
+
+    :resheader Content-Type:    :mimetype:`application/json` or
+                                :mimetype:`application/x-ndjson`
+    :resheader X-Next-Cursor:   Cursor for the next page, if there is one
+    """
+    fields = _get_fields(PAGE_FIELDS)
+
+    def encode(page):
+        if fields is None:
+            return json.dumps(page)
+        data = page.to_dict()
+        return json.dumps({f: data[f] for f in fields})
+
+    return make_listing_response(
+        workflow.pages,
+        sort_key=lambda page: (page.sequence_num,),
+        parse_cursor=lambda cursor: (int(cursor),),
+        encode=encode)
+
+
+def get_sprite_sheet(workflow, sheet_num, img_type):
+    """ Get a thumbnail sprite sheet for a range of pages, building it if
+        neccessary.
+
+    Sheets are cached by the cache keys of their thumbnails, so appending
+    pages to a workflow only invalidates its last sheet.
+
+    :param workflow:    Workflow to get sheet for
+    :type workflow:     :py:class:`spreads.workflow.Workflow`
+    :param sheet_num:   Number of the sheet, each sheet holds
+                        :py:data:`util.SHEET_SIZE` pages
+    :type sheet_num:    int
+    :param img_type:    Type of images, `raw` or `processed`
+    :type img_type:     str
+    :return:            The sheet's key, the sheet as a JPEG and the offset
+                        map for its pages
+    :rtype:             tuple
+    """
+    if img_type not in ('raw', 'processed'):
+        raise ValidationError(img_type="Image type must be one of 'raw' or "
+                                       "'processed' (was {0})"
+                                       .format(img_type))
+    pages = workflow.pages[sheet_num*SHEET_SIZE:(sheet_num+1)*SHEET_SIZE]
+    if sheet_num < 0 or not pages:
+        raise ApiException("No pages for sheet {0}".format(sheet_num), 404)
+    sources = []
+    for page in pages:
+        fpath = None
+        if img_type == 'processed':
+            fpath = page.get_latest_processed(image_only=True)
+        if fpath is None:
+            sources.append((page, page.raw_image, page.transforms))
+        else:
+            sources.append((page, fpath, None))
+    thumb_keys = [DiskCache.make_key(src_path, 'thumb', src_transforms)
+                  for _, src_path, src_transforms in sources]
+    sheet_key = unicode(hashlib.sha1('|'.join(thumb_keys)).hexdigest())
+    image_cache = app.config.get('image_cache')
+    if image_cache is not None:
+        sheet = image_cache.get('sheet-' + sheet_key)
+        offsets = image_cache.get('sheetmap-' + sheet_key)
+        if sheet is not None and offsets is not None:
+            return sheet_key, sheet, json.loads(offsets)
+    thumbnails = [
+        get_cached_image(
+            src_path, 'thumb', src_transforms,
+            lambda: get_thumbnail(src_path, transforms=src_transforms))
+        for _, src_path, src_transforms in sources]
+    sheet, positions = build_sprite_sheet(thumbnails)
+    offsets = []
+    for (page, _, _), position in zip(sources, positions):
+        position.update(capture_num=page.capture_num,
+                        sequence_num=page.sequence_num)
+        offsets.append(position)
+    if image_cache is not None:
+        image_cache.set('sheet-' + sheet_key, sheet)
+        image_cache.set('sheetmap-' + sheet_key, json.dumps(offsets))
+    return sheet_key, sheet, offsets
+
+
+@app.route('/api/workflow/<workflow:workflow>/sprites')
+def list_sprite_sheets(workflow):
+    """ List the thumbnail sprite sheets for a workflow.
+
+    Every sheet holds the thumbnails for a consecutive range of pages.
+
+    :param workflow:    UUID or slug for a workflow
+    :type workflow:     str
+
     :resheader Content-Type:    :mimetype:`application/json`
     """
+    num_pages = len(workflow.pages)
+    sheets = [{'sheet': num, 'first_page': num*SHEET_SIZE,
+               'num_pages': min(SHEET_SIZE, num_pages - num*SHEET_SIZE)}
+              for num in xrange(int(math.ceil(num_pages/SHEET_SIZE)))]
+    return jsonify(dict(sheet_size=SHEET_SIZE, sheets=sheets))
 
-    return make_response(json.dumps(workflow.pages),
-                         200, {'Content-Type': 'application/json'})
+
+@app.route('/api/workflow/<workflow:workflow>/sprites/<int:sheet_num>.json')
+def get_sprite_sheet_map(workflow, sheet_num):
+    """ Get the offset map for a thumbnail sprite sheet.
+
+    :param workflow:    UUID or slug for a workflow
+    :type workflow:     str
+    :param sheet_num:   Number of the sheet
+    :type sheet_num:    int
+    :queryparam img_type:   Type of images, `raw` (default) or `processed`
+    :type img_type:         str
+
+    :resheader Content-Type:    :mimetype:`application/json`
+    :>json string digest:   Digest of the sheet, pass it as the `digest`
+                            parameter when requesting the sheet image to
+                            allow for indefinite caching
+    :>json list pages:      Position (`x`, `y`) and size (`width`, `height`)
+                            of every page's thumbnail on the sheet
+    """
+    sheet_key, _, offsets = get_sprite_sheet(
+        workflow, sheet_num, request.args.get('img_type', 'raw'))
+    return jsonify(dict(digest=sheet_key, pages=offsets))
+
+
+@app.route('/api/workflow/<workflow:workflow>/sprites/<int:sheet_num>.jpg')
+def get_sprite_sheet_image(workflow, sheet_num):
+    """ Get the image for a thumbnail sprite sheet.
+
+    :param workflow:    UUID or slug for a workflow
+    :type workflow:     str
+    :param sheet_num:   Number of the sheet
+    :type sheet_num:    int
+    :queryparam img_type:   Type of images, `raw` (default) or `processed`
+    :type img_type:         str
+    :queryparam digest:     Digest of the sheet from its offset map, marks
+                            the response as immutable
+    :type digest:           str
+
+    :resheader Content-Type:    :mimetype:`image/jpeg`
+    """
+    sheet_key, sheet, _ = get_sprite_sheet(
+        workflow, sheet_num, request.args.get('img_type', 'raw'))
+    response = Response(sheet, mimetype='image/jpeg')
+    response.set_etag(sheet_key)
+    if request.args.get('digest') == sheet_key:
+        response.headers['Cache-Control'] = (
+            'public, max-age=31536000, immutable')
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 
 @app.route('/api/workflow/<workflow:workflow>/page/<int:number>/<img_type>',
@@ -821,10 +1370,16 @@ def get_page_image(fpath, page, workflow, number, img_type, plugname):
     :type format:       str, either `browser` or a format string recognized
                         by Pillow: http://pillow.readthedocs.org/en/latest/\\
                                    handbook/image-file-formats.html
+    :queryparam digest: ETag of the image, marks the response as immutable
+    :type digest:       str
 
     :resheader Content-Type:    Depends on value of `format`, by default
                                 the mime-type of the original image.
+                                Raw images with pending transforms (see
+                                :py:attr:`spreads.workflow.Page.transforms`)
+                                are always served as JPEG.
     """
+    transforms = page.transforms if img_type == 'raw' else None
     width = request.args.get('width', None)
     img_format = request.args.get('format', None)
     # FIXME: This clearly sucks, rework convert_image and scale_image to allow
@@ -838,15 +1393,43 @@ def get_page_image(fpath, page, workflow, number, img_type, plugname):
                            400)
     if width:
         # Scale image if requested
-        return scale_image(fpath, width=int(width))
+        variant = 'width={0}'.format(int(width))
+        return make_file_response(
+            fpath,
+            lambda: Response(
+                get_cached_image(
+                    fpath, variant, transforms,
+                    lambda: scale_image(fpath, width=int(width),
+                                        transforms=transforms)),
+                mimetype='image/jpeg'),
+            variant, transforms)
     elif img_format:
         # Convert to target format
         if fpath.suffix.lower() not in ('.tif', '.tiff', '.jpg', '.jpeg'):
             img_format = 'png' if img_format == 'browser' else img_format
-        return convert_image(fpath, img_format)
+        variant = 'format={0}'.format(img_format)
+        return make_file_response(
+            fpath,
+            lambda: Response(
+                get_cached_image(
+                    fpath, variant, transforms,
+                    lambda: convert_image(fpath, img_format,
+                                          transforms=transforms)),
+                mimetype=mimetypes.types_map.get(
+                    '.' + img_format.lower(), 'application/octet-stream')),
+            variant, transforms)
+    elif transforms:
+        return make_file_response(
+            fpath,
+            lambda: Response(
+                get_cached_image(fpath, 'transformed', transforms,
+                                 lambda: apply_transforms(fpath, transforms)),
+                mimetype='image/jpeg'),
+            'transformed', transforms)
     else:
         # Send unmodified if no scaling/converting is requested
-        return send_file(unicode(fpath))
+        return make_file_response(
+            fpath, lambda: send_file(unicode(fpath), add_etags=False))
 
 
 @app.route('/api/workflow/<workflow:workflow>/page/<int:number>/<img_type>/'
@@ -859,14 +1442,93 @@ def get_page_image_thumb(fpath, page, workflow, number, img_type, plugname):
     if fpath.suffix.lower() not in ('.jpg', '.jpeg', '.tif', '.tiff', '.png'):
         raise ApiException("Can not serve thumbnails for files with type {0}"
                            .format(fpath.suffix), 400)
-    cache_key = "{0}.{1}.{2}".format(workflow.id, img_type, fpath.name)
-    thumbnail = None
-    if not request.args:
-        thumbnail = cache.get(cache_key)
-    if thumbnail is None:
-        thumbnail = get_thumbnail(fpath)
-        cache.set(cache_key, thumbnail)
-    return Response(thumbnail, mimetype='image/jpeg')
+    transforms = page.transforms if img_type == 'raw' else None
+    return make_file_response(
+        fpath,
+        lambda: Response(
+            get_cached_image(
+                fpath, 'thumb', transforms,
+                lambda: get_thumbnail(fpath, transforms=transforms)),
+            mimetype='image/jpeg'),
+        'thumb', transforms)
+
+
+@app.route('/api/workflow/<workflow:workflow>/page/<int:number>/<img_type>/'
+           'tiles.dzi', defaults={'plugname': None})
+@app.route('/api/workflow/<workflow:workflow>/page/<int:number>/<img_type>/'
+           '<plugname>/tiles.dzi')
+@inject_page_image
+def get_page_image_dzi(fpath, page, workflow, number, img_type, plugname):
+    """ Get the Deep Zoom Image descriptor for a page image.
+
+    The tiles are located relative to the descriptor, see
+    :py:func:`get_page_image_tile`.
+
+    :resheader Content-Type:    :mimetype:`application/xml`
+    """
+    if fpath.suffix.lower() not in ('.jpg', '.jpeg', '.tif', '.tiff', '.png'):
+        raise ApiException("Can not generate tiles for files with type {0}"
+                           .format(fpath.suffix), 400)
+    transforms = page.transforms if img_type == 'raw' else None
+    return make_file_response(
+        fpath,
+        lambda: Response(
+            get_cached_image(
+                fpath, 'dzi', transforms,
+                lambda: get_dzi_descriptor(fpath, transforms=transforms)),
+            mimetype='application/xml'),
+        'dzi', transforms)
+
+
+@app.route('/api/workflow/<workflow:workflow>/page/<int:number>/<img_type>/'
+           'tiles_files/<int:level>/<int:column>_<int:row>.jpg',
+           defaults={'plugname': None})
+@app.route('/api/workflow/<workflow:workflow>/page/<int:number>/<img_type>/'
+           '<plugname>/tiles_files/<int:level>/<int:column>_<int:row>.jpg')
+@inject_page_image
+def get_page_image_tile(fpath, page, workflow, number, img_type, plugname,
+                        level, column, row):
+    """ Get a single tile from the deep zoom pyramid of a page image.
+
+    Tiles are generated on demand and cached on disk, so zooming into a
+    region of a full-resolution image only transfers the visible tiles.
+
+    :param level:       Level of the pyramid, level 0 is a single pixel and
+                        each following level doubles the dimensions
+    :type level:        int
+    :param column:      Column of the tile
+    :type column:       int
+    :param row:         Row of the tile
+    :type row:          int
+
+    :resheader Content-Type:    :mimetype:`image/jpeg`
+    """
+    if fpath.suffix.lower() not in ('.jpg', '.jpeg', '.tif', '.tiff', '.png'):
+        raise ApiException("Can not generate tiles for files with type {0}"
+                           .format(fpath.suffix), 400)
+    transforms = page.transforms if img_type == 'raw' else None
+    variant = 'tile={0}/{1}_{2}'.format(level, column, row)
+
+    def create_tile():
+        if is_source_level(fpath, level, transforms):
+            # Caching a copy of the full-resolution image would only push
+            # the thumbnails out of the cache
+            level_image = get_level_image(fpath, level, transforms=transforms)
+        else:
+            level_image = get_cached_image(
+                fpath, 'level={0}'.format(level), transforms,
+                lambda: get_level_image(fpath, level, transforms=transforms))
+        return get_tile(level_image, column, row)
+
+    try:
+        return make_file_response(
+            fpath,
+            lambda: Response(
+                get_cached_image(fpath, variant, transforms, create_tile),
+                mimetype='image/jpeg'),
+            variant, transforms)
+    except ValueError as e:
+        raise ApiException(e.message, 404)
 
 
 @app.route('/api/workflow/<workflow:workflow>/page/<int:number>',
@@ -883,17 +1545,18 @@ def delete_page(workflow, number, page):
     methods=['POST'], defaults={'plugname': None})
 @inject_page
 def crop_workflow_image(workflow, number, img_type, plugname, page):
-    """ Crop a page image in place. """
-    # TODO: We have to update the checksum!
+    """ Crop a page image.
+
+    The crop is not applied to the image file, but recorded as a transform
+    on the page that is applied when the image is served or processed.
+    """
     if img_type != 'raw':
         raise ApiException("Can only crop raw images.", 400)
     left = int(request.args.get('left', 0))
     top = int(request.args.get('top', 0))
     width = int(request.args.get('width', 0)) or None
     height = int(request.args.get('height', 0)) or None
-    workflow.crop_page(page, left, top, width, height, async=True)
-    cache_key = "{0}.{1}.{2}".format(workflow.id, 'raw', page.raw_image.name)
-    cache.delete(cache_key)
+    workflow.crop_page(page, left, top, width, height)
     return 'OK'
 
 
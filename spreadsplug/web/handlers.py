@@ -15,197 +15,701 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import fnmatch
 import itertools
 import json
 import logging
 import os
 import uuid
 import tarfile
-import tempfile
 import threading
 import time
 import zipfile
 import Queue
+from collections import deque
 
 import blinker
+from concurrent.futures import Future
 from tornado.ioloop import IOLoop
-from tornado.web import RequestHandler, asynchronous, stream_request_body
-from tornado.websocket import WebSocketHandler as TornadoWebSocketHandler
+from tornado.web import (HTTPError, RequestHandler, StaticFileHandler,
+                         asynchronous, stream_request_body)
+from tornado.websocket import (WebSocketClosedError,
+                               WebSocketHandler as TornadoWebSocketHandler)
 
 import util
+from spreads.util import EventHandler
+from spreads.vendor.bagit import BagError
 from spreads.workflow import Workflow
 
 signals = blinker.Namespace()
 on_download_finished = signals.signal('download:finished')
 
-event_buffer = None  # NOTE: Will be set after we defined EventHandler
-
+logger = logging.getLogger('spreadsplug.web.handlers')
 
-class BoundaryStripper(object):
-    def __init__(self):
-        self.initialized = False
-
-    def process(self, data):
-        trimmed = data.splitlines()
-        tmp = data.splitlines(True)
-        if not self.initialized:
-            self.boundary = trimmed[0].strip()
-            tmp = tmp[1:]
-            trimmed = trimmed[1:]
-            self.initialized = True
-            try:
-                firstelem = trimmed[:5].index("")
-                tmp = tmp[firstelem + 1:]
-                trimmed = trimmed[firstelem + 1:]
-            except ValueError:
-                pass
-        try:
-            lastelem = trimmed.index(self.boundary + "--")
-            self.initialized = False
-            return "".join(tmp[:lastelem])
-        except ValueError:
-            return "".join(tmp)
+event_buffer = None  # NOTE: Will be set after we defined EventHandler
 
 
 class WebSocketHandler(TornadoWebSocketHandler):
+    """ Broadcasts events to all connected websocket clients.
+
+    Events can be sent from any thread. They are encoded once, handed over
+    to the IOLoop and sent out in batches (as a JSON array) with every
+    iteration of the loop. Every client has a bounded queue of events that
+    still have to be sent to it, with at most one write in flight at a time.
+    Progress events (status changes and ``*:progressed`` events) that have
+    not been sent yet are replaced by newer ones for the same sender, so
+    slow clients only get the most recent progress.
+    """
     # This is a class attribute valid for all SocketHandler objects, used
     # to store a reference to all open websockets.
     clients = []
-    lock = threading.Lock()
+    #: Maximum number of events waiting to be sent to a single client
+    max_queued = 256
+    #: Encoded events waiting to be handed over to the clients
+    _pending = []
+    _pending_lock = threading.Lock()
+    _flush_scheduled = False
 
     def open(self):
+        #: (merge key, encoded event) pairs waiting to be sent
+        self.queue = deque()
+        self.sending = False
+        #: Minimum level of the log records the client subscribed to
+        self.log_level = None
         if self not in self.clients:
             self.clients.append(self)
 
     def on_close(self):
         if self in self.clients:
             self.clients.remove(self)
+        log_forwarder.unsubscribe(self)
+
+    def on_message(self, message):
+        """ Handle (un-)subscriptions to log records.
+
+        Clients subscribe with ``{"subscribe": "logrecord", "level": ...}``
+        and unsubscribe with ``{"unsubscribe": "logrecord"}``.
+        """
+        try:
+            data = json.loads(message)
+            if data.get('subscribe') == 'logrecord':
+                self.log_level = parse_log_level(data.get('level', 'info'))
+                log_forwarder.subscribe(self, self.log_level)
+            elif data.get('unsubscribe') == 'logrecord':
+                self.log_level = None
+                log_forwarder.unsubscribe(self)
+        except (ValueError, AttributeError):
+            logger.warning("Invalid websocket message: {0}".format(message))
 
     @staticmethod
-    def send_event(event):
-        data = json.dumps(event, cls=util.CustomJSONEncoder)
-        for client in WebSocketHandler.clients:
-            with WebSocketHandler.lock:
-                client.write_message(data)
+    def _get_merge_key(event):
+        """ Get the key under which newer versions of a progress event
+            replace older ones, or `None` if the event is not about progress.
+        """
+        name = event.signal.name
+        changes = event.data.get('changes', {})
+        is_progress = (name.endswith(':progressed') or
+                       (name == 'workflow:modified' and
+                        changes.keys() == ['status']))
+        if not is_progress:
+            return None
+        sender_id = (event.data.get('senderId') or
+                     getattr(event.sender, 'id', None))
+        return (name, sender_id)
+
+    @classmethod
+    def send_event(cls, event, log_level=None):
+        """ Broadcast an event to all connected clients.
+
+        Safe to call from any thread, the actual sending happens on the
+        IOLoop.
+
+        :param event:       Event to broadcast
+        :type event:        :py:class:`util.Event`
+        :param log_level:   Level of the log record in the event, it will
+                            only be sent to clients subscribed to this level
+        :type log_level:    int
+        """
+        if not cls.clients:
+            return
+        item = (cls._get_merge_key(event),
+                json.dumps(event, cls=util.CustomJSONEncoder), log_level)
+        with cls._pending_lock:
+            cls._pending.append(item)
+            if cls._flush_scheduled:
+                return
+            cls._flush_scheduled = True
+        IOLoop.instance().add_callback(cls._flush_pending)
+
+    @classmethod
+    def _flush_pending(cls):
+        with cls._pending_lock:
+            items, cls._pending = cls._pending, []
+            cls._flush_scheduled = False
+        for client in list(cls.clients):
+            client.enqueue([
+                (key, encoded) for key, encoded, log_level in items
+                if log_level is None or (client.log_level is not None and
+                                         log_level >= client.log_level)])
+            client.send_queued()
+
+    def enqueue(self, items):
+        """ Add encoded events to the client's queue.
+
+        :param items:   (merge key, encoded event) pairs
+        :type items:    list of tuple
+        """
+        for key, encoded in items:
+            if key is not None:
+                self.queue = deque(x for x in self.queue if x[0] != key)
+            self.queue.append((key, encoded))
+        num_dropped = len(self.queue) - self.max_queued
+        if num_dropped > 0:
+            logger.warning("Websocket client {0} is too slow, dropping {1} "
+                           "events".format(self.request.remote_ip,
+                                           num_dropped))
+            for _ in xrange(num_dropped):
+                self.queue.popleft()
+
+    def send_queued(self):
+        """ Send all queued events as a single message, unless a previous
+            message is still being written.
+        """
+        if self.sending or not self.queue:
+            return
+        message = "[{0}]".format(", ".join(x[1] for x in self.queue))
+        self.queue.clear()
+        try:
+            future = self.write_message(message)
+        except WebSocketClosedError:
+            self.on_close()
+            return
+        self.sending = True
+        IOLoop.current().add_future(future, self._on_sent)
+
+    def _on_sent(self, future):
+        self.sending = False
+        if future.exception() is not None:
+            self.on_close()
+            return
+        self.send_queued()
+
+
+class CursorTooOld(Exception):
+    """ Raised when the events following a cursor are no longer buffered.
+
+    :attr last_id:  ID of the most recent event
+    :type last_id:  int
+    """
+    def __init__(self, last_id):
+        super(CursorTooOld, self).__init__(
+            "Events after the cursor are no longer available.")
+        self.last_id = last_id
+
+
+def make_event_filter(workflow_id=None, event_names=None, log_level=None):
+    """ Create a function that checks if an event matches a subscription.
+
+    :param workflow_id:     Only match events that belong to the workflow
+                            with this ID. Events that do not belong to any
+                            workflow (e.g. log records) always match.
+    :type workflow_id:      unicode
+    :param event_names:     Only match events with one of these names,
+                            shell-style wildcards (e.g. ``workflow:*``) are
+                            supported.
+    :type event_names:      list of unicode
+    :param log_level:       Only match log records at or above this level.
+                            If not set, log records never match.
+    :type log_level:        int
+    :returns:               The filter function
+    :rtype:                 callable
+    """
+    def event_filter(event):
+        if event.signal is EventHandler.on_log_emit:
+            if (log_level is None or
+                    event.data['record'].levelno < log_level):
+                return False
+        if event_names and not any(fnmatch.fnmatchcase(event.signal.name, p)
+                                   for p in event_names):
+            return False
+        if workflow_id:
+            if isinstance(event.sender, Workflow):
+                sender_id = event.sender.id
+            else:
+                sender_id = event.data.get('senderId')
+            if sender_id is not None and sender_id != workflow_id:
+                return False
+        return True
+    return event_filter
 
 
 class EventBuffer(object):
-    def __init__(self):
-        self.waiters = set()
-        self.cache = []
-        self.cache_size = 200
-        self.counter = itertools.count()
-        self.count_lock = threading.Lock()
-
-    def wait_for_events(self, callback, cursor=None):
-        if cursor:
-            cursor = int(cursor)
-            new_count = 0
-            for event in reversed(self.cache):
-                if event.id == cursor:
-                    break
-                new_count += 1
-            if new_count:
-                callback(self.cache[-new_count:])
-                return
-        self.waiters.add(callback)
+    """ Buffer of the most recent events for long-polling clients.
+
+    Events get consecutive IDs, so the events following a client's cursor
+    can be located without searching the buffer. The size of the buffer is
+    limited by the total length of the encoded events, which are encoded
+    once when they come in.
+
+    :param max_bytes:   Maximum total length of the buffered, encoded events
+    :type max_bytes:    int
+    """
+    def __init__(self, max_bytes=1024**2):
+        self.max_bytes = max_bytes
+        #: Mapping from waiting callbacks to their event filters
+        self.waiters = {}
+        #: (event, encoded event) pairs, oldest first
+        self.cache = deque()
+        self.cache_bytes = 0
+        #: ID of the most recent event, IDs start at 1
+        self.last_id = 0
+        self.lock = threading.Lock()
+
+    def wait_for_events(self, callback, cursor=None, event_filter=None):
+        """ Call `callback` with the events following `cursor`.
+
+        If there are no matching events after the cursor (or no cursor was
+        given), the callback will be called once matching events come in.
+
+        :param callback:        Function that is called with the matching
+                                events, encoded as JSON
+        :type callback:         callable
+        :param cursor:          ID of the last event the client received
+        :type cursor:           int
+        :param event_filter:    Function that returns whether an event
+                                should be passed to the callback, see
+                                :py:func:`make_event_filter`
+        :type event_filter:     callable
+        :raises:                :py:class:`CursorTooOld` if the events after
+                                the cursor are no longer buffered or the
+                                cursor is not known (e.g. after a restart)
+        """
+        with self.lock:
+            if cursor is not None:
+                cursor = int(cursor)
+                first_id = self.last_id - len(self.cache) + 1
+                if not (first_id - 1) <= cursor <= self.last_id:
+                    raise CursorTooOld(self.last_id)
+                num_new = self.last_id - cursor
+                events = [encoded for event, encoded
+                          in itertools.islice(reversed(self.cache), num_new)
+                          if event_filter is None or event_filter(event)]
+                events.reverse()
+            else:
+                events = None
+            if not events:
+                self.waiters[callback] = event_filter
+        if events:
+            callback(events)
 
     def cancel_wait(self, callback):
-        self.waiters.remove(callback)
+        with self.lock:
+            self.waiters.pop(callback, None)
 
     def new_events(self, events):
-        for event in events:
-            with self.count_lock:
-                event.id = next(self.counter)
-        for callback in self.waiters:
+        to_notify = []
+        with self.lock:
+            entries = []
+            for event in events:
+                self.last_id += 1
+                event.id = self.last_id
+                entries.append(
+                    (event, json.dumps(event, cls=util.CustomJSONEncoder)))
+            self.cache.extend(entries)
+            self.cache_bytes += sum(len(encoded) for _, encoded in entries)
+            # Always keep the most recent event around
+            while self.cache_bytes > self.max_bytes and len(self.cache) > 1:
+                self.cache_bytes -= len(self.cache.popleft()[1])
+            for callback, event_filter in self.waiters.items():
+                matching = [encoded for event, encoded in entries
+                            if event_filter is None or event_filter(event)]
+                if matching:
+                    to_notify.append((callback, matching))
+                    del self.waiters[callback]
+        for callback, matching in to_notify:
             try:
-                callback(events)
+                callback(matching)
             except:
                 logging.error("Error in waiter callback", exc_info=True)
-        self.waiters = set()
-        self.cache.extend(events)
-        if len(self.cache) > self.cache_size:
-            self.cache = self.cache[-self.cache_size:]
 # Global event buffer (previously defined at the top of the module)
 event_buffer = EventBuffer()
 
 
 class EventLongPollingHandler(RequestHandler):
+    """ Long-polling endpoint for events.
+
+    Clients pass the ID of the last event they received as the ``cursor``
+    argument and can subscribe to the events of a single workflow (via the
+    ``workflow`` argument, which takes a workflow ID) or to certain event
+    types (via the comma-separated ``events`` argument). If the events after
+    the cursor are no longer available, the request fails with status code
+    410 and the client has to fetch the current state again and continue
+    polling from the ``cursor`` included in the response.
+    """
     @asynchronous
     def post(self):
         cursor = self.get_argument("cursor", None)
-        event_buffer.wait_for_events(self.on_new_events, cursor=cursor)
+        event_names = self.get_argument("events", None)
+        log_level = self.get_argument("loglevel", None)
+        if log_level is not None:
+            log_level = parse_log_level(log_level)
+            log_forwarder.poll(log_level)
+        event_filter = make_event_filter(
+            workflow_id=self.get_argument("workflow", None),
+            event_names=event_names.split(',') if event_names else None,
+            log_level=log_level)
+        try:
+            event_buffer.wait_for_events(self.on_new_events, cursor=cursor,
+                                         event_filter=event_filter)
+        except ValueError:
+            raise HTTPError(400, "Malformed cursor.")
+        except CursorTooOld as e:
+            self.set_status(410)
+            self.set_header('Content-Type', 'application/json')
+            self.finish(json.dumps({'message': unicode(e),
+                                    'cursor': e.last_id}))
 
     def on_new_events(self, events):
+        # New events can come in on any thread
+        IOLoop.instance().add_callback(self._send_events, events)
+
+    def _send_events(self, events):
         if self.request.connection.stream.closed():
             return
-        self.finish(json.dumps(dict(events=events),
-                               cls=util.CustomJSONEncoder))
+        self.set_header('Content-Type', 'application/json')
+        self.finish('{{"events": [{0}]}}'.format(", ".join(events)))
 
     def on_connection_close(self):
         event_buffer.cancel_wait(self.on_new_events)
 
 
+def parse_log_level(name):
+    """ Get the number of a log level from its (case-insensitive) name.
+
+    :raises:    :py:exc:`ValueError` if the level is unknown
+    """
+    level = logging.getLevelName(unicode(name).upper())
+    if not isinstance(level, int):
+        raise ValueError("Unknown log level: {0}".format(name))
+    return level
+
+
+class LogForwarder(object):
+    """ Forwards log records to the clients that subscribed to them.
+
+    Websocket clients subscribe with a minimum level for as long as they
+    are connected, long-polling clients by passing a minimum level with
+    every poll, their subscription expires after :py:attr:`poll_timeout`
+    seconds without a poll. The level of the
+    :py:class:`spreads.util.EventHandler` is raised to the lowest subscribed
+    level, so records that nobody subscribed to are not even emitted.
+
+    Repeated records (i.e. with the same logger, level and message template)
+    are limited to :py:attr:`max_rate` per second, the number of records
+    that were suppressed is sent along with the next one that gets through.
+    """
+    #: Seconds after which a long-polling subscription expires
+    poll_timeout = 60
+    #: Maximum number of repeated records per second
+    max_rate = 5
+    #: Maximum number of messages whose rates are tracked
+    max_tracked = 1024
+
+    def __init__(self):
+        self.subscribers = {}
+        #: Mapping from subscribed levels of long-polling clients to the time
+        #: of the last poll
+        self.poll_levels = {}
+        #: Mapping from messages to [tokens, time of last update,
+        #: number of suppressed records]
+        self.buckets = {}
+        self.min_level = None
+        self.lock = threading.Lock()
+
+    def subscribe(self, client, level):
+        with self.lock:
+            self.subscribers[client] = level
+            self._update_level()
+
+    def unsubscribe(self, client):
+        with self.lock:
+            if self.subscribers.pop(client, None) is not None:
+                self._update_level()
+
+    def poll(self, level):
+        with self.lock:
+            self.poll_levels[level] = time.time()
+            self._update_level()
+
+    def update_level(self):
+        """ Adjust the level of the event handler to the subscriptions. """
+        with self.lock:
+            self._update_level()
+
+    def _update_level(self):
+        expired = time.time() - self.poll_timeout
+        for level, last_poll in self.poll_levels.items():
+            if last_poll < expired:
+                del self.poll_levels[level]
+        levels = self.subscribers.values() + self.poll_levels.keys()
+        self.min_level = min(levels) if levels else None
+        handler_level = (self.min_level if self.min_level is not None
+                         else logging.CRITICAL+1)
+        for handler in logging.getLogger().handlers:
+            if isinstance(handler, EventHandler):
+                handler.setLevel(handler_level)
+
+    def _is_limited(self, record):
+        """ Check if a record exceeds the rate limit for its message.
+
+        :returns:   `None` if the record is to be suppressed, otherwise the
+                    number of records that were suppressed before it
+        """
+        key = (record.name, record.levelno, unicode(record.msg))
+        now = time.time()
+        if key not in self.buckets and len(self.buckets) >= self.max_tracked:
+            self.buckets.clear()
+        bucket = self.buckets.setdefault(key, [self.max_rate, now, 0])
+        bucket[0] = min(self.max_rate,
+                        bucket[0] + (now - bucket[1])*self.max_rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return None
+        bucket[0] -= 1
+        suppressed, bucket[2] = bucket[2], 0
+        return suppressed
+
+    def forward(self, sender=None, record=None, **kwargs):
+        """ Receiver for :py:attr:`spreads.util.EventHandler.on_log_emit`.
+        """
+        with self.lock:
+            if self.poll_levels:
+                self._update_level()
+            if self.min_level is None or record.levelno < self.min_level:
+                return
+            suppressed = self._is_limited(record)
+            if suppressed is None:
+                return
+            to_websockets = any(level <= record.levelno
+                                for level in self.subscribers.itervalues())
+            to_buffer = any(level <= record.levelno
+                            for level in self.poll_levels)
+        data = {'record': record, 'suppressed': suppressed}
+        if to_websockets:
+            WebSocketHandler.send_event(
+                util.Event(EventHandler.on_log_emit, None, dict(data)),
+                log_level=record.levelno)
+        if to_buffer:
+            event_buffer.new_events(
+                [util.Event(EventHandler.on_log_emit, None, dict(data))])
+
+
+# Global log forwarder
+log_forwarder = LogForwarder()
+
+
 @stream_request_body
 class StreamingUploadHandler(RequestHandler):
+    """ Receives a workflow bag as a ZIP archive.
+
+    The archive is extracted into the workflow directory and verified
+    against the bag's manifests while it is being received, the response is
+    sent as soon as the last entry was checked.
+    Invalid or incomplete uploads are answered with a 400 status code,
+    uploads of workflows that already exist with a 409 status code, the
+    partially extracted workflow is removed in both cases.
+    """
     def initialize(self, base_path):
         self.base_path = base_path
 
     def prepare(self):
-        self.stripper = BoundaryStripper()
         self.request.connection.set_max_body_size(2*1024**3)
-        fdesc, self.fname = tempfile.mkstemp()
-        self.fp = os.fdopen(fdesc, 'wb')
+        self.extractor = util.ZipStreamExtractor(self.base_path)
+        self.error = None
+        self.error_status = 400
 
     def data_received(self, chunk):
-        # FIXME: When do we need the stripper???
-        # self.fp.write(self.stripper.process(chunk))
-        self.fp.write(chunk)
-        self.fp.flush()
+        if self.error is not None:
+            return
+        try:
+            self.extractor.feed(chunk)
+        except (zipfile.BadZipfile, BagError) as e:
+            self._abort(e)
+        except ValueError as e:
+            self._abort(e, 409)
+
+    def on_connection_close(self):
+        if not self.extractor.finished:
+            logger.warning("Connection closed during workflow upload")
+            self.extractor.abort()
 
     def post(self):
-        self.fp.close()
-        with zipfile.ZipFile(self.fname) as zf:
-            wfname = os.path.dirname(zf.namelist()[0])
-            zf.extractall(path=self.base_path)
-        os.unlink(self.fname)
+        if self.error is None:
+            try:
+                wf_path = self.extractor.finish()
+            except (zipfile.BadZipfile, BagError) as e:
+                self._abort(e)
+            except ValueError as e:
+                self._abort(e, 409)
+        self.set_header('Content-Type', 'application/json')
+        if self.error is not None:
+            self.set_status(self.error_status)
+            self.write(json.dumps({'type': 'upload', 'payload': None,
+                                   'message': self.error}))
+            return
 
-        workflow = Workflow(path=os.path.join(self.base_path, wfname))
+        workflow = Workflow(path=wf_path)
         from spreads.workflow import on_created
         on_created.send(workflow, workflow=workflow)
-
-        self.set_header('Content-Type', 'application/json')
         self.write(json.dumps(workflow, cls=util.CustomJSONEncoder))
 
+    def _abort(self, error, status=400):
+        logger.error("Workflow upload failed: {0}".format(error))
+        self.error = unicode(error)
+        self.error_status = status
+        self.extractor.abort()
 
-class ZipDownloadHandler(RequestHandler):
-    def initialize(self, base_path):
+
+class ThrottledDownloadHandler(RequestHandler):
+    """ Base class for handlers that stream workflow archives to the client.
+
+    The chunks are sent as soon as the (optional)
+    :py:class:`util.RateLimiter` allows it.
+    """
+    def initialize(self, base_path, rate_limiter=None):
         self.base_path = base_path
+        self.rate_limiter = rate_limiter
+
+    def send_chunk(self, chunk, callback):
+        """ Write and flush a chunk once the rate limiter allows it.
+
+        :param chunk:       Data to send
+        :type chunk:        str
+        :param callback:    Called when the chunk was flushed
+        """
+        delay = 0
+        if self.rate_limiter is not None:
+            delay = self.rate_limiter.reserve(len(chunk))
+        if delay is None:
+            # Transfers are paused, try again later
+            IOLoop.current().call_later(util.RateLimiter.POLL_INTERVAL,
+                                        self.send_chunk, chunk, callback)
+        elif delay:
+            IOLoop.current().call_later(delay, self._write_chunk, chunk,
+                                        callback)
+        else:
+            self._write_chunk(chunk, callback)
+
+    def _write_chunk(self, chunk, callback):
+        self.write(chunk)
+        self.flush(callback=callback)
+
 
+class ZipDownloadHandler(ThrottledDownloadHandler):
+    """ Stream a workflow as a ZIP archive.
+
+    With the `compression` argument set to `auto`, the compression is picked
+    per file (see :py:func:`util.get_compress_type`) and the archive is sent
+    without a `Content-Length`. By default, no file is compressed and the
+    size of the archive is known in advance.
+    """
     @asynchronous
     def get(self, workflow_id, filename):
         uuid.UUID(workflow_id)
         workflow = Workflow.find_by_id(self.base_path, workflow_id)
-        zstream = workflow.bag.package_as_zipstream(compression=None)
+        compression = self.get_argument('compression', 'none')
+        if compression not in ('none', 'auto'):
+            raise HTTPError(400, "compression must be 'none' or 'auto'")
 
         self.set_status(200)
         self.set_header('Content-type', 'application/zip')
-        self.set_header('Content-length',
-                        str(util.calculate_zipsize(zstream.paths_to_write)))
-
-        self.zstream_iter = iter(zstream)
+        if compression == 'auto':
+            self.zstream_iter = util.CompressingZipStream(
+                workflow.bag).iter_nonblocking()
+        else:
+            zstream = workflow.bag.package_as_zipstream(compression=None)
+            self.set_header(
+                'Content-length',
+                str(util.calculate_zipsize(zstream.paths_to_write)))
+            self.zstream_iter = iter(zstream)
 
         self.send_next_chunk()
 
     def send_next_chunk(self):
         try:
-            self.write(next(self.zstream_iter))
-            self.flush(callback=self.send_next_chunk)
+            chunk = next(self.zstream_iter)
         except StopIteration:
             self.finish()
+        else:
+            if isinstance(chunk, Future):
+                # Still being compressed, don't block the IOLoop meanwhile
+                IOLoop.current().add_future(
+                    chunk, lambda future: self.send_next_chunk())
+                return
+            self.send_chunk(chunk, self.send_next_chunk)
         on_download_finished.send()
 
 
+class WSGIStatsHandler(RequestHandler):
+    """ Report the load of the WSGI container's thread pool.
+
+    This is served directly from the IOLoop, so it also responds when all
+    workers are busy.
+    """
+    def initialize(self, container):
+        self.container = container
+
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(self.container.stats))
+
+
+class WorkflowFileHandler(StaticFileHandler):
+    """ Serve files from a workflow's data directory directly from Tornado.
+
+    Supports `Range` and conditional requests, so downloads of large files
+    (PDFs, DNGs) can be resumed. The file is read and flushed in chunks, so
+    other clients are not stalled while it is being sent.
+    """
+    def initialize(self, base_path, subdirectory=None):
+        """ Set up handler.
+
+        :param base_path:       Directory the workflows are located in
+        :type base_path:        unicode
+        :param subdirectory:    Directory below the workflow's data directory
+                                to serve files from
+        :type subdirectory:     unicode
+        """
+        super(WorkflowFileHandler, self).initialize(path=base_path)
+        self.base_path = base_path
+        self.subdirectory = subdirectory
+
+    def head(self, workflow_id, path):
+        return self.get(workflow_id, path, include_body=False)
+
+    def get(self, workflow_id, path, include_body=True):
+        try:
+            uuid.UUID(workflow_id)
+            workflow = Workflow.find_by_id(self.base_path, workflow_id)
+        except ValueError:
+            workflow = Workflow.find_by_slug(self.base_path, workflow_id)
+        if workflow is None:
+            raise HTTPError(404)
+        root = workflow.path/'data'
+        if self.subdirectory:
+            root = root/self.subdirectory
+        self.root = unicode(root)
+        return super(WorkflowFileHandler, self).get(path, include_body)
+
+    def compute_etag(self):
+        # The default implementation hashes the whole file (and caches the
+        # result forever), which is both slow for large files and wrong for
+        # files that change, so we use modification time and size instead.
+        stat = os.stat(self.absolute_path)
+        return '"{0:x}-{1:x}"'.format(int(stat.st_mtime), stat.st_size)
+
+
 class QueueIO(object):
     """ File-like object that writes to a queue.
 
@@ -254,9 +758,7 @@ class QueueIO(object):
         return self.queue.get()
 
 
-class TarDownloadHandler(RequestHandler):
-    def initialize(self, base_path):
-        self.base_path = base_path
+class TarDownloadHandler(ThrottledDownloadHandler):
 
     def create_tar(self, workflow, cb, exception_cb):
         """ Intended to be run in a separate thread, since the call will block
@@ -309,10 +811,11 @@ class TarDownloadHandler(RequestHandler):
 
     def send_next_chunk(self):
         try:
-            self.write(next(self.fp))
-            self.flush(callback=self.send_next_chunk)
+            chunk = next(self.fp)
         except StopIteration:
             self.finish()
+        else:
+            self.send_chunk(chunk, self.send_next_chunk)
 
     def on_done(self):
         self.fp.close()
@@ -18,17 +18,26 @@
 from __future__ import division
 
 import copy
+import json
 import logging
+import os
 import shutil
+import threading
+import time
+import urllib
+import zipfile
+import zlib
 
 import blinker
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import spreads.util as util
-from spreads.workflow import Workflow
-from app import task_queue
-from util import GeneratorIO, calculate_zipsize
+import spreads.vendor.bagit as bagit
+from spreads.workflow import Workflow, on_capture_succeeded
+from app import app, task_queue
+from util import ThrottledReader, get_compress_type
 
 IS_WIN = util.is_os('windows')
 if IS_WIN:
@@ -37,6 +46,20 @@ else:
     from util import find_stick
 
 logger = logging.getLogger('spreadsplug.web.tasks')
+
+#: Size of the chunks workflow files are uploaded in
+UPLOAD_CHUNK_SIZE = 4*1024**2
+#: Timeout for every request during an upload in seconds
+UPLOAD_TIMEOUT = 60
+#: How often an upload is resumed without making any progress
+UPLOAD_MAX_RETRIES = 5
+#: Delay before resuming an upload in seconds, doubles with every attempt
+UPLOAD_RETRY_DELAY = 2
+#: How often a file is sent again when it did not match its digest
+UPLOAD_MAX_RESENDS = 2
+#: Size of the blocks files are copied in when transfers are throttled
+TRANSFER_CHUNK_SIZE = 256*1024
+
 signals = blinker.Namespace()
 on_transfer_started = signals.signal('transfer:started')
 on_transfer_progressed = signals.signal('transfer:progressed')
@@ -47,9 +70,30 @@ on_submit_completed = signals.signal('submit:completed')
 on_submit_error = signals.signal('submit:error')
 
 
+def _copy_throttled(src, dst, rate_limiter):
+    """ Copy a file in blocks whose sizes are taken from a rate limiter.
+
+    :param src:             Source file
+    :type src:              :py:class:`pathlib.Path`
+    :param dst:             Destination file
+    :type dst:              :py:class:`pathlib.Path`
+    :param rate_limiter:    Limiter for the transfer
+    :type rate_limiter:     :py:class:`spreadsplug.web.util.RateLimiter`
+    """
+    with src.open('rb') as in_fp, dst.open('wb') as out_fp:
+        while True:
+            block = in_fp.read(TRANSFER_CHUNK_SIZE)
+            if not block:
+                break
+            rate_limiter.consume(len(block))
+            out_fp.write(block)
+    shutil.copystat(unicode(src), unicode(dst))
+
+
 @task_queue.task()
 def transfer_to_stick(wf_id, base_path):
     workflow = Workflow.find_by_id(base_path, wf_id)
+    rate_limiter = app.config['rate_limiters'].get('transfer')
     stick = find_stick()
     files = list(workflow.path.rglob('*'))
     num_files = len(files)
@@ -77,8 +121,10 @@ def transfer_to_stick(wf_id, base_path):
             target = target_path/path.relative_to(workflow.path)
             if path.is_dir():
                 target.mkdir()
+            elif rate_limiter is not None and rate_limiter.active:
+                _copy_throttled(path, target, rate_limiter)
             else:
-                shutil.copyfile(unicode(path), unicode(target))
+                util.place_file(path, target)
     finally:
         if 'mount_point' in locals():
             signals['transfer:progressed'].send(workflow, progress=0.8,
@@ -94,15 +140,227 @@ def transfer_to_stick(wf_id, base_path):
         workflow.status['step'] = None
 
 
+def get_bag_files(bag, algorithm='md5'):
+    """ Get the sizes and digests of all files in a bag.
+
+    Digests are taken from the bag's manifests, only files that are not
+    listed in any of them (e.g. the tag manifests themselves) are hashed.
+
+    :param bag:         Bag to list files for
+    :type bag:          :py:class:`spreads.vendor.bagit.Bag`
+    :param algorithm:   Digest algorithm
+    :type algorithm:    unicode
+    :returns:           Mapping from bag-relative paths to dicts with the
+                        `size` and `digest` of the file
+    :rtype:             dict
+    """
+    digests = {}
+    for manifests in (bag.manifest_files, bag.tagmanifest_files):
+        if algorithm in manifests:
+            digests.update((path.replace(os.sep, '/'), digest)
+                           for path, digest in manifests[algorithm].items())
+    files = {}
+    for fpath in bagit.iterdir(bag.path):
+        relpath = os.path.relpath(fpath, bag.path).replace(os.sep, '/')
+        digest = digests.get(relpath)
+        if digest is None:
+            digest = bagit.hash_file(fpath, [algorithm])[1][algorithm]
+        files[relpath] = {'size': os.path.getsize(fpath), 'digest': digest}
+    return files
+
+
+def _get_file_info(fpath, algorithm='md5'):
+    return {'size': fpath.stat().st_size,
+            'digest': bagit.hash_file(unicode(fpath),
+                                      [algorithm])[1][algorithm]}
+
+
+def _is_digest_mismatch(resp):
+    """ Check if the server rejected a file because it did not match its
+        digest, in which case it has to be sent again from the start (see
+        :py:func:`spreadsplug.web.endpoints.upload_file_chunk`).
+    """
+    if resp.status_code != 400:
+        return False
+    try:
+        payload = resp.json().get('payload')
+    except ValueError:
+        return False
+    return isinstance(payload, dict) and payload.get('offset') == 0
+
+
+class _FileChanged(Exception):
+    """ A file changed after it was announced and has to be announced
+        again.
+    """
+
+
+def _is_retriable(exc):
+    if isinstance(exc, requests.HTTPError):
+        return exc.response.status_code >= 500
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+
+
+def upload_bag(workflow, server, files, progress_callback=None,
+               finish=True, max_retries=None, rate_limiter=None):
+    """ Upload files from a workflow bag to a postprocessing server.
+
+    Uses the resumable upload protocol of
+    :py:func:`spreadsplug.web.endpoints.create_upload_session`: The files
+    are announced to the server, which replies with the number of bytes it
+    already has for every file and the files it still needs (if the workflow
+    was uploaded before, only new and changed files). These are then sent in
+    chunks of :py:data:`UPLOAD_CHUNK_SIZE` bytes that are acknowledged one
+    by one. Chunks of files that compress well (see
+    :py:func:`spreadsplug.web.util.get_compress_type`) are deflated.
+    When the connection fails, the session is resumed after a delay that
+    doubles with every attempt that made no progress, until the maximum
+    number of retries is exceeded.
+    Files that do not match their digest on the server are sent again from
+    the start (up to :py:data:`UPLOAD_MAX_RESENDS` times), files that
+    changed since they were announced are announced again first.
+
+    :param workflow:            Workflow to upload
+    :type workflow:             :py:class:`spreads.workflow.Workflow`
+    :param server:              Base URL of the server
+    :type server:               unicode
+    :param files:               Files to upload, see :py:func:`get_bag_files`
+    :type files:                dict
+    :param progress_callback:   Called with the fraction of acknowledged
+                                bytes after every chunk
+    :param finish:              Whether to complete the upload, otherwise
+                                `files` are only part of the bag, they are
+                                added to the session, which is left open
+                                and can be resumed (with more files) later
+    :type finish:               bool
+    :param max_retries:         How often to resume the upload without
+                                making progress, defaults to
+                                :py:data:`UPLOAD_MAX_RETRIES`
+    :type max_retries:          int
+    :param rate_limiter:        Limiter for the upload's throughput
+    :type rate_limiter:         :py:class:`spreadsplug.web.util.RateLimiter`
+    :returns:                   The remote workflow, None if `finish` was
+                                not set
+    :rtype:                     dict
+    :raises requests.RequestException:  When the upload failed
+    :raises IOError:            When the server acknowledged a chunk without
+                                making progress, e.g. because a file is
+                                shorter than announced, or a file did not
+                                match its digest too often
+    """
+    if max_retries is None:
+        max_retries = UPLOAD_MAX_RETRIES
+    retries = 0
+    resends = dict.fromkeys(files, 0)
+    while True:
+        session_data = json.dumps({'name': workflow.path.name,
+                                   'workflow_id': workflow.id,
+                                   'algorithm': 'md5',
+                                   'files': files,
+                                   'partial': not finish})
+        total_size = sum(info['size'] for info in files.itervalues()) or 1
+        try:
+            resp = requests.post(server + '/api/upload', data=session_data,
+                                 timeout=UPLOAD_TIMEOUT)
+            resp.raise_for_status()
+            status = resp.json()
+            session_url = '{0}/api/upload/{1}'.format(server, status['id'])
+            # Earlier partial announcements may include files that no
+            # longer exist locally
+            pending = [p for p in status['pending'] if p in files]
+            logger.debug("Sending {0} of {1} files"
+                         .format(len(pending), len(files)))
+            transferred = total_size - sum(
+                files[path]['size'] - status['files'][path]
+                for path in pending)
+            for path in pending:
+                offset = status['files'][path]
+                url = '{0}/{1}'.format(session_url,
+                                       urllib.quote(path.encode('utf8')))
+                # Text files and TIFFs are compressed on the wire, the
+                # offsets still refer to the uncompressed file
+                deflate = get_compress_type(path) == zipfile.ZIP_DEFLATED
+                headers = {'Content-Encoding': 'deflate'} if deflate else {}
+                with (workflow.path/path).open('rb') as fp:
+                    while True:
+                        fp.seek(offset)
+                        data = fp.read(UPLOAD_CHUNK_SIZE)
+                        if deflate:
+                            data = zlib.compress(data)
+                        if rate_limiter is not None and rate_limiter.active:
+                            data = ThrottledReader(data, rate_limiter)
+                        resp = requests.put(
+                            url, params={'offset': offset}, data=data,
+                            headers=headers, timeout=UPLOAD_TIMEOUT)
+                        if resp.status_code == 409:
+                            # The server has a different idea of where we are
+                            new_offset = resp.json()['payload']['offset']
+                        elif _is_digest_mismatch(resp):
+                            if resends[path] >= UPLOAD_MAX_RESENDS:
+                                raise IOError(
+                                    "Upload of {0} did not match its digest"
+                                    .format(path))
+                            resends[path] += 1
+                            info = _get_file_info(workflow.path/path)
+                            if info != files[path]:
+                                files[path] = info
+                                raise _FileChanged(path)
+                            logger.warning("Upload of {0} did not match its "
+                                           "digest, sending it again"
+                                           .format(path))
+                            transferred -= offset
+                            offset = 0
+                            continue
+                        else:
+                            resp.raise_for_status()
+                            new_offset = resp.json()['offset']
+                        progressed = new_offset != offset
+                        transferred += new_offset - offset
+                        offset = new_offset
+                        retries = 0
+                        if progress_callback:
+                            progress_callback(transferred/total_size)
+                        if resp and offset >= files[path]['size']:
+                            break
+                        if not progressed:
+                            # E.g. the file got shorter since it was
+                            # announced, trying again would not help
+                            raise IOError(
+                                "Upload of {0} made no progress at offset "
+                                "{1}".format(path, offset))
+            if not finish:
+                return
+            resp = requests.post(session_url + '/finish',
+                                 timeout=UPLOAD_TIMEOUT)
+            resp.raise_for_status()
+            return resp.json()
+        except _FileChanged as e:
+            logger.warning("{0} changed during the upload, announcing it "
+                           "again".format(e))
+        except requests.RequestException as e:
+            if not _is_retriable(e) or retries >= max_retries:
+                raise
+            delay = UPLOAD_RETRY_DELAY*(2**retries)
+            retries += 1
+            logger.warning("Upload interrupted ({0}), resuming in {1}s"
+                           .format(e, delay))
+            time.sleep(delay)
+
+
 @task_queue.task()
-def upload_workflow(wf_id, base_path, endpoint, user_config,
+def upload_workflow(wf_id, base_path, server, user_config,
                     start_process=False, start_output=False):
     logger.debug("Uploading workflow to postprocessing server")
 
     workflow = Workflow.find_by_id(base_path, wf_id)
+    # Captures that are still being submitted in the background must not
+    # interfere with the announcement of the complete bag
+    live_submitter = app.config.get('live_submitter')
+    if live_submitter is not None:
+        live_submitter.stop(workflow)
     # NOTE: This is kind of nasty.... We temporarily write the user-supplied
-    # configuration to the bag, update the tag-payload, create the zip, and
-    # once everything is done, we restore the old version
+    # configuration to the bag, update the tag-payload, upload the files,
+    # and once everything is done, we restore the old version
     tmp_cfg = copy.deepcopy(workflow.config)
     tmp_cfg.set(user_config)
     tmp_cfg_path = workflow.path/'config.yml'
@@ -110,52 +368,139 @@ def upload_workflow(wf_id, base_path, endpoint, user_config,
                  sections=(user_config['plugins'] + ["plugins", "device"]))
     workflow.bag.add_tagfiles(unicode(tmp_cfg_path))
 
-    # Create a zipstream from the workflow-bag
-    zstream = workflow.bag.package_as_zipstream(compression=None)
-    zsize = calculate_zipsize(zstream.paths_to_write)
+    progress = ["0.00"]
 
-    def zstream_wrapper():
-        """ Wrapper around our zstream so we can emit a signal when all data
-        has been streamed to the client.
-        """
-        transferred = 0
-        progress = "0.00"
-        for data in zstream:
-            yield data
-            transferred += len(data)
-            # Only update progress if we've progress at least by 0.01
-            new_progress = "{0:.2f}".format(transferred/zsize)
-            if new_progress != progress:
-                progress = new_progress
-                signals['submit:progressed'].send(
-                    workflow, progress=float(progress),
-                    status="Uploading workflow...")
-
-    # NOTE: This is neccessary since requests makes a chunked upload when
-    #       passed a plain generator, which is not supported by the WSGI
-    #       protocol that receives it. Hence we wrap it inside of a
-    #       GeneratorIO to make it appear as a file-like object with a
-    #       known size.
-    zstream_fp = GeneratorIO(zstream_wrapper(), zsize)
-    logger.debug("Projected size for upload: {}".format(zsize))
-    signals['submit:started'].send(workflow)
-    resp = requests.post(endpoint, data=zstream_fp,
-                         headers={'Content-Type': 'application/zip'})
-    if not resp:
-        error_msg = "Upload failed: {0}".format(resp.content)
-        signals['submit:error'].send(workflow, message=error_msg,
-                                     data=resp.content)
+    def update_progress(fraction):
+        # Only update progress if we've progress at least by 0.01
+        new_progress = "{0:.2f}".format(fraction)
+        if new_progress != progress[0]:
+            progress[0] = new_progress
+            signals['submit:progressed'].send(
+                workflow, progress=float(new_progress),
+                status="Uploading workflow...")
+
+    try:
+        files = get_bag_files(workflow.bag)
+        signals['submit:started'].send(workflow)
+        remote_workflow = upload_bag(
+            workflow, server, files, update_progress,
+            rate_limiter=app.config['rate_limiters'].get('upload'))
+    except requests.RequestException as e:
+        error_msg = "Upload failed: {0}".format(e)
+        data = e.response.content if e.response is not None else None
+        signals['submit:error'].send(workflow, message=error_msg, data=data)
+        logger.error(error_msg)
+    except IOError as e:
+        error_msg = "Upload failed: {0}".format(e)
+        signals['submit:error'].send(workflow, message=error_msg, data=None)
         logger.error(error_msg)
     else:
-        wfid = resp.json()['id']
+        wfid = remote_workflow['id']
         if start_process:
-            requests.post(endpoint + "/{0}/process".format(wfid))
+            requests.post("{0}/api/workflow/{1}/process".format(server, wfid))
         if start_output:
-            requests.post(endpoint + "/{0}/output".format(wfid))
+            requests.post("{0}/api/workflow/{1}/output".format(server, wfid))
         signals['submit:completed'].send(workflow, remote_id=wfid)
+    finally:
+        # Restore our old configuration
+        workflow._save_config()
+        if live_submitter is not None:
+            live_submitter.resume(workflow)
+
+
+class LiveSubmitter(object):
+    """ Submits new captures to a postprocessing server in the background
+    while the capture is still running.
+
+    Every capture is added to an open upload session on the server (see
+    :py:func:`upload_bag`), which is resumed by the regular submission of
+    the workflow once capturing is done. Since most of the images are on
+    the server by then, only the remaining files have to be transferred and
+    processing can start right away.
+
+    Submissions run on a single background thread, captures that come in
+    while a submission is running are sent with the next one. Failed
+    submissions are not retried on their own, their files are sent along
+    with the next capture. Captures are only ever added to the session, the
+    regular submission has to :py:meth:`stop` the live submissions of the
+    workflow before it announces the complete bag.
+
+    :param server:          Base URL of the postprocessing server
+    :type server:           unicode
+    :param rate_limiter:    Limiter for the uploads' throughput
+    :type rate_limiter:     :py:class:`spreadsplug.web.util.RateLimiter`
+    """
+    def __init__(self, server, rate_limiter=None):
+        self.server = server
+        self.rate_limiter = rate_limiter
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        # Workflow ID -> files that were announced to the server
+        self._files = {}
+        # Workflow ID -> captured images that were not submitted yet
+        self._scheduled = {}
+        # IDs of workflows whose captures are not submitted
+        self._stopped = set()
+
+    def connect_signals(self):
+        """ Submit every successful capture. """
+        on_capture_succeeded.connect(self.on_capture_succeeded, weak=False)
+
+    def stop(self, workflow):
+        """ Stop submitting the captures of a workflow and wait for the
+            submissions that are already scheduled.
+
+        :param workflow:    Workflow to stop submitting
+        :type workflow:     :py:class:`spreads.workflow.Workflow`
+        """
+        with self._lock:
+            self._stopped.add(workflow.id)
+        # Submissions run one after another, so once this is done, all
+        # previously scheduled submissions are finished
+        self._executor.submit(lambda: None).result()
+
+    def resume(self, workflow):
+        """ Submit the captures of a stopped workflow again.
+
+        :param workflow:    Workflow to resume submitting
+        :type workflow:     :py:class:`spreads.workflow.Workflow`
+        """
+        with self._lock:
+            self._stopped.discard(workflow.id)
+            self._files.pop(workflow.id, None)
+
+    def on_capture_succeeded(self, workflow, pages, **kwargs):
+        with self._lock:
+            if workflow.id in self._stopped:
+                return
+            is_scheduled = workflow.id in self._scheduled
+            self._scheduled.setdefault(workflow.id, []).extend(
+                page.raw_image for page in pages)
+            if not is_scheduled:
+                self._executor.submit(self._submit, workflow)
 
-    # Restore our old configuration
-    workflow._save_config()
+    def _submit(self, workflow):
+        with self._lock:
+            new_images = self._scheduled.pop(workflow.id)
+        files = self._files.setdefault(workflow.id, {})
+        # Drop files that were removed in the meantime, e.g. by a retake
+        for path in [p for p in files if not (workflow.path/p).exists()]:
+            del files[path]
+        for fpath in new_images:
+            if not fpath.exists():
+                continue
+            files[fpath.relative_to(workflow.path).as_posix()] = (
+                _get_file_info(fpath))
+        try:
+            upload_bag(workflow, self.server, files, finish=False,
+                       max_retries=0, rate_limiter=self.rate_limiter)
+            logger.debug("Submitted {0} new captures of workflow {1}"
+                         .format(len(new_images), workflow.slug))
+        except requests.RequestException as e:
+            logger.warning("Could not submit captures, will try again with "
+                           "the next capture: {0}".format(e))
+        except Exception:
+            logger.error("Error during live submission", exc_info=True)
 
 
 @task_queue.task()
@@ -17,23 +17,45 @@
 
 from __future__ import division
 
+import bisect
+import hashlib
+import heapq
+import itertools
+import json
 import logging
+import math
 import mimetypes
+import multiprocessing
 import os
+import re
+import shutil
+import struct
+import threading
 import time
 import traceback
 import uuid
+import zipfile
+import zlib
+from collections import OrderedDict, defaultdict, deque
 from datetime import datetime
 from io import BufferedIOBase, UnsupportedOperation
 
+import tornado
+from concurrent.futures import Future, ThreadPoolExecutor
 from flask import abort
 from flask.json import JSONEncoder
 from pathlib import Path
+from tornado import escape, httputil
+from tornado.ioloop import IOLoop
+from tornado.wsgi import WSGIContainer
+from wand.color import Color
 from wand.image import Image
 from werkzeug.routing import BaseConverter
 
-from spreads.workflow import Workflow, signals as workflow_signals
-from spreads.util import EventHandler
+import spreads.vendor.bagit as bagit
+from spreads.workflow import (Workflow, apply_transforms, transform_image,
+                              signals as workflow_signals)
+from spreads.util import EventHandler, place_file
 
 try:
     from jpegtran import JPEGImage
@@ -64,6 +86,44 @@ class Event(object):
         self.id = id
 
 
+#: Functions to obtain the serializable value of a workflow's field
+WORKFLOW_FIELDS = {
+    'id': lambda wf: wf.id,
+    'slug': lambda wf: wf.slug,
+    'metadata': lambda wf: dict(wf.metadata),
+    'status': lambda wf: wf.status,
+    'last_modified': lambda wf: wf.last_modified,
+    'pages': lambda wf: wf.pages,
+    'pages_version': lambda wf: wf.pages_version,
+    'page_count': lambda wf: len(wf.pages),
+    'out_files': lambda wf: [{'name': path.name, 'mimetype': path}
+                             for path in wf.out_files],
+    'config': lambda wf: {
+        k: v for k, v in wf.config.flatten().iteritems()
+        if k in wf.config['plugins'].get() or k in ('device', 'plugins')},
+}
+
+#: Fields that are included when serializing a workflow by default
+DEFAULT_WORKFLOW_FIELDS = ('id', 'slug', 'metadata', 'status',
+                           'last_modified', 'pages', 'pages_version',
+                           'out_files', 'config')
+
+
+def workflow_to_dict(workflow, fields=None):
+    """ Serialize a workflow to a dictionary.
+
+    :param workflow:    Workflow to serialize
+    :type workflow:     :py:class:`spreads.workflow.Workflow`
+    :param fields:      Fields to include, must be keys of
+                        :py:data:`WORKFLOW_FIELDS`. By default, all fields in
+                        :py:data:`DEFAULT_WORKFLOW_FIELDS` are included.
+    :type fields:       list of str
+    :rtype:             dict
+    """
+    return {field: WORKFLOW_FIELDS[field](workflow)
+            for field in (fields or DEFAULT_WORKFLOW_FIELDS)}
+
+
 class CustomJSONEncoder(JSONEncoder):
     def default(self, obj):
         if hasattr(obj, 'to_dict'):
@@ -83,20 +143,7 @@ class CustomJSONEncoder(JSONEncoder):
             return JSONEncoder.default(self, obj)
 
     def _workflow_to_dict(self, workflow):
-        return {
-            'id': workflow.id,
-            'slug': workflow.slug,
-            'metadata': dict(workflow.metadata),
-            'status': workflow.status,
-            'last_modified': workflow.last_modified,
-            'pages': workflow.pages,
-            'out_files': [{'name': path.name,
-                           'mimetype': path}
-                          for path in workflow.out_files],
-            'config': {k: v for k, v in workflow.config.flatten().iteritems()
-                       if k in workflow.config['plugins'].get() or
-                       k in ('device', 'plugins')}
-        }
+        return workflow_to_dict(workflow)
 
     def _logrecord_to_dict(self, record):
         return {
@@ -115,10 +162,361 @@ class CustomJSONEncoder(JSONEncoder):
             if 'senderId' not in data:
                 data['senderId'] = event.sender.id
         elif event.signal is EventHandler.on_log_emit:
-            data = data['record']
+            data = dict(self._logrecord_to_dict(data['record']),
+                        suppressed=data.get('suppressed', 0))
         return {'name': name, 'data': data, 'id': event.id}
 
 
+class WorkflowJSONCache(object):
+    """ Cache for the JSON-encoded fragments of serialized workflows.
+
+    Encoding a workflow's pages, configuration and output files is costly
+    and has to be done for every API request that includes the workflow.
+    This cache keeps the encoded fragments for every workflow around and
+    only throws them away when the workflow signals a change to the
+    respective field via :py:data:`spreads.workflow.on_modified` (or
+    :py:data:`spreads.workflow.on_pages_changed` for the pages).
+    Cheap and volatile fields (like the status) are always encoded anew.
+    """
+    #: Fields whose encoded values are cached. The pages version is cached
+    #: along with the pages, so the two always match.
+    CACHED_FIELDS = ('metadata', 'pages', 'pages_version', 'config',
+                     'out_files')
+
+    def __init__(self):
+        self._fragments = {}
+        # Incremented on every invalidation, so that fragments that were
+        # encoded while a change happened are not stored.
+        self._generations = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def connect_signals(self):
+        """ Invalidate cached fragments when workflows are modified or
+            removed.
+        """
+        workflow_signals['workflow:modified'].connect(self._on_modified)
+        workflow_signals['workflow:pages-changed'].connect(
+            self._on_pages_changed)
+        workflow_signals['workflow:removed'].connect(self._on_removed)
+
+    def _on_modified(self, sender, **kwargs):
+        fields = [f for f in kwargs.get('changes', {})
+                  if f in self.CACHED_FIELDS]
+        if fields:
+            self.invalidate(sender.id, fields)
+
+    def _on_pages_changed(self, sender, **kwargs):
+        self.invalidate(sender.id, ['pages', 'pages_version'])
+
+    def _on_removed(self, sender, **kwargs):
+        self.invalidate(kwargs['senderId'])
+
+    def invalidate(self, workflow_id, fields=None):
+        """ Remove cached fragments for a workflow.
+
+        :param workflow_id: ID of the workflow
+        :type workflow_id:  unicode
+        :param fields:      Fields to invalidate, by default all fields
+        :type fields:       list of str
+        """
+        with self._lock:
+            for field in (fields or self.CACHED_FIELDS):
+                key = (workflow_id, field)
+                self._fragments.pop(key, None)
+                self._generations[key] += 1
+
+    def get_fragment(self, workflow, field):
+        """ Get the JSON-encoded value of a workflow's field.
+
+        :param workflow:    Workflow to get the value from
+        :type workflow:     :py:class:`spreads.workflow.Workflow`
+        :param field:       Name of the field, must be a key of
+                            :py:data:`WORKFLOW_FIELDS`
+        :type field:        str
+        :returns:           The JSON-encoded value
+        :rtype:             str
+        """
+        if field not in self.CACHED_FIELDS:
+            return json.dumps(WORKFLOW_FIELDS[field](workflow),
+                              cls=CustomJSONEncoder)
+        key = (workflow.id, field)
+        with self._lock:
+            fragment = self._fragments.get(key)
+            generation = self._generations[key]
+        if fragment is None:
+            fragment = json.dumps(WORKFLOW_FIELDS[field](workflow),
+                                  cls=CustomJSONEncoder)
+            with self._lock:
+                if self._generations[key] == generation:
+                    self._fragments[key] = fragment
+        return fragment
+
+    def to_json(self, workflow, fields=None):
+        """ Serialize a workflow to JSON from its (cached) fragments.
+
+        :param workflow:    Workflow to serialize
+        :type workflow:     :py:class:`spreads.workflow.Workflow`
+        :param fields:      Fields to include, see :py:func:`workflow_to_dict`
+        :type fields:       list of str
+        :returns:           The JSON-encoded workflow
+        :rtype:             str
+        """
+        return "{{{0}}}".format(", ".join(
+            "\"{0}\": {1}".format(field, self.get_fragment(workflow, field))
+            for field in (fields or DEFAULT_WORKFLOW_FIELDS)))
+
+
+class WorkflowIndex(object):
+    """ Workflows of a directory, sorted by their modification time.
+
+    Listing the workflows would otherwise have to look at the modification
+    time of every workflow and sort all of them for every page that is
+    requested. The index keeps them sorted and only updates the position of
+    a workflow when it signals a change via
+    :py:data:`spreads.workflow.on_created`,
+    :py:data:`spreads.workflow.on_modified` or
+    :py:data:`spreads.workflow.on_pages_changed`, so a page can be looked up
+    with a binary search. The workflows are loaded from the disk when the
+    index is first used.
+    """
+    def __init__(self, location):
+        """ Set up the index.
+
+        :param location:    Directory the workflows are located in
+        :type location:     unicode or :py:class:`pathlib.Path`
+        """
+        self.location = Path(location)
+        self._loaded = False
+        #: Sorted keys of all workflows
+        self._keys = []
+        #: Sort key -> workflow
+        self._workflows = {}
+        #: Workflow ID -> sort key
+        self._workflow_keys = {}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def get_sort_key(workflow):
+        """ Sort workflows by their modification time (in microseconds, most
+        recent first) and their ID.
+
+        :param workflow:    Workflow to get the key for
+        :type workflow:     :py:class:`spreads.workflow.Workflow`
+        :rtype:             tuple
+        """
+        modified = workflow.last_modified
+        timestamp = (int(time.mktime(modified.timetuple()))*10**6
+                     + modified.microsecond)
+        return (-timestamp, workflow.id)
+
+    def connect_signals(self):
+        """ Update the index when workflows are created, modified or
+            removed.
+        """
+        for name in ('workflow:created', 'workflow:modified',
+                     'workflow:pages-changed'):
+            workflow_signals[name].connect(self._on_changed)
+        workflow_signals['workflow:removed'].connect(self._on_removed)
+
+    def _on_changed(self, sender, **kwargs):
+        if sender.path.parent != self.location:
+            return
+        with self._lock:
+            if not self._loaded:
+                return
+            self.update(sender)
+
+    def _on_removed(self, sender, **kwargs):
+        with self._lock:
+            self._discard(kwargs['senderId'])
+
+    def _load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            for workflow in Workflow.find_all(self.location).values():
+                self.update(workflow)
+            self._loaded = True
+
+    def _discard(self, workflow_id):
+        key = self._workflow_keys.pop(workflow_id, None)
+        if key is None:
+            return
+        del self._keys[bisect.bisect_left(self._keys, key)]
+        del self._workflows[key]
+
+    def update(self, workflow):
+        """ Insert a workflow or move it to its current position.
+
+        :param workflow:    Workflow to update
+        :type workflow:     :py:class:`spreads.workflow.Workflow`
+        """
+        with self._lock:
+            self._discard(workflow.id)
+            try:
+                key = self.get_sort_key(workflow)
+            except OSError:
+                # Workflow was deleted from the disk
+                return
+            bisect.insort(self._keys, key)
+            self._workflows[key] = workflow
+            self._workflow_keys[workflow.id] = key
+
+    def get_items(self, cursor_key=None, limit=None):
+        """ Get the workflows that come after a given sort key.
+
+        :param cursor_key:  Sort key to start after, from the beginning if
+                            omitted
+        :type cursor_key:   tuple
+        :param limit:       Maximum number of workflows
+        :type limit:        int
+        :returns:           Sort keys and workflows
+        :rtype:             list of (tuple,
+                            :py:class:`spreads.workflow.Workflow`) tuples
+        """
+        self._load()
+        with self._lock:
+            start = (0 if cursor_key is None
+                     else bisect.bisect_right(self._keys, cursor_key))
+            end = None if limit is None else start + limit
+            return [(key, self._workflows[key])
+                    for key in self._keys[start:end]]
+
+
+class RateLimiter(object):
+    """ Token bucket that limits the throughput of transfers.
+
+    Tokens (bytes) are added to the bucket at a constant rate, up to one
+    second's worth, so short bursts are possible after idle periods. Every
+    chunk takes its size in tokens from the bucket and has to wait until
+    the bucket is no longer in debt. Transfers that share a limiter share
+    its bandwidth.
+
+    Captures write to the same storage (and often the same USB bus) as the
+    transfers, so while a capture is in progress (from
+    :py:data:`spreads.workflow.on_capture_triggered` until the images are
+    written), the limiter switches to :py:attr:`capture_rate`.
+
+    :attr rate:             Maximum throughput in bytes per second, no limit
+                            if zero
+    :type rate:             int
+    :attr capture_rate:     Maximum throughput while capturing, transfers
+                            are paused if it is zero
+    :type capture_rate:     int
+    :attr clock:            Function that returns the current time in
+                            seconds
+    :type clock:            callable
+    """
+    #: Interval in seconds at which paused transfers check if they can go on
+    POLL_INTERVAL = 0.25
+    #: Time in seconds after which a capture that never reported back is no
+    #: longer considered to be in progress
+    CAPTURE_TIMEOUT = 60
+
+    def __init__(self, rate=0, capture_rate=0, clock=time.time):
+        self.rate = rate
+        self.capture_rate = capture_rate
+        self.clock = clock
+        self._tokens = 0
+        self._last_update = clock()
+        # Workflow ID -> start of the capture that is in progress
+        self._captures = {}
+        self._lock = threading.Lock()
+
+    def connect_signals(self):
+        """ Switch to the capture rate while workflows are capturing. """
+        workflow_signals['workflow:capture-triggered'].connect(
+            self._on_capture_triggered)
+        workflow_signals['workflow:capture-succeeded'].connect(
+            self._on_capture_done)
+        workflow_signals['workflow:capture-failed'].connect(
+            self._on_capture_done)
+
+    def _on_capture_triggered(self, sender, **kwargs):
+        with self._lock:
+            self._captures[sender.id] = self.clock()
+
+    def _on_capture_done(self, sender, **kwargs):
+        with self._lock:
+            self._captures.pop(sender.id, None)
+
+    @property
+    def capturing(self):
+        """ Whether a capture is in progress. """
+        min_start = self.clock() - self.CAPTURE_TIMEOUT
+        return any(start > min_start for start in self._captures.values())
+
+    @property
+    def active(self):
+        """ Whether transfers currently have to go through the limiter, i.e.
+            a limit is configured or a capture is in progress.
+        """
+        return bool(self.rate) or self.capturing
+
+    def reserve(self, num_bytes):
+        """ Take the tokens for a chunk from the bucket.
+
+        :param num_bytes:   Size of the chunk
+        :type num_bytes:    int
+        :returns:           Time in seconds to wait before the chunk can be
+                            sent or None if transfers are paused, in which
+                            case no tokens were taken
+        :rtype:             float
+        """
+        with self._lock:
+            capturing = self.capturing
+            rate = self.capture_rate if capturing else self.rate
+            now = self.clock()
+            if rate:
+                self._tokens = min(
+                    self._tokens + (now - self._last_update)*rate, rate)
+            self._last_update = now
+            if not rate:
+                return None if capturing else 0
+            self._tokens -= num_bytes
+            return max(0, -self._tokens/rate)
+
+    def consume(self, num_bytes):
+        """ Block until a chunk can be sent.
+
+        :param num_bytes:   Size of the chunk
+        :type num_bytes:    int
+        """
+        delay = self.reserve(num_bytes)
+        while delay is None:
+            time.sleep(self.POLL_INTERVAL)
+            delay = self.reserve(num_bytes)
+        if delay:
+            time.sleep(delay)
+
+
+class ThrottledReader(object):
+    """ File-like object for sending a string in blocks that are throttled
+        by a :py:class:`RateLimiter`.
+
+    :param data:            Data to send
+    :type data:             str
+    :param rate_limiter:    Limiter to take the blocks' sizes from
+    :type rate_limiter:     :py:class:`RateLimiter`
+    """
+    def __init__(self, data, rate_limiter):
+        self._data = data
+        self._offset = 0
+        self._rate_limiter = rate_limiter
+
+    def __len__(self):
+        return len(self._data)
+
+    def read(self, num_bytes=-1):
+        if num_bytes is None or num_bytes < 0:
+            num_bytes = len(self._data) - self._offset
+        block = self._data[self._offset:self._offset+num_bytes]
+        self._offset += len(block)
+        if block:
+            self._rate_limiter.consume(len(block))
+        return block
+
+
 class WorkflowConverter(BaseConverter):
     def to_python(self, value):
         from spreadsplug.web.app import app
@@ -135,6 +533,207 @@ class WorkflowConverter(BaseConverter):
         return value.slug
 
 
+class ThreadPoolWSGIContainer(WSGIContainer):
+    """ WSGI container that runs the application in a pool of worker
+        threads.
+
+    Tornado's :py:class:`tornado.wsgi.WSGIContainer` runs WSGI requests
+    synchronously on the IOLoop, i.e. a single slow request blocks all other
+    requests and websocket messages. Here, only the response is written on
+    the IOLoop, the application itself runs in one of the workers.
+
+    :attr max_workers:  Number of worker threads
+    :type max_workers:  int
+    :attr max_queued:   Maximum number of requests waiting for a worker,
+                        further requests are rejected with a 503 error
+    :type max_queued:   int
+    """
+    def __init__(self, wsgi_application, max_workers=4, max_queued=64):
+        super(ThreadPoolWSGIContainer, self).__init__(wsgi_application)
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._num_queued = 0
+        self._num_active = 0
+        self._peak_queued = 0
+
+    @property
+    def stats(self):
+        """ Current load of the container.
+
+        :returns:   Number of requests waiting for a worker (`queued`) and
+                    being processed (`active`), the number of workers and the
+                    maximum number of queued requests seen so far
+        :rtype:     dict
+        """
+        with self._lock:
+            return {'queued': self._num_queued,
+                    'active': self._num_active,
+                    'workers': self.max_workers,
+                    'peak_queued': self._peak_queued}
+
+    def __call__(self, request):
+        with self._lock:
+            if self._num_queued >= self.max_queued:
+                overloaded = True
+            else:
+                overloaded = False
+                self._num_queued += 1
+                self._peak_queued = max(self._peak_queued, self._num_queued)
+        if overloaded:
+            logger.warn("Too many pending requests, rejecting {0}"
+                        .format(request.uri))
+            self._write_response(request, 503, 'Service Unavailable', [],
+                                 b'')
+            return
+        # The environment has to be built on the IOLoop, since it reads from
+        # the request
+        environ = WSGIContainer.environ(request)
+        io_loop = IOLoop.current()
+        # Status and headers set by the application and whether they were
+        # already written
+        response = {'headers_written': False}
+        future = self._executor.submit(self._run_application, request,
+                                       environ, response, io_loop)
+        io_loop.add_future(
+            future, lambda f: self._on_application_done(request, response,
+                                                        f))
+
+    def _run_application(self, request, environ, response, io_loop):
+        """ Run the WSGI application, called from a worker thread.
+
+        The body is passed to the IOLoop chunk by chunk as the application
+        produces it. Before the next chunk is read from the application, the
+        worker waits for the previous one to be flushed to the client, so
+        large responses are never held in memory as a whole.
+
+        Applications that know the length of their body (like Flask for
+        non-streamed responses) set a Content-Length, all other bodies are
+        sent with chunked transfer encoding.
+        """
+        with self._lock:
+            self._num_queued -= 1
+            self._num_active += 1
+        try:
+            def start_response(status, response_headers, exc_info=None):
+                response["status"] = status
+                response["headers"] = response_headers
+                return lambda chunk: self._run_on_loop(
+                    io_loop, self._write_chunk, request, response, chunk)
+            app_response = self.wsgi_application(environ, start_response)
+            try:
+                for chunk in app_response:
+                    if chunk:
+                        self._run_on_loop(io_loop, self._write_chunk,
+                                          request, response, chunk)
+            finally:
+                if hasattr(app_response, "close"):
+                    app_response.close()
+            if "status" not in response:
+                raise Exception("WSGI app did not call start_response")
+        finally:
+            with self._lock:
+                self._num_active -= 1
+
+    @staticmethod
+    def _run_on_loop(io_loop, func, *args):
+        """ Run a function that returns a future on the IOLoop and wait for
+            that future, called from a worker thread.
+        """
+        result = Future()
+
+        def copy_result(future):
+            if future.exception() is not None:
+                result.set_exception(future.exception())
+            else:
+                result.set_result(future.result())
+
+        def callback():
+            try:
+                io_loop.add_future(func(*args), copy_result)
+            except Exception as e:
+                result.set_exception(e)
+        io_loop.add_callback(callback)
+        return result.result()
+
+    def _write_chunk(self, request, response, chunk):
+        """ Write a chunk of a streamed response, called on the IOLoop.
+
+        :returns:   Future that is done once the chunk has been flushed
+        :rtype:     :py:class:`tornado.concurrent.Future`
+        """
+        if response['headers_written']:
+            return request.connection.write(escape.utf8(chunk))
+        response['headers_written'] = True
+        status_code, reason = response['status'].split(' ', 1)
+        return self._write_headers(request, int(status_code), reason,
+                                   list(response['headers']),
+                                   escape.utf8(chunk), finished=False)
+
+    def _on_application_done(self, request, response, future):
+        """ Write the end of the response, called on the IOLoop.
+        """
+        try:
+            future.result()
+        except Exception as e:
+            if response['headers_written']:
+                # Too late to tell the client, the most we can do is to make
+                # sure the truncated response is not mistaken for a complete
+                # one
+                logger.warn("Aborted response for {0}: {1}"
+                            .format(request.uri, e))
+                request.connection.close()
+                return
+            logger.error("Uncaught exception in WSGI application")
+            logger.exception(e)
+            self._write_response(request, 500, 'Internal Server Error', [],
+                                 b'')
+            return
+        status_code, reason = response['status'].split(' ', 1)
+        status_code = int(status_code)
+        if response['headers_written']:
+            request.connection.finish()
+            self._log(status_code, request)
+        else:
+            # Empty body
+            self._write_response(request, status_code, reason,
+                                 list(response['headers']), b'')
+
+    def _write_headers(self, request, status_code, reason, headers, chunk,
+                       finished):
+        """ Write the status line and headers along with the first chunk of
+            the body.
+
+        :param finished:    Whether `chunk` is the complete body, if not and
+                            the application did not set a Content-Length, the
+                            body is sent with chunked transfer encoding
+        :type finished:     bool
+        """
+        header_set = set(k.lower() for (k, v) in headers)
+        if status_code != 304:
+            if finished and "content-length" not in header_set:
+                headers.append(("Content-Length", str(len(chunk))))
+            if "content-type" not in header_set:
+                headers.append(("Content-Type", "text/html; charset=UTF-8"))
+        if "server" not in header_set:
+            headers.append(("Server", "TornadoServer/%s" % tornado.version))
+
+        start_line = httputil.ResponseStartLine("HTTP/1.1", status_code,
+                                                reason)
+        header_obj = httputil.HTTPHeaders()
+        for key, value in headers:
+            header_obj.add(key, value)
+        return request.connection.write_headers(start_line, header_obj,
+                                                chunk=chunk)
+
+    def _write_response(self, request, status_code, reason, headers, body):
+        self._write_headers(request, status_code, reason, headers,
+                            escape.utf8(body), finished=True)
+        request.connection.finish()
+        self._log(status_code, request)
+
+
 class GeneratorIO(BufferedIOBase):
     """ Wrapper around a generator to act as a file-like object.
     """
@@ -168,12 +767,344 @@ class GeneratorIO(BufferedIOBase):
             raise UnsupportedOperation
 
 
-def convert_image(img_path, img_format):
-    with Image(filename=unicode(img_path)) as img:
+class StoredLogRecord(object):
+    """ Log record as kept by :py:class:`LogStore`.
+
+    The message is rendered when the record is stored, the traceback (if
+    any) only when it is first requested (see :py:meth:`format_traceback`).
+    """
+    __slots__ = ['seq', 'created', 'message', 'origin', 'levelno', 'level',
+                 'size', '_exc_info', '_traceback']
+
+    def __init__(self, seq, record):
+        self.seq = seq
+        self.created = record.created
+        self.message = record.getMessage()
+        self.origin = record.name
+        self.levelno = record.levelno
+        self.level = record.levelname
+        self._exc_info = record.exc_info
+        self._traceback = None
+        #: Rough estimate of the memory used by the record, fixed at creation
+        #: so that it can be subtracted again on eviction
+        self.size = len(self.message) + (4096 if self._exc_info else 0)
+
+    def format_traceback(self):
+        """ Render the traceback, if it was not rendered before.
+
+        Must be called with the lock of the :py:class:`LogStore` held.
+        """
+        if self._exc_info:
+            self._traceback = "".join(
+                traceback.format_exception(*self._exc_info))
+            # Don't keep the frames around any longer than necessary
+            self._exc_info = None
+
+    @property
+    def traceback(self):
+        return self._traceback
+
+    def to_dict(self):
+        return {
+            'id': self.seq,
+            'time': datetime.fromtimestamp(self.created),
+            'message': self.message,
+            'origin': self.origin,
+            'level': self.level,
+            'traceback': self.traceback
+        }
+
+
+class LogStore(logging.Handler):
+    """ Logging handler that keeps the most recent log records in memory.
+
+    Records are kept in a ring buffer that is limited by both the number of
+    records and their estimated size. Additionally, the records of every
+    level are indexed, so that querying the most recent records above a
+    certain level does not require looking at all records.
+
+    :param max_records: Maximum number of records to keep
+    :type max_records:  int
+    :param max_bytes:   Maximum estimated size of all records
+    :type max_bytes:    int
+    """
+    def __init__(self, max_records=10000, max_bytes=4*1024**2):
+        super(LogStore, self).__init__()
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self._records = deque()
+        #: Records by their level number, oldest first
+        self._by_level = defaultdict(deque)
+        self._size = 0
+        self._seq = itertools.count(1)
+
+    def emit(self, record):
+        # NOTE: logging.Handler.handle already holds the handler's lock
+        stored = StoredLogRecord(next(self._seq), record)
+        self._records.append(stored)
+        self._by_level[stored.levelno].append(stored)
+        self._size += stored.size
+        while (len(self._records) > self.max_records or
+               (self._size > self.max_bytes and len(self._records) > 1)):
+            oldest = self._records.popleft()
+            self._by_level[oldest.levelno].popleft()
+            self._size -= oldest.size
+
+    def count(self, min_level=logging.NOTSET):
+        """ Get the number of stored records at or above a level.
+
+        :param min_level:   Minimum level number
+        :type min_level:    int
+        :rtype:             int
+        """
+        with self.lock:
+            return sum(len(records)
+                       for levelno, records in self._by_level.iteritems()
+                       if levelno >= min_level)
+
+    def get_records(self, min_level=logging.NOTSET, start=0, count=50):
+        """ Get the most recent records at or above a level.
+
+        :param min_level:   Minimum level number
+        :type min_level:    int
+        :param start:       Number of (matching) records to skip
+        :type start:        int
+        :param count:       Maximum number of records to return
+        :type count:        int
+        :returns:           The records, most recent first
+        :rtype:             list of :py:class:`StoredLogRecord`
+        """
+        with self.lock:
+            # Merge the per-level indexes from their most recent end
+            streams = [((-rec.seq, rec) for rec in reversed(records))
+                       for levelno, records in self._by_level.iteritems()
+                       if levelno >= min_level]
+            records = [rec for _, rec in itertools.islice(
+                heapq.merge(*streams), start, start+count)]
+            for rec in records:
+                rec.format_traceback()
+            return records
+
+
+class DiskCache(object):
+    """ Persistent cache for derived images (thumbnails, scaled and converted
+        versions) with a size budget and least-recently-used eviction.
+
+    Entries are stored as individual files in :py:attr:`path`, the access
+    order survives restarts since every hit updates the file's timestamps.
+
+    :attr path:         Directory the cached files are stored in
+    :type path:         :py:class:`pathlib.Path`
+    :attr max_size:     Maximum size of all cached files in bytes
+    :type max_size:     int
+    """
+    def __init__(self, path, max_size):
+        self.path = Path(path)
+        self.max_size = max_size
+        if not self.path.exists():
+            self.path.mkdir(parents=True)
+        self._lock = threading.Lock()
+        #: Mapping from keys to the size of their files, least recently
+        #: used first
+        self._entries = OrderedDict()
+        #: Mapping from keys that are currently being created to events that
+        #: are set once they are done
+        self._creating = {}
+        self._size = 0
+        existing = sorted((p for p in self.path.iterdir() if p.is_file()),
+                          key=lambda p: p.stat().st_mtime)
+        for fpath in existing:
+            if fpath.suffix == '.tmp':
+                fpath.unlink()
+                continue
+            self._entries[fpath.name] = fpath.stat().st_size
+            self._size += self._entries[fpath.name]
+        with self._lock:
+            self._evict()
+
+    @staticmethod
+    def make_key(img_path, variant, transforms=None):
+        """ Build a cache key for a derived version of an image.
+
+        The key changes whenever the source image is modified, so stale
+        entries never have to be invalidated explicitly, they simply age out.
+
+        :param img_path:    Path to the source image
+        :type img_path:     :py:class:`pathlib.Path`
+        :param variant:     Identifier for the derived version, e.g.
+                            ``thumb`` or ``width=800``
+        :type variant:      unicode
+        :param transforms:  Transforms applied to the source image
+        :type transforms:   list of dict
+        :rtype:             unicode
+        """
+        stat = img_path.stat()
+        ident = json.dumps([unicode(img_path), stat.st_mtime, stat.st_size,
+                            variant, transforms or []], sort_keys=True)
+        return unicode(hashlib.sha1(ident).hexdigest())
+
+    def get_path(self, key):
+        """ Get the path to a cached file and mark it as recently used.
+
+        :param key:     Cache key
+        :type key:      unicode
+        :returns:       Path to the cached file or None if not cached
+        :rtype:         :py:class:`pathlib.Path`
+        """
+        with self._lock:
+            if key not in self._entries:
+                return None
+            fpath = self.path/key
+            try:
+                os.utime(unicode(fpath), None)
+            except OSError:
+                # Removed from under us
+                self._size -= self._entries.pop(key)
+                return None
+            self._entries[key] = self._entries.pop(key)
+            return fpath
+
+    def get(self, key):
+        """ Get the cached data for a key.
+
+        :param key:     Cache key
+        :type key:      unicode
+        :returns:       The cached data or None if not cached
+        :rtype:         bytestring
+        """
+        fpath = self.get_path(key)
+        if fpath is None:
+            return None
+        try:
+            with fpath.open('rb') as fp:
+                return fp.read()
+        except IOError:
+            return None
+
+    def set(self, key, data):
+        """ Store data in the cache, evicting the least recently used entries
+            if the size budget is exceeded.
+
+        :param key:     Cache key
+        :type key:      unicode
+        :param data:    Data to cache
+        :type data:     bytestring
+        """
+        fpath = self.path/key
+        # Write to a temporary file first, so readers never see partial data
+        tmp_path = self.path/(key + '.' + uuid.uuid4().hex + '.tmp')
+        with tmp_path.open('wb') as fp:
+            fp.write(data)
+        os.rename(unicode(tmp_path), unicode(fpath))
+        with self._lock:
+            self._size -= self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._size += len(data)
+            self._evict()
+
+    def get_or_create(self, key, create_func):
+        """ Get the cached data for a key, create and store it if it is not
+            cached yet.
+
+        If another thread is already creating the data for the same key
+        (e.g. the background thumbnail generation and a request from the
+        client), this waits for it instead of creating the data a second
+        time.
+
+        :param key:             Cache key
+        :type key:              unicode
+        :param create_func:     Function without arguments that returns the
+                                data to cache
+        :type create_func:      callable
+        :rtype:                 bytestring
+        """
+        while True:
+            data = self.get(key)
+            if data is not None:
+                return data
+            with self._lock:
+                creating = self._creating.get(key)
+                if creating is None:
+                    creating = self._creating[key] = threading.Event()
+                    break
+            # If the other thread failed, we try ourselves
+            creating.wait()
+        try:
+            data = create_func()
+            self.set(key, data)
+        finally:
+            with self._lock:
+                del self._creating[key]
+            creating.set()
+        return data
+
+    def _evict(self):
+        """ Remove the least recently used entries until the cache fits into
+            its size budget. Must be called with the lock held.
+        """
+        while self._size > self.max_size and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                (self.path/key).unlink()
+            except OSError:
+                pass
+            logger.debug("Evicted {0} from image cache".format(key))
+
+
+def generate_thumbnails(image_cache, pages):
+    """ Generate thumbnails for the most recent images of the given pages and
+        store them in the image cache.
+
+    This is intended to be run in the background after images were captured
+    or processed, so that the thumbnail requests from the web client can be
+    served directly from the cache.
+
+    :param image_cache: Cache to store the generated images in
+    :type image_cache:  :py:class:`DiskCache`
+    :param pages:       Pages to generate thumbnails for
+    :type pages:        list of :py:class:`spreads.workflow.Page`
+    """
+    for page in pages:
+        sources = [(page.raw_image, page.transforms)]
+        processed = page.get_latest_processed(image_only=True)
+        if processed is not None:
+            sources.append((processed, None))
+        for fpath, transforms in sources:
+            if fpath.suffix.lower() not in ('.jpg', '.jpeg', '.tif', '.tiff',
+                                            '.png'):
+                continue
+            try:
+                image_cache.get_or_create(
+                    image_cache.make_key(fpath, 'thumb', transforms),
+                    lambda: get_thumbnail(fpath, transforms=transforms))
+            except Exception as e:
+                # The thumbnail can still be generated on demand
+                logger.warn("Could not generate thumbnail for {0}: {1}"
+                            .format(fpath, e))
+
+
+def _open_image(img_path, transforms=None):
+    """ Open an image with :py:mod:`wand`, applying the given transforms.
+
+    :param img_path:    Path to image
+    :type img_path:     pathlib.Path
+    :param transforms:  Transforms to apply before opening,
+                        see :py:func:`spreads.workflow.transform_image`
+    :type transforms:   list of dict
+    :rtype:             :py:class:`wand.image.Image`
+    """
+    if transforms:
+        return Image(blob=apply_transforms(img_path, transforms))
+    return Image(filename=unicode(img_path))
+
+
+def convert_image(img_path, img_format, transforms=None):
+    with _open_image(img_path, transforms) as img:
         return img.make_blob(format=img_format)
 
 
-def scale_image(img_path, width=None, height=None):
+def scale_image(img_path, width=None, height=None, transforms=None):
     def get_target_size(srcwidth, srcheight):
         aspect = srcwidth/srcheight
         target_width = width if width else int(aspect*height)
@@ -184,32 +1115,222 @@ def scale_image(img_path, width=None, height=None):
         raise ValueError("Please specify either width or height")
     if HAS_JPEGTRAN and img_path.suffix.lower() in ('.jpg', '.jpeg'):
         img = JPEGImage(unicode(img_path))
+        if transforms:
+            img = transform_image(img, transforms)
         width, height = get_target_size(img.width, img.height)
         return img.downscale(width, height).as_blob()
     else:
-        with Image(filename=unicode(img_path)) as img:
+        with _open_image(img_path, transforms) as img:
             width, height = get_target_size(img.width, img.height)
             img.sample(width, height)
             return img.make_blob(format='jpg')
 
 
-def get_thumbnail(img_path):
+def get_thumbnail(img_path, transforms=None):
     """ Return thumbnail for image.
 
-    :param img_path:  Path to image
-    :type img_path:   pathlib.Path
-    :return:          The thumbnail
-    :rtype:           bytestring
+    :param img_path:    Path to image
+    :type img_path:     pathlib.Path
+    :param transforms:  Transforms to apply to the thumbnail
+    :type transforms:   list of dict
+    :return:            The thumbnail
+    :rtype:             bytestring
     """
-    if HAS_JPEGTRAN and img_path.suffix.lower() in ('.jpg', '.jpeg'):
+    transforms = transforms or []
+    # The EXIF thumbnail can only be used if the transforms do not depend on
+    # the dimensions of the full image
+    is_cropped = any(t['type'] == 'crop' for t in transforms)
+    if (HAS_JPEGTRAN and not is_cropped and
+            img_path.suffix.lower() in ('.jpg', '.jpeg')):
         img = JPEGImage(unicode(img_path))
         thumb = img.exif_thumbnail
         if thumb:
             logger.debug("Using EXIF thumbnail for {0}".format(img_path))
+            if transforms:
+                thumb = transform_image(thumb, transforms)
             return thumb.as_blob()
 
     logger.debug("Generating thumbnail for {0}".format(img_path))
-    return scale_image(img_path, width=160)
+    return scale_image(img_path, width=160, transforms=transforms)
+
+
+#: Number of pages per thumbnail sprite sheet
+SHEET_SIZE = 50
+
+#: Number of thumbnails per row in a sprite sheet
+SHEET_COLUMNS = 10
+
+
+def build_sprite_sheet(thumbnails):
+    """ Combine thumbnails into a single sprite sheet.
+
+    The thumbnails are laid out in a grid of :py:data:`SHEET_COLUMNS`
+    columns, each cell is as large as the largest thumbnail.
+
+    :param thumbnails:  Thumbnails to combine
+    :type thumbnails:   list of bytestring
+    :return:            The sprite sheet as a JPEG and the position and size
+                        of every thumbnail on the sheet
+    :rtype:             tuple of bytestring and list of dict
+    """
+    if not thumbnails:
+        raise ValueError("Can not build a sprite sheet without thumbnails")
+    images = [Image(blob=thumb) for thumb in thumbnails]
+    try:
+        cell_width = max(img.width for img in images)
+        cell_height = max(img.height for img in images)
+        num_columns = min(SHEET_COLUMNS, len(images))
+        num_rows = int(math.ceil(len(images)/SHEET_COLUMNS))
+        offsets = []
+        with Image(width=cell_width*num_columns, height=cell_height*num_rows,
+                   background=Color('white')) as sheet:
+            for idx, img in enumerate(images):
+                left = (idx % SHEET_COLUMNS)*cell_width
+                top = (idx // SHEET_COLUMNS)*cell_height
+                sheet.composite(img, left=left, top=top)
+                offsets.append({'x': left, 'y': top, 'width': img.width,
+                                'height': img.height})
+            return sheet.make_blob(format='jpg'), offsets
+    finally:
+        for img in images:
+            img.close()
+
+
+#: Edge length of the tiles in the deep zoom pyramid
+TILE_SIZE = 256
+
+
+def _open_level_source(img_path, transforms=None):
+    """ Open an image for generating the levels of a deep zoom pyramid.
+
+    :returns:   The image and whether it was opened with :py:mod:`jpegtran`
+    :rtype:     tuple
+    """
+    if HAS_JPEGTRAN and img_path.suffix.lower() in ('.jpg', '.jpeg'):
+        img = JPEGImage(unicode(img_path))
+        if transforms:
+            img = transform_image(img, transforms)
+        return img, True
+    return _open_image(img_path, transforms), False
+
+
+def get_max_level(width, height):
+    """ Get the index of the full-resolution level of a deep zoom pyramid
+        for an image of the given dimensions.
+
+    Level 0 is a single pixel, every following level doubles the dimensions.
+
+    :rtype:     int
+    """
+    return int(math.ceil(math.log(max(width, height, 1), 2)))
+
+
+def get_dzi_descriptor(img_path, transforms=None):
+    """ Generate a Deep Zoom Image descriptor for an image.
+
+    :param img_path:    Path to image
+    :type img_path:     pathlib.Path
+    :param transforms:  Transforms to apply to the image
+    :type transforms:   list of dict
+    :return:            The XML descriptor
+    :rtype:             bytestring
+    """
+    img, is_jpeg = _open_level_source(img_path, transforms)
+    width, height = img.width, img.height
+    if not is_jpeg:
+        img.close()
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+        'Format="jpg" Overlap="0" TileSize="{0}">'
+        '<Size Width="{1}" Height="{2}"/></Image>'
+        .format(TILE_SIZE, width, height)).encode('utf-8')
+
+
+def get_level_image(img_path, level, transforms=None):
+    """ Get an image scaled down to a level of its deep zoom pyramid.
+
+    With :py:mod:`jpegtran`, JPEGs are scaled in the DCT domain, i.e. without
+    fully decoding them. Their full-resolution level is the (losslessly
+    transformed) source image as it is, so tiles cut from it are lossless,
+    too.
+
+    :param img_path:    Path to image
+    :type img_path:     pathlib.Path
+    :param level:       Level of the pyramid
+    :type level:        int
+    :param transforms:  Transforms to apply to the image
+    :type transforms:   list of dict
+    :return:            The scaled image as a JPEG
+    :rtype:             bytestring
+    """
+    img, is_jpeg = _open_level_source(img_path, transforms)
+    max_level = get_max_level(img.width, img.height)
+    if not 0 <= level <= max_level:
+        raise ValueError("Level must be between 0 and {0}".format(max_level))
+    factor = 2**(max_level - level)
+    width = max(int(math.ceil(img.width/factor)), 1)
+    height = max(int(math.ceil(img.height/factor)), 1)
+    if is_jpeg:
+        if level == max_level:
+            return img.as_blob()
+        return img.downscale(width, height, quality=90).as_blob()
+    with img:
+        if (width, height) != (img.width, img.height):
+            img.resize(width, height)
+        return img.make_blob(format='jpg')
+
+
+def is_source_level(img_path, level, transforms=None):
+    """ Check if a level of the deep zoom pyramid is the source image itself
+        (see :py:func:`get_level_image`).
+
+    Such levels are as large as the source and cheap to get, so they should
+    not be cached.
+
+    :param img_path:    Path to image
+    :type img_path:     pathlib.Path
+    :param level:       Level of the pyramid
+    :type level:        int
+    :param transforms:  Transforms to apply to the image
+    :type transforms:   list of dict
+    :rtype:             bool
+    """
+    if not HAS_JPEGTRAN or img_path.suffix.lower() not in ('.jpg', '.jpeg'):
+        return False
+    img, _ = _open_level_source(img_path, transforms)
+    return level == get_max_level(img.width, img.height)
+
+
+def get_tile(level_image, column, row):
+    """ Cut a tile from a level of a deep zoom pyramid.
+
+    With :py:mod:`jpegtran`, the tile is cropped losslessly.
+
+    :param level_image: The level's image as a JPEG, see
+                        :py:func:`get_level_image`
+    :type level_image:  bytestring
+    :param column:      Column of the tile
+    :type column:       int
+    :param row:         Row of the tile
+    :type row:          int
+    :return:            The tile as a JPEG
+    :rtype:             bytestring
+    """
+    if HAS_JPEGTRAN:
+        img = JPEGImage(blob=level_image)
+    else:
+        img = Image(blob=level_image)
+    left, top = column*TILE_SIZE, row*TILE_SIZE
+    if left >= img.width or top >= img.height:
+        raise ValueError("Tile is outside of the image")
+    width = min(TILE_SIZE, img.width - left)
+    height = min(TILE_SIZE, img.height - top)
+    if HAS_JPEGTRAN:
+        return img.crop(left, top, width, height).as_blob()
+    with img:
+        img.crop(left, top, width=width, height=height)
+        return img.make_blob(format='jpg')
 
 
 def find_stick():
@@ -271,3 +1392,882 @@ def calculate_zipsize(frecords):
         size += os.path.getsize(filename)
     size += 22  # End of central directory record (EOCD)
     return size
+
+
+#: Extensions of files that are already compressed and thus stored as they
+#: are in ZIP archives
+STORED_EXTENSIONS = frozenset((
+    '.jpg', '.jpeg', '.jp2', '.jpx', '.j2k', '.png', '.gif', '.pdf',
+    '.djvu', '.epub', '.zip', '.gz', '.bz2', '.xz'))
+
+
+def get_compress_type(path):
+    """ Pick the compression for a file in a ZIP archive by its type.
+
+    Images in compressed formats (JPEG, JPEG 2000, PNG) and other compressed
+    files are stored, everything else (text, hOCR, JSON, TIFF, ...) is
+    deflated.
+
+    :param path:    Path to the file
+    :type path:     unicode
+    :returns:       :py:data:`zipfile.ZIP_STORED` or
+                    :py:data:`zipfile.ZIP_DEFLATED`
+    :rtype:         int
+    """
+    if os.path.splitext(path)[1].lower() in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def _read_block(path, offset, size, deflate, last):
+    """ Read a block from a file and optionally compress it.
+
+    Every block is deflated on its own and ends with a sync flush (or the
+    end of the stream for the last block of a file), so the compressed
+    blocks of a file can simply be concatenated.
+
+    :returns:   The raw data and the data to write to the archive
+    :rtype:     tuple of (str, str)
+    """
+    with open(path, 'rb') as fp:
+        fp.seek(offset)
+        data = fp.read(size)
+    if not deflate:
+        return data, data
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  -zlib.MAX_WBITS)
+    payload = compressor.compress(data) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return data, payload
+
+
+class _ByteCounter(object):
+    """ Write-only file-like object that buffers the data written to it and
+        keeps track of the position in the stream.
+    """
+    def __init__(self):
+        self.position = 0
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        """ Get and clear the buffered data. """
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class CompressingZipStream(object):
+    """ ZIP archive of a bag that chooses the compression per file and is
+        generated while iterating over it.
+
+    Files are read and compressed in blocks on a pool of worker threads,
+    which work a number of blocks ahead of the consumer, so that it only
+    has to wait for the compression if the network is faster than the
+    workers.
+    The archive has the same layout as the ones generated by
+    :py:meth:`spreads.vendor.bagit.Bag.package_as_zipstream`, i.e. the sizes
+    and checksums of every file follow its data in a data descriptor.
+    Since the size of the archive is not known in advance, it has to be
+    sent without a `Content-Length`.
+
+    :param bag:             Bag to package
+    :type bag:              :py:class:`spreads.vendor.bagit.Bag`
+    :param compress_type:   Function that returns the compression for a
+                            file path, see :py:func:`get_compress_type`
+    :param max_workers:     Number of threads compressing blocks, defaults
+                            to the number of CPUs
+    :type max_workers:      int
+    """
+    #: Size of the blocks that files are read and compressed in
+    BLOCK_SIZE = 1024**2
+    #: Number of blocks per worker that are prepared ahead of the consumer
+    LOOKAHEAD = 2
+
+    def __init__(self, bag, compress_type=get_compress_type,
+                 max_workers=None):
+        self.bag = bag
+        self.compress_type = compress_type
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+
+    def _get_entries(self):
+        """ Get the files to be archived with their archive names,
+            compression and status.
+        """
+        prefix = os.path.basename(self.bag.path)
+        for fpath in bagit.iterdir(self.bag.path):
+            relpath = os.path.relpath(fpath, self.bag.path)
+            arcname = "/".join((prefix, relpath.replace(os.sep, '/')))
+            yield fpath, arcname, self.compress_type(fpath), os.stat(fpath)
+
+    def _submit_blocks(self, executor, entries):
+        """ Submit jobs that read (and compress) every block of every file.
+
+        :returns:   Generator over the futures for the blocks
+        """
+        for fpath, arcname, compress_type, stat in entries:
+            deflate = compress_type == zipfile.ZIP_DEFLATED
+            # Empty files still need the end of their compressed stream
+            for offset in xrange(0, stat.st_size or 1, self.BLOCK_SIZE):
+                last = offset + self.BLOCK_SIZE >= stat.st_size
+                yield executor.submit(_read_block, fpath, offset,
+                                      self.BLOCK_SIZE, deflate, last)
+
+    def __iter__(self):
+        for chunk in self.iter_nonblocking():
+            if isinstance(chunk, Future):
+                # Wait for the block, errors are raised by the generator
+                chunk.exception()
+            else:
+                yield chunk
+
+    def iter_nonblocking(self):
+        """ Iterate over the archive without waiting for the workers.
+
+        :returns:   Generator over the chunks of the archive. When the next
+                    block is not compressed yet, its
+                    :py:class:`concurrent.futures.Future` is yielded
+                    instead, the iteration can be continued once it is
+                    done.
+        """
+        entries = list(self._get_entries())
+        out = _ByteCounter()
+        zinfos = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            jobs = self._submit_blocks(executor, entries)
+            pending = deque(itertools.islice(
+                jobs, self.max_workers*self.LOOKAHEAD))
+            for fpath, arcname, compress_type, stat in entries:
+                zinfo = zipfile.ZipInfo(
+                    arcname, time.localtime(stat.st_mtime)[:6])
+                zinfo.external_attr = (stat.st_mode & 0xFFFF) << 16
+                zinfo.compress_type = compress_type
+                # Sizes and checksum follow the data in a data descriptor
+                zinfo.flag_bits |= 0x08
+                zinfo.header_offset = out.tell()
+                out.write(zinfo.FileHeader(False))
+                yield out.pop()
+
+                crc = file_size = compress_size = 0
+                num_blocks = max(1, -(-stat.st_size // self.BLOCK_SIZE))
+                for _ in xrange(num_blocks):
+                    future = pending.popleft()
+                    if not future.done():
+                        yield future
+                    data, payload = future.result()
+                    pending.extend(itertools.islice(jobs, 1))
+                    crc = zlib.crc32(data, crc)
+                    file_size += len(data)
+                    compress_size += len(payload)
+                    out.write(payload)
+                    yield out.pop()
+                zinfo.CRC = crc & 0xffffffff
+                zinfo.file_size = file_size
+                zinfo.compress_size = compress_size
+                if max(file_size, compress_size) > zipfile.ZIP64_LIMIT:
+                    descriptor = ZipStreamExtractor.DESCRIPTOR64
+                else:
+                    descriptor = ZipStreamExtractor.DESCRIPTOR
+                out.write(descriptor.pack(ZipStreamExtractor.SIG_DESCRIPTOR,
+                                          zinfo.CRC, compress_size,
+                                          file_size))
+                zinfos.append(zinfo)
+        # Let the standard library write the central directory
+        zfile = zipfile.ZipFile(out, 'w', allowZip64=True)
+        zfile.filelist = zinfos
+        zfile.close()
+        yield out.pop()
+
+
+class ZipStreamExtractor(object):
+    """ Extracts a workflow bag from a ZIP archive while it is being received.
+
+    Entries are written to a hidden staging directory next to their final
+    location below `base_path` as soon as their data comes in, so the
+    archive never has to be stored as a whole. The bag is moved into place
+    once it was verified completely, existing bags are never written to.
+    Every file is hashed on the fly and checked against the digests in the
+    bag's (tag-)manifests. Since archives generated from a
+    :py:class:`spreads.vendor.bagit.Bag` have the manifests before the
+    payload, most files are verified as soon as their last byte was received,
+    files that arrived before the manifest listing them are verified when
+    it comes in.
+
+    Stored and deflated entries are supported, with or without data
+    descriptors (as written by `zipstream`).
+
+    :param base_path:   Directory to extract the bag to
+    :type base_path:    unicode
+    """
+    LOCAL_HEADER = struct.Struct(b'<4s5H3L2H')
+    DESCRIPTOR = struct.Struct(b'<4s3L')
+    DESCRIPTOR64 = struct.Struct(b'<4sL2Q')
+    SIG_LOCAL_HEADER = b'PK\x03\x04'
+    SIG_DESCRIPTOR = b'PK\x07\x08'
+    SIG_CENTRAL_DIR = (b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06')
+    MANIFEST_RE = re.compile(r'^(tag)?manifest-(\w+)\.txt$')
+
+    def __init__(self, base_path):
+        self.base_path = Path(base_path)
+        self.bag_name = None
+        #: Directory the entries are extracted to until the bag is complete
+        self.staging_path = None
+        #: Whether the end of the last entry was reached
+        self.finished = False
+        self._buffer = b''
+        self._entry = None
+        self._fp = None
+        # bag-relative path -> {algorithm: hexdigest}
+        self._received = {}
+        # manifest filename -> (algorithm, {bag-relative path: hexdigest})
+        self._manifests = {}
+
+    @property
+    def bag_path(self):
+        """ Path to the extracted bag or None if no entry was received yet.
+        """
+        if self.bag_name is not None:
+            return self.base_path/self.bag_name
+
+    def feed(self, data):
+        """ Process the next chunk of the archive.
+
+        :param data:    Raw archive data
+        :type data:     str
+        :raises zipfile.BadZipfile:     When the archive is malformed
+        :raises spreads.vendor.bagit.ValidationError:
+                                        When a checksum does not match
+        :raises ValueError:             When the bag already exists
+        """
+        if self.finished:
+            return
+        self._buffer += data
+        while self._buffer and not self.finished:
+            if self._entry is None:
+                done = self._read_header()
+            elif self._data_done:
+                done = self._read_descriptor()
+            else:
+                done = self._read_data()
+            if not done:
+                break
+
+    def finish(self):
+        """ Check that the bag was received completely and move it into
+            place.
+
+        :returns:       Path to the extracted bag
+        :rtype:         :py:class:`pathlib.Path`
+        :raises zipfile.BadZipfile:     When the archive was truncated
+        :raises spreads.vendor.bagit.ValidationError:
+                                        When no payload manifest was
+                                        received or files listed in a
+                                        manifest are missing/unexpected
+        :raises ValueError:             When the bag was created by someone
+                                        else in the meantime
+        """
+        if not self.finished or self._entry is not None:
+            raise zipfile.BadZipfile("Archive is incomplete")
+        payload = set()
+        for fname, (alg, entries) in self._manifests.iteritems():
+            missing = [path for path in entries if path not in self._received]
+            if missing:
+                raise bagit.FileMissing(missing[0])
+            if not fname.startswith('tag'):
+                payload.update(entries)
+        if not payload:
+            raise bagit.ValidationError("Archive contains no bag manifest")
+        for path in self._received:
+            if path.startswith('data/') and path not in payload:
+                raise bagit.UnexpectedFile(path)
+        if self.bag_path.exists():
+            raise ValueError("'{0}' already exists".format(self.bag_name))
+        try:
+            self.staging_path.rename(self.bag_path)
+        except OSError as e:
+            raise ValueError("Could not move '{0}' into place: {1}"
+                             .format(self.bag_name, e))
+        self.staging_path = None
+        return self.bag_path
+
+    def abort(self):
+        """ Stop extraction and remove the partially extracted bag. """
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        self.finished = True
+        self._buffer = b''
+        if self.staging_path is not None and self.staging_path.exists():
+            shutil.rmtree(unicode(self.staging_path))
+
+    def _read_header(self):
+        buf = self._buffer
+        if len(buf) < 4:
+            return False
+        if buf[:4] in self.SIG_CENTRAL_DIR:
+            # We don't need anything from the central directory
+            self.finished = True
+            self._buffer = b''
+            return False
+        elif buf[:4] != self.SIG_LOCAL_HEADER:
+            raise zipfile.BadZipfile("Bad local file header")
+        if len(buf) < self.LOCAL_HEADER.size:
+            return False
+        (_, _, flags, method, _, _, crc, csize, usize, name_len,
+         extra_len) = self.LOCAL_HEADER.unpack_from(buf)
+        header_size = self.LOCAL_HEADER.size + name_len + extra_len
+        if len(buf) < header_size:
+            return False
+        name = buf[self.LOCAL_HEADER.size:self.LOCAL_HEADER.size+name_len]
+        try:
+            name = name.decode('utf8' if flags & 0x800 else 'cp437')
+        except UnicodeDecodeError:
+            raise zipfile.BadZipfile("Malformed file name in archive")
+        self._buffer = buf[header_size:]
+        if flags & 0x1:
+            raise zipfile.BadZipfile("Encrypted entries are not supported")
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise zipfile.BadZipfile("Unsupported compression method for {0}"
+                                     .format(name))
+        has_descriptor = bool(flags & 0x8)
+        if not has_descriptor and 0xffffffff in (csize, usize):
+            raise zipfile.BadZipfile("ZIP64 entries without data descriptor"
+                                     " are not supported")
+        self._start_entry(name, method, has_descriptor,
+                          None if has_descriptor else (crc, csize, usize))
+        return True
+
+    def _get_relpath(self, name):
+        parts = [p for p in name.replace('\\', '/').split('/')
+                 if p not in ('', '.')]
+        if not parts or '..' in parts:
+            raise zipfile.BadZipfile("Illegal path in archive: {0}"
+                                     .format(name))
+        if self.bag_name is None:
+            if parts[0].startswith('.'):
+                raise zipfile.BadZipfile("Illegal bag name in archive: {0}"
+                                         .format(parts[0]))
+            self.bag_name = parts[0]
+            if self.bag_path.exists():
+                raise ValueError("'{0}' already exists".format(self.bag_name))
+            self.staging_path = self.base_path/'.{0}.{1}'.format(
+                self.bag_name, uuid.uuid4().hex)
+            self.staging_path.mkdir(parents=True)
+        elif parts[0] != self.bag_name:
+            raise zipfile.BadZipfile("Archive must contain a single bag")
+        return '/'.join(parts[1:])
+
+    def _start_entry(self, name, method, has_descriptor, expected):
+        self._entry = self._get_relpath(name)
+        self._has_descriptor = has_descriptor
+        self._expected = expected
+        self._remaining = expected[1] if expected else None
+        self._data_done = False
+        self._crc = 0
+        self._compressed = 0
+        self._size = 0
+        self._decompressor = None
+        if method == zipfile.ZIP_DEFLATED:
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._hashes = None
+        target = (self.staging_path/self._entry if self._entry
+                  else self.staging_path)
+        if name.endswith('/'):
+            if not target.exists():
+                target.mkdir(parents=True)
+            return
+        if not target.parent.exists():
+            target.parent.mkdir(parents=True)
+        self._fp = target.open('wb')
+        algorithms = set(alg for alg, _ in self._manifests.itervalues())
+        algorithms.add('md5')
+        self._hashes = dict((alg, bagit.HASH_ALGORITHMS[alg]())
+                            for alg in algorithms)
+
+    def _write(self, data):
+        """ Write data for the current entry, returns the data past the end
+            of a deflated stream.
+        """
+        unused = b''
+        if self._decompressor is not None:
+            output = self._decompressor.decompress(data)
+            unused = self._decompressor.unused_data
+            if unused:
+                data = data[:len(data)-len(unused)]
+            if unused or self._remaining == 0:
+                output += self._decompressor.flush()
+                self._data_done = True
+        else:
+            output = data
+        self._compressed += len(data)
+        self._size += len(output)
+        if output:
+            self._crc = zlib.crc32(output, self._crc)
+            if self._fp is not None:
+                self._fp.write(output)
+                for hash_ in self._hashes.itervalues():
+                    hash_.update(output)
+        return unused
+
+    def _read_data(self):
+        if self._remaining is not None:
+            data = self._buffer[:self._remaining]
+            self._buffer = self._buffer[len(data):]
+            self._remaining -= len(data)
+            self._write(data)
+            if self._remaining:
+                return False
+            self._data_done = True
+        elif self._decompressor is not None:
+            data, self._buffer = self._buffer, b''
+            self._buffer = self._write(data)
+            if not self._data_done:
+                return False
+        else:
+            # Stored entry of unknown size, the only way to find its end is
+            # to look for a data descriptor that matches the data before it.
+            return self._scan_descriptor()
+        if not self._has_descriptor:
+            self._finish_entry(*self._expected)
+        return True
+
+    def _scan_descriptor(self):
+        buf = self._buffer
+        idx = buf.find(self.SIG_DESCRIPTOR)
+        while idx != -1:
+            size = self._compressed + idx
+            for fmt in (self.DESCRIPTOR, self.DESCRIPTOR64):
+                if len(buf) < idx + fmt.size:
+                    # Not enough data to tell if this is the descriptor
+                    self._write(buf[:idx])
+                    self._buffer = buf[idx:]
+                    return False
+                _, crc, csize, usize = fmt.unpack_from(buf, idx)
+                if (csize == usize == size and
+                        crc == zlib.crc32(buf[:idx], self._crc) & 0xffffffff):
+                    self._write(buf[:idx])
+                    self._buffer = buf[idx+fmt.size:]
+                    self._finish_entry(crc, csize, usize)
+                    return True
+            idx = buf.find(self.SIG_DESCRIPTOR, idx+1)
+        # Hold back enough bytes for a signature that was split between chunks
+        keep = len(self.SIG_DESCRIPTOR) - 1
+        self._write(buf[:-keep])
+        self._buffer = buf[-keep:]
+        return False
+
+    def _read_descriptor(self):
+        buf = self._buffer
+        if len(buf) < 4:
+            return False
+        if buf[:4] != self.SIG_DESCRIPTOR:
+            # The signature is optional
+            buf = self.SIG_DESCRIPTOR + buf
+        is_zip64 = max(self._compressed, self._size) >= 0xffffffff
+        fmt = self.DESCRIPTOR64 if is_zip64 else self.DESCRIPTOR
+        if len(buf) < fmt.size:
+            return False
+        _, crc, csize, usize = fmt.unpack_from(buf)
+        self._buffer = buf[fmt.size:]
+        self._finish_entry(crc, csize, usize)
+        return True
+
+    def _finish_entry(self, crc, csize, usize):
+        path = self._entry
+        self._entry = None
+        if (crc != self._crc & 0xffffffff or csize != self._compressed or
+                usize != self._size):
+            raise zipfile.BadZipfile("Bad CRC or size for {0}".format(path))
+        if self._fp is None:
+            return
+        self._fp.close()
+        self._fp = None
+        self._received[path] = dict((alg, hash_.hexdigest())
+                                    for alg, hash_ in self._hashes.iteritems())
+        match = self.MANIFEST_RE.match(path)
+        if match:
+            alg = match.group(2)
+            if alg not in bagit.HASH_ALGORITHMS:
+                raise bagit.ValidationError("Unknown algorithm: {0}"
+                                            .format(alg))
+            manifest = bagit.Manifest(unicode(self.staging_path/path))
+            self._manifests[path] = (
+                alg, dict((p.replace(os.sep, '/'), digest)
+                          for p, digest in manifest.iteritems()))
+            for received_path in self._received:
+                self._verify(received_path)
+        else:
+            self._verify(path)
+
+    def _verify(self, path):
+        for alg, entries in self._manifests.itervalues():
+            if path not in entries:
+                continue
+            digests = self._received[path]
+            if alg not in digests:
+                # File was received before we knew about this algorithm
+                digests.update(
+                    bagit.hash_file(unicode(self.staging_path/path), [alg])[1])
+            if digests[alg] != entries[path].lower():
+                raise bagit.ChecksumMismatch(path, alg, entries[path],
+                                             digests[alg])
+
+
+class UploadSession(object):
+    """ Server-side state of a resumable workflow upload.
+
+    The client announces all files of the bag it wants to upload along with
+    their sizes and digests (as listed in the bag's manifests). The files
+    are staged in ``<base_path>/.uploads/<session id>`` and can be sent in
+    chunks of arbitrary size. The number of bytes that were acknowledged for
+    a file is the size of its staged copy, so an interrupted upload can be
+    resumed at any point, even after the server was restarted. Every file
+    is verified against its digest once it is complete and all files are
+    moved to the workflow directory when the session is committed.
+
+    If the workflow directory already exists (i.e. the workflow was
+    uploaded before), files that are identical to the announced ones are
+    not transferred again. On commit, the directory is updated in place and
+    files that are no longer part of the bag are removed.
+
+    Files can also be announced in parts (e.g. while the workflow is still
+    being captured), partial announcements only ever add files to the
+    session. The session can only be committed once all files of the bag
+    were announced, after that, partial announcements are refused.
+
+    Use :py:meth:`create` and :py:meth:`get` to obtain instances, there is
+    only a single instance per session.
+
+    :param path:    Staging directory of the session
+    :type path:     :py:class:`pathlib.Path`
+    """
+    STAGING_DIR = '.uploads'
+    _sessions = {}
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.id = path.name
+        self.lock = threading.RLock()
+        with (path/'session.json').open('rb') as fp:
+            data = json.load(fp)
+        self.name = data['name']
+        self.workflow_id = data['workflow_id']
+        self.algorithm = data['algorithm']
+        self.files = data['files']
+        self.verified = set(data['verified'])
+        self.unchanged = set(data.get('unchanged', []))
+        # Whether all files of the bag were announced
+        self.complete = data.get('complete', False)
+
+    @property
+    def target_path(self):
+        """ Path of the workflow directory. """
+        return self.path.parent.parent/self.name
+
+    @classmethod
+    def create(cls, base_path, name, workflow_id, files, algorithm='md5',
+               partial=False):
+        """ Start a new upload session or resume the existing session for
+        the same workflow.
+
+        When resuming, staged files whose size or digest changed in the
+        meantime are discarded.
+
+        :param base_path:   Directory the workflow will be stored in
+        :type base_path:    unicode
+        :param name:        Name of the workflow directory
+        :type name:         unicode
+        :param workflow_id: ID of the workflow on the client
+        :type workflow_id:  unicode
+        :param files:       Files in the bag, as a mapping from bag-relative
+                            paths to dicts with their `size` and `digest`
+        :type files:        dict
+        :param algorithm:   Algorithm the digests were calculated with
+        :type algorithm:    unicode
+        :param partial:     Whether only some of the files in the bag are
+                            announced, they are added to the ones announced
+                            before
+        :type partial:      bool
+        :rtype:             :py:class:`UploadSession`
+        :raises ValueError: When the name, a path, a size, a digest or the
+                            algorithm is invalid, the workflow directory
+                            belongs to a different workflow or a partial
+                            announcement is made after all files were
+                            announced
+        """
+        if not name or name.startswith('.') or '/' in name or '\\' in name:
+            raise ValueError("Invalid workflow name: {0}".format(name))
+        if algorithm not in bagit.HASH_ALGORITHMS:
+            raise ValueError("Unknown algorithm: {0}".format(algorithm))
+        if not isinstance(files, dict):
+            raise ValueError("Files must be a mapping from paths to sizes "
+                             "and digests")
+        for path, info in files.iteritems():
+            cls._check_path(path)
+            if (not isinstance(info, dict) or
+                    not isinstance(info.get('size'), (int, long))):
+                raise ValueError("Invalid size for {0}".format(path))
+            if not isinstance(info.get('digest'), basestring):
+                raise ValueError("Invalid digest for {0}".format(path))
+        target_path = Path(base_path)/name
+        if target_path.exists():
+            info = bagit.BagInfo(unicode(target_path/'bag-info.txt'))
+            if info.get('spreads-id') != workflow_id:
+                raise ValueError("'{0}' already exists and belongs to a "
+                                 "different workflow".format(name))
+        with cls._lock:
+            session = next(
+                (s for s in cls._find_all(base_path)
+                 if s.workflow_id == workflow_id and s.name == name), None)
+            if session is None:
+                path = Path(base_path)/cls.STAGING_DIR/unicode(uuid.uuid4())
+                path.mkdir(parents=True)
+                with (path/'session.json').open('wb') as fp:
+                    json.dump({'name': name, 'workflow_id': workflow_id,
+                               'algorithm': algorithm, 'files': {},
+                               'verified': []}, fp)
+                session = cls._sessions[path] = cls(path)
+        with session.lock:
+            if partial and session.complete:
+                raise ValueError("All files of '{0}' were already announced"
+                                 .format(name))
+            if partial and session.algorithm == algorithm:
+                announced = dict(session.files)
+                announced.update(files)
+                files = announced
+            if not partial and not session.complete:
+                session.complete = True
+                session._save()
+            if session.files != files or session.algorithm != algorithm:
+                for path, info in session.files.iteritems():
+                    changed = (files.get(path) != info or
+                               session.algorithm != algorithm)
+                    staged = session._get_staged_path(path)
+                    if changed and staged.exists():
+                        staged.unlink()
+                    if changed:
+                        session.verified.discard(path)
+                session.files = files
+                session.algorithm = algorithm
+                session._find_unchanged()
+                session._save()
+        return session
+
+    def _find_unchanged(self):
+        """ Find the announced files that are already present in the
+            workflow directory.
+
+        Digests are taken from the existing bag's manifests where possible.
+        """
+        self.verified -= self.unchanged
+        self.unchanged = set()
+        if not self.target_path.exists():
+            return
+        digests = {}
+        for prefix in ('', 'tag'):
+            manifest_path = self.target_path/'{0}manifest-{1}.txt'.format(
+                prefix, self.algorithm)
+            if manifest_path.exists():
+                digests.update(
+                    (path.replace(os.sep, '/'), digest) for path, digest
+                    in bagit.Manifest(unicode(manifest_path)).iteritems())
+        for path, info in self.files.iteritems():
+            if path in self.verified:
+                continue
+            existing = self.target_path/path
+            if (not existing.is_file() or
+                    existing.stat().st_size != info['size']):
+                continue
+            digest = digests.get(path)
+            if digest is None:
+                digest = bagit.hash_file(
+                    unicode(existing), [self.algorithm])[1][self.algorithm]
+            if digest.lower() == info['digest'].lower():
+                self.unchanged.add(path)
+                self.verified.add(path)
+
+    @classmethod
+    def get(cls, base_path, session_id):
+        """ Get an existing upload session.
+
+        :param base_path:   Directory the workflow will be stored in
+        :type base_path:    unicode
+        :param session_id:  ID of the session
+        :type session_id:   unicode
+        :rtype:             :py:class:`UploadSession` or None
+        """
+        with cls._lock:
+            return next((s for s in cls._find_all(base_path)
+                         if s.id == session_id), None)
+
+    @classmethod
+    def _find_all(cls, base_path):
+        staging_path = Path(base_path)/cls.STAGING_DIR
+        if not staging_path.exists():
+            return
+        for path in staging_path.iterdir():
+            if path not in cls._sessions:
+                if not (path/'session.json').exists():
+                    continue
+                cls._sessions[path] = cls(path)
+            yield cls._sessions[path]
+
+    @staticmethod
+    def _check_path(path):
+        parts = path.split('/')
+        if path.startswith('/') or '..' in parts or '' in parts:
+            raise ValueError("Illegal path: {0}".format(path))
+
+    def _get_staged_path(self, path):
+        return self.path/'files'/path
+
+    def _save(self):
+        with (self.path/'session.json.tmp').open('wb') as fp:
+            json.dump({'name': self.name, 'workflow_id': self.workflow_id,
+                       'algorithm': self.algorithm, 'files': self.files,
+                       'verified': sorted(self.verified),
+                       'unchanged': sorted(self.unchanged),
+                       'complete': self.complete}, fp)
+        os.rename(unicode(self.path/'session.json.tmp'),
+                  unicode(self.path/'session.json'))
+
+    @property
+    def is_complete(self):
+        """ Whether all files were received and verified. """
+        return all(path in self.verified for path in self.files)
+
+    def get_offset(self, path):
+        """ Get the number of bytes that were received for a file.
+
+        :param path:    Bag-relative path of the file
+        :type path:     unicode
+        :rtype:         int
+        """
+        if path in self.unchanged:
+            return self.files[path]['size']
+        staged = self._get_staged_path(path)
+        return staged.stat().st_size if staged.exists() else 0
+
+    def get_status(self):
+        """ Get the state of the session.
+
+        :returns:   The session ID, the workflow name, the number of bytes
+                    received for every file and the files that were not
+                    verified yet
+        :rtype:     dict
+        """
+        with self.lock:
+            return {'id': self.id,
+                    'name': self.name,
+                    'files': dict((path, self.get_offset(path))
+                                  for path in self.files),
+                    'pending': sorted(path for path in self.files
+                                      if path not in self.verified)}
+
+    def write(self, path, offset, data):
+        """ Write a chunk of a file.
+
+        Once the file is complete, it is verified against its digest.
+
+        :param path:    Bag-relative path of the file
+        :type path:     unicode
+        :param offset:  Position of the chunk in the file, must be the
+                        number of bytes that were received so far
+        :type offset:   int
+        :param data:    Data to write
+        :type data:     str
+        :returns:       Number of bytes received for the file
+        :rtype:         int
+        :raises KeyError:   When the file is not part of the session
+        :raises ValueError: When the offset does not match or the chunk
+                            exceeds the size of the file
+        :raises spreads.vendor.bagit.ChecksumMismatch:
+                            When the digest of the complete file does not
+                            match, the staged file is discarded
+        """
+        with self.lock:
+            info = self.files[path]
+            if path in self.unchanged:
+                raise ValueError("{0} is unchanged".format(path))
+            current = self.get_offset(path)
+            if offset != current:
+                raise ValueError("Offset {0} does not match number of "
+                                 "received bytes ({1})"
+                                 .format(offset, current))
+            if offset + len(data) > info['size']:
+                raise ValueError("Data exceeds size of {0}".format(path))
+            staged = self._get_staged_path(path)
+            if not staged.parent.exists():
+                staged.parent.mkdir(parents=True)
+            with staged.open('ab') as fp:
+                fp.write(data)
+            offset += len(data)
+            if offset == info['size'] and path not in self.verified:
+                digest = bagit.hash_file(
+                    unicode(staged), [self.algorithm])[1][self.algorithm]
+                if digest != info['digest'].lower():
+                    staged.unlink()
+                    raise bagit.ChecksumMismatch(path, self.algorithm,
+                                                 info['digest'], digest)
+                self.verified.add(path)
+                self._save()
+            return offset
+
+    def commit(self):
+        """ Move all received files to the workflow directory, remove files
+        that are not part of the bag from it and end the session.
+
+        :returns:       Path to the workflow directory
+        :rtype:         :py:class:`pathlib.Path`
+        :raises ValueError:
+                        When not all files of the bag were announced yet
+        :raises spreads.vendor.bagit.FileMissing:
+                        When not all files were received yet or an
+                        unchanged file was removed in the meantime
+        """
+        with self.lock:
+            if not self.complete:
+                raise ValueError("Not all files of '{0}' were announced yet"
+                                 .format(self.name))
+            missing = [path for path in sorted(self.files)
+                       if path not in self.verified]
+            if missing:
+                raise bagit.FileMissing(missing[0])
+            removed = [path for path in self.unchanged
+                       if not (self.target_path/path).is_file()]
+            if removed:
+                self.unchanged.difference_update(removed)
+                self.verified.difference_update(removed)
+                self._save()
+                raise bagit.FileMissing(removed[0])
+            for path in self.files:
+                if path in self.unchanged:
+                    continue
+                target = self.target_path/path
+                if not target.parent.exists():
+                    target.parent.mkdir(parents=True)
+                place_file(self._get_staged_path(path), target, move=True)
+            for fpath in bagit.iterdir(unicode(self.target_path)):
+                relpath = os.path.relpath(
+                    fpath, unicode(self.target_path)).replace(os.sep, '/')
+                if relpath not in self.files:
+                    os.unlink(fpath)
+            self.discard()
+        return self.target_path
+
+    def discard(self):
+        """ End the session and remove all staged files. """
+        with self._lock:
+            self._sessions.pop(self.path, None)
+        if self.path.exists():
+            shutil.rmtree(unicode(self.path))
@@ -1,5 +1,4 @@
 import mock
-import shutil
 
 from pathlib import Path
 
@@ -30,27 +29,32 @@ def test_process():
             sorted(x[0][1] for x in pool.submit.call_args_list))
 
 
-def test_autorotate_image(tmpdir):
-    in_path = tmpdir.join('foo.jpg')
-    out_path = tmpdir.join('foo_rotated.jpg')
-    shutil.copyfile('./tests/data/odd.jpg', unicode(in_path))
-
+def test_get_exif_orientation():
     with mock.patch('spreadsplug.autorotate.JPEGImage') as mockcls:
-        img = mock.Mock()
-        mockcls.return_value = img
-        img.exif_orientation = 1
-        autorotate.autorotate_image(unicode(in_path), unicode(out_path))
-        assert img.exif_autotransform.call_count == 0
-        assert out_path.exists()
-
-        img.exif_orientation = None
-        autorotate.autorotate_image(unicode(in_path), unicode(out_path))
-        assert img.exif_autotransform.call_count == 0
-        assert out_path.exists()
-
-        img.exif_orientation = 6
-        img.exif_autotransform.return_value = mock.Mock()
-        autorotate.autorotate_image(unicode(in_path), unicode(out_path))
-        assert img.exif_autotransform.call_count == 1
-        img.exif_autotransform.return_value.save.assert_called_with(
-            unicode(out_path))
+        mockcls.return_value.exif_orientation = 6
+        assert autorotate.get_exif_orientation('foo.jpg') == 6
+        mockcls.assert_called_with('foo.jpg')
+
+
+def test_update_callback():
+    plugin = autorotate.AutoRotatePlugin({'autorotate': None})
+    future = mock.Mock()
+
+    page = Page(Path('000.jpg'))
+    future.result.return_value = 1
+    plugin._get_update_callback(page)(future)
+    assert page.transforms == []
+
+    future.result.return_value = None
+    plugin._get_update_callback(page)(future)
+    assert page.transforms == []
+
+    future.result.return_value = 6
+    plugin._get_update_callback(page)(future)
+    assert page.transforms == [{'type': 'rotate', 'angle': 90}]
+
+    page = Page(Path('001.jpg'))
+    future.result.return_value = 7
+    plugin._get_update_callback(page)(future)
+    assert page.transforms == [{'type': 'rotate', 'angle': 270},
+                               {'type': 'flip', 'direction': 'horizontal'}]
@@ -132,6 +132,24 @@ def test_capture(jpeg, camera):
     assert jpeg.return_value.save.called_once_with('/tmp/000.jpg')
 
 
+@mock.patch('spreadsplug.dev.chdkcamera.JPEGImage')
+def test_capture_rotate(jpeg, camera):
+    rotated = jpeg.return_value.exif_autotransform.return_value
+    rotated.as_blob.return_value = 'rotated'
+    camera.config['rotate_on_capture'] = True
+    camera._device.mode = 'rec'
+    fpath = mock.MagicMock()
+    camera.target_page = 'odd'
+    future = camera.capture(fpath)
+    future.result()
+    assert jpeg.return_value.exif_orientation == 6
+    assert rotated.exif_orientation == 1
+    fpath.open.return_value.__enter__.return_value.write.assert_called_with(
+        'rotated')
+    camera.finish_capture()
+    assert camera._write_executor is None
+
+
 @mock.patch('spreadsplug.dev.chdkcamera.JPEGImage')
 def test_capture_raw(jpeg, camera):
     jpeg.return_value = mock.Mock()
@@ -0,0 +1,37 @@
+import mock
+
+import spreads.util as util
+
+
+def test_place_file_move(tmpdir):
+    src, dst = tmpdir.join('src.jpg'), tmpdir.join('dst.jpg')
+    src.write('foobar')
+    assert util.place_file(unicode(src), unicode(dst), move=True) == 'rename'
+    assert not src.exists()
+    assert dst.read() == 'foobar'
+
+
+def test_place_file_link(tmpdir):
+    src, dst = tmpdir.join('src.jpg'), tmpdir.join('dst.jpg')
+    src.write('foobar')
+    dst.write('stale')
+    with mock.patch('spreads.util._reflink') as reflink:
+        reflink.side_effect = OSError()
+        assert util.place_file(unicode(src), unicode(dst)) == 'hardlink'
+    assert src.exists()
+    assert dst.read() == 'foobar'
+
+
+def test_place_file_copy_fallback(tmpdir):
+    src, dst = tmpdir.join('src.jpg'), tmpdir.join('dst.jpg')
+    src.write('foobar')
+    with mock.patch('spreads.util._reflink') as reflink, \
+            mock.patch('spreads.util.os.rename') as rename, \
+            mock.patch('spreads.util.os.link') as link:
+        reflink.side_effect = OSError()
+        rename.side_effect = OSError()
+        link.side_effect = OSError()
+        assert util.place_file(unicode(src), unicode(dst),
+                               move=True) == 'copy'
+    assert not src.exists()
+    assert dst.read() == 'foobar'
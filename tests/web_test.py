@@ -1,8 +1,11 @@
+import io
 import json
 import os
 import random
 import re
 import time
+import urllib
+import zipfile
 
 import jpegtran
 import mock
@@ -21,6 +24,13 @@ def app(config, tmpdir):
     config['web']['debug'] = False
     config['web']['standalone_device'] = True
     config['web']['postprocessing_server'] = ''
+    config['web']['image_cache_size'] = 64
+    config['web']['image_cache_dir'] = unicode(tmpdir.join('cache'))
+    config['web']['worker_threads'] = 4
+    config['web']['upload_rate_limit'] = 0
+    config['web']['transfer_rate_limit'] = 0
+    config['web']['download_rate_limit'] = 0
+    config['web']['capture_rate_limit'] = 0
 
     webapp = WebApplication(config)
     webapp.setup_logging()
@@ -139,6 +149,62 @@ def test_list_workflows(client):
     assert 'config' in data[0]
 
 
+def test_list_workflows_paginated(client):
+    for _ in xrange(5):
+        create_workflow(client, num_captures=None)
+    rv = client.get('/api/workflow?fields=id,slug,page_count&limit=2')
+    data = json.loads(rv.data)
+    assert len(data) == 2
+    assert sorted(data[0].keys()) == ['id', 'page_count', 'slug']
+    seen = [wf['id'] for wf in data]
+    while 'X-Next-Cursor' in rv.headers:
+        rv = client.get('/api/workflow?fields=id&limit=2&cursor={0}'
+                        .format(rv.headers['X-Next-Cursor']))
+        seen.extend(wf['id'] for wf in json.loads(rv.data))
+    assert len(seen) == 5
+    assert len(set(seen)) == 5
+
+    rv = client.get('/api/workflow?fields=id&format=ndjson')
+    assert rv.mimetype == 'application/x-ndjson'
+    assert len(rv.data.splitlines()) == 5
+
+    assert client.get('/api/workflow?fields=foo').status_code == 400
+    assert client.get('/api/workflow?cursor=foo').status_code == 400
+
+
+def test_list_workflows_index(client):
+    from spreads.workflow import Workflow
+    wfids = [create_workflow(client, num_captures=None) for _ in xrange(3)]
+    data = json.loads(client.get('/api/workflow?fields=id').data)
+    assert sorted(wf['id'] for wf in data) == sorted(wfids)
+    # Make sure the modification time differs on all filesystems
+    time.sleep(1)
+    oldest = data[-1]['id']
+    client.post('/api/workflow/{0}/prepare_capture'.format(oldest))
+    client.post('/api/workflow/{0}/capture'.format(oldest))
+    client.post('/api/workflow/{0}/finish_capture'.format(oldest))
+    client.delete('/api/workflow/{0}'.format(data[0]['id']))
+    with mock.patch.object(Workflow, 'find_all') as find_all:
+        data = json.loads(client.get('/api/workflow?fields=id').data)
+        # The index is kept up to date from the workflow signals
+        assert not find_all.called
+    assert len(data) == 2
+    assert data[0]['id'] == oldest
+
+
+def test_get_all_pages_paginated(client):
+    wfid = create_workflow(client, num_captures=3)
+    rv = client.get('/api/workflow/{0}/page?fields=capture_num&limit=4'
+                    .format(wfid))
+    data = json.loads(rv.data)
+    assert len(data) == 4
+    assert data[0].keys() == ['capture_num']
+    rv = client.get('/api/workflow/{0}/page?limit=4&cursor={1}'
+                    .format(wfid, rv.headers['X-Next-Cursor']))
+    assert len(json.loads(rv.data)) == 2
+    assert 'X-Next-Cursor' not in rv.headers
+
+
 def test_get_workflow(client):
     wfid = create_workflow(client)
     data = json.loads(client.get('/api/workflow/{0}'.format(wfid)).data)
@@ -178,16 +244,519 @@ def test_submit_workflow(requests, app, tmpdir):
     wfid = create_workflow(client)
     with mock.patch('spreadsplug.web.app.task_queue') as mock_tq:
         mock_tq.task.return_value = lambda x: x
-        requests.post.return_value.json.return_value = {'id': 1}
+        requests.post.return_value.json.return_value = {
+            'id': 1, 'files': {}, 'pending': []}
         client.post('/api/workflow/{0}/submit'.format(wfid),
                     content_type="application/json",
                     data=json.dumps({'config': {'plugins': []},
                                      'server': '127.0.0.1:5000'}))
-    assert requests.post.call_count == 1
+    # Start upload session, finish it
+    assert requests.post.call_count == 2
     # TODO: Iterate through data, assert events are emitted
     # TODO: Assert completed are emitted
 
 
+@pytest.yield_fixture
+def remote_upload(app, tmpdir):
+    """ Route upload requests from the tasks module to the test client,
+        with the second base directory acting as the remote server.
+    """
+    import requests
+    client = app.test_client()
+    puts = []
+
+    def make_request(method):
+        def request(url, params=None, data=None, headers=None,
+                    timeout=None):
+            if method == 'put':
+                puts.append(url)
+                # The fifth chunk fails
+                if len(puts) == 5:
+                    raise requests.ConnectionError("Connection dropped")
+            path = url.replace('http://remote', '')
+            if params:
+                path += '?' + urllib.urlencode(params)
+            base_path = app.config['base_path']
+            app.config['base_path'] = unicode(tmpdir.join('remote'))
+            try:
+                rv = getattr(client, method)(path, data=data,
+                                             headers=headers)
+            finally:
+                app.config['base_path'] = base_path
+            resp = requests.Response()
+            resp.status_code = rv.status_code
+            resp._content = rv.data
+            resp.url = url
+            return resp
+        return request
+
+    tmpdir.join('remote').mkdir()
+    with mock.patch('spreadsplug.web.app.task_queue') as mock_tq:
+        mock_tq.task.return_value = lambda x: x
+        from spreadsplug.web import tasks
+    with mock.patch.multiple(tasks, UPLOAD_CHUNK_SIZE=16384,
+                             UPLOAD_RETRY_DELAY=0):
+        with mock.patch.multiple(tasks.requests, post=make_request('post'),
+                                 put=make_request('put')):
+            yield tasks, puts
+
+
+def test_rate_limiter():
+    from spreads.workflow import on_capture_triggered, on_capture_succeeded
+    from spreadsplug.web.util import RateLimiter, ThrottledReader
+    now = [1000.0]
+    rate_limiter = RateLimiter(rate=1024, capture_rate=0,
+                               clock=lambda: now[0])
+    rate_limiter.connect_signals()
+    assert rate_limiter.active
+    # The bucket starts out empty, so every chunk has to wait for its tokens
+    assert rate_limiter.reserve(512) == 0.5
+    assert rate_limiter.reserve(512) == 1.0
+    now[0] += 0.5
+    assert rate_limiter.reserve(512) == 1.0
+    # The bucket never holds more than a second's worth of tokens
+    now[0] += 10
+    assert rate_limiter.reserve(1024) == 0
+    assert rate_limiter.reserve(512) == 0.5
+
+    # Transfers are paused while capturing
+    workflow = mock.Mock(id='foo')
+    on_capture_triggered.send(workflow)
+    assert rate_limiter.capturing
+    assert rate_limiter.reserve(512) is None
+    on_capture_succeeded.send(workflow, pages=[], retake=False)
+    assert not rate_limiter.capturing
+    assert rate_limiter.reserve(512) == 1.0
+    # Captures that never report back time out
+    on_capture_triggered.send(workflow)
+    now[0] += RateLimiter.CAPTURE_TIMEOUT + 1
+    assert not rate_limiter.capturing
+
+    # Without a limit, the limiter is only used while capturing
+    unlimited = RateLimiter(clock=lambda: now[0])
+    unlimited.connect_signals()
+    assert not unlimited.active
+    assert unlimited.reserve(512) == 0
+    on_capture_triggered.send(workflow)
+    assert unlimited.active
+    on_capture_succeeded.send(workflow, pages=[], retake=False)
+    reader = ThrottledReader(b'x'*4096, unlimited)
+    assert len(reader) == 4096
+    assert reader.read(1024) == b'x'*1024
+    assert reader.read() == b'x'*3072
+    assert reader.read() == b''
+
+
+def test_resumable_upload(app, tmpdir, remote_upload):
+    from spreads.workflow import Workflow
+    from spreadsplug.web.util import UploadSession
+    tasks, num_puts = remote_upload
+    wfid = create_workflow(app.test_client(), 3)
+    workflow = Workflow.find_by_id(app.config['base_path'], wfid)
+    tasks.upload_workflow(wfid, app.config['base_path'], 'http://remote',
+                          {'plugins': []})
+    assert len(num_puts) > 5
+    remote = Workflow.find_by_id(unicode(tmpdir.join('remote')), wfid)
+    for fpath in workflow.path.glob('data/**/*'):
+        if fpath.is_file():
+            target = remote.path/fpath.relative_to(workflow.path)
+            assert target.open('rb').read() == fpath.open('rb').read()
+    assert not tmpdir.join('remote', '.uploads').listdir()
+
+    # Sessions are resumed from the staged files
+    files = tasks.get_bag_files(workflow.bag)
+    path = sorted(p for p in files if files[p]['size'] > 10)[0]
+    session = UploadSession.create(app.config['base_path'], 'foo', wfid,
+                                   files)
+    with (workflow.path/path).open('rb') as fp:
+        session.write(path, 0, fp.read(10))
+    UploadSession._sessions.clear()
+    resumed = UploadSession.create(app.config['base_path'], 'foo', wfid,
+                                   files)
+    assert resumed.id == session.id
+    assert resumed.get_status()['files'][path] == 10
+    with pytest.raises(ValueError):
+        resumed.write(path, 0, b'foo')
+    resumed.discard()
+
+
+def test_compressed_upload(app, tmpdir, remote_upload):
+    from spreads.workflow import Workflow
+    tasks, puts = remote_upload
+    wfid = create_workflow(app.test_client(), 1)
+    workflow = Workflow.find_by_id(app.config['base_path'], wfid)
+    with mock.patch.object(tasks.requests, 'put',
+                           side_effect=tasks.requests.put) as put:
+        tasks.upload_workflow(wfid, app.config['base_path'], 'http://remote',
+                              {'plugins': []})
+    encodings = dict((args[0].rsplit('/', 1)[-1],
+                      kwargs['headers'].get('Content-Encoding'))
+                     for args, kwargs in put.call_args_list)
+    assert encodings['bagit.txt'] == 'deflate'
+    assert encodings['000.jpg'] is None
+    remote = Workflow.find_by_id(unicode(tmpdir.join('remote')), wfid)
+    assert ((remote.path/'bagit.txt').open('rb').read() ==
+            (workflow.path/'bagit.txt').open('rb').read())
+
+
+def test_upload_validation(app, tmpdir, remote_upload):
+    from spreads.workflow import Workflow
+    tasks, puts = remote_upload
+    wfid = create_workflow(app.test_client(), 1)
+    workflow = Workflow.find_by_id(app.config['base_path'], wfid)
+    files = tasks.get_bag_files(workflow.bag)
+    # The file got shorter after it was announced
+    path = sorted(p for p in files if p.startswith('data/raw/'))[0]
+    with (workflow.path/path).open('r+b') as fp:
+        fp.truncate(files[path]['size'] // 2)
+    with pytest.raises(IOError):
+        tasks.upload_bag(workflow, 'http://remote', {path: files[path]})
+    errors = []
+
+    def on_error(sender, **kwargs):
+        errors.append(kwargs['message'])
+    with mock.patch.object(tasks, 'upload_bag',
+                           side_effect=IOError("no progress")):
+        with tasks.signals['submit:error'].connected_to(on_error):
+            tasks.upload_workflow(wfid, app.config['base_path'],
+                                  'http://remote', {'plugins': []})
+    assert errors == ["Upload failed: no progress"]
+
+    client = app.test_client()
+    for info in ({'size': 1}, {'size': 1, 'digest': 1}, None):
+        rv = client.post('/api/upload', data=json.dumps(
+            {'name': 'foo', 'workflow_id': wfid,
+             'files': {'bagit.txt': info}}))
+        assert rv.status_code == 400
+    rv = client.post('/api/upload', data=json.dumps(
+        {'name': 'foo', 'workflow_id': wfid, 'files': ['bagit.txt']}))
+    assert rv.status_code == 400
+
+
+def test_upload_digest_mismatch(app, tmpdir, remote_upload):
+    from spreads.workflow import Workflow
+    tasks, puts = remote_upload
+    wfid = create_workflow(app.test_client(), 1)
+    workflow = Workflow.find_by_id(app.config['base_path'], wfid)
+    files = tasks.get_bag_files(workflow.bag)
+    path = sorted(p for p in files if p.startswith('data/raw/'))[0]
+    put = tasks.requests.put
+    corrupted = []
+    limit = [1]
+
+    def corrupting_put(url, params=None, data=None, **kwargs):
+        if url.endswith(path) and params['offset'] == 0 and limit[0]:
+            limit[0] -= 1
+            corrupted.append(url)
+            data = b'x' + data[1:]
+        return put(url, params=params, data=data, **kwargs)
+
+    # Corrupted on the wire, the file is sent again from the start
+    with mock.patch.object(tasks.requests, 'put', corrupting_put):
+        tasks.upload_bag(workflow, 'http://remote', {path: files[path]},
+                         finish=False)
+    assert len(corrupted) == 1
+    rv = app.test_client().post('/api/upload', data=json.dumps(
+        {'name': workflow.path.name, 'workflow_id': wfid,
+         'files': {path: files[path]}, 'partial': True}))
+    assert path not in json.loads(rv.data)['pending']
+
+    # But not forever
+    path = sorted(p for p in files if p.startswith('data/raw/'))[1]
+    limit = [tasks.UPLOAD_MAX_RESENDS + 1]
+    del corrupted[:]
+    with mock.patch.object(tasks.requests, 'put', corrupting_put):
+        with pytest.raises(IOError):
+            tasks.upload_bag(workflow, 'http://remote', {path: files[path]},
+                             finish=False)
+    assert len(corrupted) == tasks.UPLOAD_MAX_RESENDS + 1
+
+    # Files that changed since they were announced are announced again
+    with (workflow.path/path).open('r+b') as fp:
+        fp.write(b'changed')
+    announced = dict(files[path])
+    upload_files = {path: files[path]}
+    tasks.upload_bag(workflow, 'http://remote', upload_files, finish=False)
+    assert upload_files[path]['digest'] != announced['digest']
+    session_path = next(tmpdir.join('remote', '.uploads').visit(path))
+    assert session_path.read('rb') == (workflow.path/path).open('rb').read()
+
+
+def test_delta_upload(app, tmpdir, remote_upload):
+    from spreads.workflow import Workflow
+    tasks, puts = remote_upload
+    wfid = create_workflow(app.test_client(), 3)
+    workflow = Workflow.find_by_id(app.config['base_path'], wfid)
+    tasks.upload_workflow(wfid, app.config['base_path'], 'http://remote',
+                          {'plugins': []})
+    remote_path = tmpdir.join('remote', workflow.path.name)
+    remote_path.join('data', 'stale.txt').write('stale')
+
+    changed = sorted(workflow.path.glob('data/raw/*'))[0]
+    with changed.open('ab') as fp:
+        fp.write(b'retaken')
+    workflow.bag.add_payload(unicode(changed))
+    del puts[:]
+    tasks.upload_workflow(wfid, app.config['base_path'], 'http://remote',
+                          {'plugins': []})
+    sent = set(url.split('/', 6)[-1] for url in puts)
+    assert unicode(changed.relative_to(workflow.path)) in sent
+    assert not any(p.startswith('data/') for p in sent
+                   if p != unicode(changed.relative_to(workflow.path)))
+    assert (remote_path.join(unicode(changed.relative_to(workflow.path)))
+            .read('rb') == changed.open('rb').read())
+    assert not remote_path.join('data', 'stale.txt').exists()
+
+
+def test_live_submit(app, tmpdir, remote_upload):
+    from spreads.workflow import Workflow
+    tasks, puts = remote_upload
+    submitter = tasks.LiveSubmitter('http://remote')
+    submitter.connect_signals()
+    wfid = create_workflow(app.test_client(), 4)
+    submitter._executor.shutdown(wait=True)
+    workflow = Workflow.find_by_id(app.config['base_path'], wfid)
+    raw_images = set(unicode(p.relative_to(workflow.path))
+                     for p in workflow.path.glob('data/raw/*'))
+    live_sent = set(url.split('/', 6)[-1] for url in puts)
+    assert live_sent and live_sent <= raw_images
+    # Nothing was committed yet
+    assert not tmpdir.join('remote', workflow.path.name).exists()
+
+    del puts[:]
+    tasks.upload_workflow(wfid, app.config['base_path'], 'http://remote',
+                          {'plugins': []})
+    final_sent = set(url.split('/', 6)[-1] for url in puts)
+    assert len(final_sent & raw_images) < len(raw_images)
+    assert Workflow.find_by_id(unicode(tmpdir.join('remote')), wfid)
+
+
+def test_partial_upload_announcement(app, tmpdir):
+    from spreads.workflow import Workflow
+    from spreadsplug.web.tasks import get_bag_files
+    from spreadsplug.web.util import UploadSession
+    wfid = create_workflow(app.test_client(), 2)
+    workflow = Workflow.find_by_id(app.config['base_path'], wfid)
+    files = get_bag_files(workflow.bag)
+    raw = dict((p, i) for p, i in files.iteritems()
+               if p.startswith('data/raw/'))
+    first, second = sorted(raw)[:2]
+    base_path = unicode(tmpdir.join('remote'))
+
+    def write(session, path):
+        with (workflow.path/path).open('rb') as fp:
+            session.write(path, 0, fp.read())
+
+    # Partial announcements only add files
+    session = UploadSession.create(base_path, 'foo', wfid,
+                                   {first: raw[first]}, partial=True)
+    write(session, first)
+    session = UploadSession.create(base_path, 'foo', wfid,
+                                   {second: raw[second]}, partial=True)
+    assert sorted(session.files) == [first, second]
+    assert session.get_offset(first) == raw[first]['size']
+    with pytest.raises(ValueError):
+        session.commit()
+
+    # Once all files were announced, partial announcements are refused
+    session = UploadSession.create(base_path, 'foo', wfid, files)
+    write(session, 'bagit.txt')
+    with pytest.raises(ValueError):
+        UploadSession.create(base_path, 'foo', wfid, raw, partial=True)
+    assert sorted(session.files) == sorted(files)
+    for path in session.get_status()['pending']:
+        write(session, path)
+    wf_path = session.commit()
+    assert (wf_path/'bagit.txt').exists()
+    assert (wf_path/'manifest-md5.txt').exists()
+
+
+def test_live_submit_interleaved(app, tmpdir, remote_upload):
+    from spreads.workflow import Workflow
+    tasks, puts = remote_upload
+    # The fixture swaps the base path while requests to the remote are made
+    base_path = app.config['base_path']
+    submitter = tasks.LiveSubmitter('http://remote')
+    submitter.connect_signals()
+    app.config['live_submitter'] = submitter
+    try:
+        wfid = create_workflow(app.test_client(), 4)
+        # Submissions for the last captures are most likely still queued
+        tasks.upload_workflow(wfid, base_path, 'http://remote',
+                              {'plugins': []})
+    finally:
+        app.config['live_submitter'] = None
+        submitter._executor.shutdown(wait=True)
+    remote = Workflow.find_by_id(unicode(tmpdir.join('remote')), wfid)
+    assert (remote.path/'bagit.txt').exists()
+    assert remote.bag.is_valid()
+
+
+def _feed_randomly(extractor, data):
+    pos = 0
+    while pos < len(data):
+        size = random.randint(1, 8192)
+        extractor.feed(data[pos:pos+size])
+        pos += size
+
+
+def test_zip_stream_extractor(app, tmpdir):
+    from spreads.vendor.bagit import ChecksumMismatch
+    from spreads.workflow import Workflow
+    from spreadsplug.web.util import ZipStreamExtractor
+    wfid = create_workflow(app.test_client(), 3)
+    workflow = Workflow.find_by_id(app.config['base_path'], wfid)
+    data = b''.join(workflow.bag.package_as_zipstream(compression=None))
+
+    extractor = ZipStreamExtractor(unicode(tmpdir.join('remote')))
+    extractor.feed(data[:len(data)//2])
+    # Entries are staged in a hidden directory until the bag is complete
+    assert extractor.staging_path.name.startswith('.')
+    assert not extractor.bag_path.exists()
+    _feed_randomly(extractor, data[len(data)//2:])
+    wf_path = extractor.finish()
+    assert wf_path.name == workflow.path.name
+    assert tmpdir.join('remote').listdir() == [tmpdir.join('remote',
+                                                           wf_path.name)]
+    for fpath in workflow.path.rglob('*'):
+        if fpath.is_file():
+            target = wf_path/fpath.relative_to(workflow.path)
+            assert target.open('rb').read() == fpath.open('rb').read()
+
+    # Deflated entries with sizes in the local header
+    zpath = unicode(tmpdir.join('deflated.zip'))
+    with zipfile.ZipFile(zpath, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for fpath in workflow.path.rglob('*'):
+            if fpath.is_file():
+                zf.write(unicode(fpath), unicode(
+                    fpath.relative_to(workflow.path.parent)))
+    extractor = ZipStreamExtractor(unicode(tmpdir.join('deflated')))
+    with open(zpath, 'rb') as fp:
+        _feed_randomly(extractor, fp.read())
+    assert extractor.finish().exists()
+
+    # Existing bags are never written to
+    extractor = ZipStreamExtractor(unicode(tmpdir.join('remote')))
+    with pytest.raises(ValueError):
+        extractor.feed(data)
+    extractor.abort()
+    assert len(tmpdir.join('remote').listdir()) == 1
+
+    # Payload that does not match the manifest
+    with next(workflow.path.glob('data/raw/*.jpg')).open('ab') as fp:
+        fp.write(b'garbage')
+    data = b''.join(workflow.bag.package_as_zipstream(compression=None))
+    extractor = ZipStreamExtractor(unicode(tmpdir.join('tampered')))
+    with pytest.raises(ChecksumMismatch):
+        _feed_randomly(extractor, data)
+    extractor.abort()
+    assert not tmpdir.join('tampered').listdir()
+
+    # Truncated archive
+    extractor = ZipStreamExtractor(unicode(tmpdir.join('truncated')))
+    extractor.feed(data[:len(data)//2])
+    with pytest.raises(zipfile.BadZipfile):
+        extractor.finish()
+
+
+def test_compressing_zip_stream(app, tmpdir, monkeypatch):
+    from spreads.workflow import Workflow
+    from spreadsplug.web.util import CompressingZipStream, ZipStreamExtractor
+    wfid = create_workflow(app.test_client(), 3)
+    workflow = Workflow.find_by_id(app.config['base_path'], wfid)
+    # Make sure files span multiple blocks
+    monkeypatch.setattr(CompressingZipStream, 'BLOCK_SIZE', 4096)
+    data = b''.join(CompressingZipStream(workflow.bag, max_workers=2))
+
+    zfile = zipfile.ZipFile(io.BytesIO(data))
+    assert zfile.testzip() is None
+    for zinfo in zfile.infolist():
+        if zinfo.filename.endswith('.jpg'):
+            assert zinfo.compress_type == zipfile.ZIP_STORED
+        else:
+            assert zinfo.compress_type == zipfile.ZIP_DEFLATED
+        fpath = workflow.path.parent/zinfo.filename
+        assert zfile.read(zinfo) == fpath.open('rb').read()
+
+    extractor = ZipStreamExtractor(unicode(tmpdir.join('remote')))
+    _feed_randomly(extractor, data)
+    assert extractor.finish().name == workflow.path.name
+
+    # Consumers on the IOLoop get the futures of pending blocks instead
+    chunks = list(CompressingZipStream(workflow.bag, max_workers=2)
+                  .iter_nonblocking())
+    assert b''.join(c for c in chunks if isinstance(c, bytes)) == data
+
+
+@pytest.yield_fixture
+def file_server(app):
+    from tornado.httpclient import AsyncHTTPClient
+    from tornado.httpserver import HTTPServer
+    from tornado.ioloop import IOLoop
+    from tornado.testing import bind_unused_port
+    from tornado.web import Application
+    from spreadsplug.web.handlers import WorkflowFileHandler
+
+    io_loop = IOLoop()
+    io_loop.make_current()
+    base_path = app.config['base_path']
+    application = Application([
+        (r"/api/workflow/([0-9a-z-]+)/output/([^/]+)", WorkflowFileHandler,
+         dict(base_path=base_path, subdirectory='out')),
+        (r"/api/workflow/([0-9a-z-]+)/data/((?:raw|done|out)/[^/]+)",
+         WorkflowFileHandler, dict(base_path=base_path))])
+    sock, port = bind_unused_port()
+    server = HTTPServer(application)
+    server.add_sockets([sock])
+
+    def fetch(path, **kwargs):
+        return io_loop.run_sync(lambda: AsyncHTTPClient().fetch(
+            "http://127.0.0.1:{0}{1}".format(port, path), raise_error=False,
+            **kwargs))
+    yield fetch
+    server.stop()
+    IOLoop.clear_current()
+    io_loop.close(all_fds=True)
+
+
+def test_workflow_file_handler(app, file_server):
+    from spreads.workflow import Workflow
+    wfid = create_workflow(app.test_client(), 1)
+    workflow = Workflow.find_by_id(app.config['base_path'], wfid)
+    fpath = sorted((workflow.path/'data'/'raw').iterdir())[0]
+    with fpath.open('rb') as fp:
+        data = fp.read()
+    url = '/api/workflow/{0}/data/raw/{1}'.format(wfid, fpath.name)
+
+    resp = file_server(url)
+    assert resp.code == 200
+    assert resp.body == data
+    etag = resp.headers['Etag']
+
+    # Workflows can also be looked up by their slug
+    resp = file_server('/api/workflow/{0}/data/raw/{1}'
+                       .format(workflow.slug, fpath.name))
+    assert resp.code == 200
+    assert resp.body == data
+
+    resp = file_server(url, headers={'If-None-Match': etag})
+    assert resp.code == 304
+    assert not resp.body
+
+    resp = file_server(url, headers={'Range': 'bytes=100-199'})
+    assert resp.code == 206
+    assert resp.body == data[100:200]
+    assert resp.headers['Content-Range'] == 'bytes 100-199/{0}'.format(
+        len(data))
+
+    assert file_server('/api/workflow/{0}/data/raw/999.jpg'
+                       .format(wfid)).code == 404
+    assert file_server('/api/workflow/{0}/output/foo.pdf'
+                       .format(wfid)).code == 404
+    assert file_server('/api/workflow/nonexistent/data/raw/{0}'
+                       .format(fpath.name)).code == 404
+
+
 def test_get_page_image(client):
     wfid = create_workflow(client)
     with open(os.path.abspath('./tests/data/even.jpg'), 'rb') as fp:
@@ -196,6 +765,19 @@ def test_get_page_image(client):
     assert orig == fromapi
 
 
+def test_get_page_image_conditional(client):
+    wfid = create_workflow(client)
+    url = '/api/workflow/{0}/page/0/raw'.format(wfid)
+    rv = client.get(url)
+    etag = rv.headers['ETag'].strip('"')
+    assert rv.headers['Cache-Control'] == 'no-cache'
+    rv = client.get(url, headers={'If-None-Match': '"{0}"'.format(etag)})
+    assert rv.status_code == 304
+    assert not rv.data
+    rv = client.get(url + '?digest=' + etag)
+    assert 'immutable' in rv.headers['Cache-Control']
+
+
 def test_get_page_image_scaled(client):
     wfid = create_workflow(client)
     rv = client.get('/api/workflow/{0}/page/0/raw?width=300'.format(wfid))
@@ -204,6 +786,28 @@ def test_get_page_image_scaled(client):
     assert img.width == 300
 
 
+def test_get_page_image_tiles(client):
+    wfid = create_workflow(client)
+    url = '/api/workflow/{0}/page/0/raw/'.format(wfid)
+    rv = client.get(url + 'tiles.dzi')
+    assert rv.status_code == 200
+    assert re.search(r'<Size Width="4368" Height="2912"/>', rv.data)
+    import spreadsplug.web.endpoints as endpoints
+    with mock.patch('spreadsplug.web.endpoints.get_cached_image',
+                    wraps=endpoints.get_cached_image) as get_cached:
+        rv = client.get(url + 'tiles_files/13/1_1.jpg')
+    assert rv.status_code == 200
+    img = jpegtran.JPEGImage(blob=rv.data)
+    assert (img.width, img.height) == (256, 256)
+    # The full-resolution level is cut from the source, not the cache
+    assert all(not c[0][1].startswith('level=')
+               for c in get_cached.call_args_list)
+    rv = client.get(url + 'tiles_files/8/0_0.jpg')
+    assert jpegtran.JPEGImage(blob=rv.data).width == 137
+    rv = client.get(url + 'tiles_files/8/1_0.jpg')
+    assert rv.status_code == 404
+
+
 def test_get_page_image_thumb(client):
     # TODO: Use test images that actually have an EXIF thumbnail...
     wfid = create_workflow(client)
@@ -212,6 +816,20 @@ def test_get_page_image_thumb(client):
     assert jpegtran.JPEGImage(blob=rv.data).width == 196
 
 
+def test_get_sprite_sheets(client):
+    wfid = create_workflow(client, num_captures=2)
+    url = '/api/workflow/{0}/sprites'.format(wfid)
+    data = json.loads(client.get(url).data)
+    assert data['sheets'] == [{'sheet': 0, 'first_page': 0, 'num_pages': 4}]
+    offsets = json.loads(client.get(url + '/0.json').data)
+    assert len(offsets['pages']) == 4
+    assert offsets['pages'][1]['x'] == offsets['pages'][0]['width']
+    rv = client.get(url + '/0.jpg?digest=' + offsets['digest'])
+    assert rv.status_code == 200
+    assert 'immutable' in rv.headers['Cache-Control']
+    assert client.get(url + '/1.json').status_code == 404
+
+
 def test_prepare_capture(client):
     wfid = create_workflow(client, num_captures=None)
     rv = client.post('/api/workflow/{0}/prepare_capture'.format(wfid))
@@ -282,3 +900,279 @@ def test_get_logs(client):
     assert len(records['messages']) == 5
     assert (records['messages'][0]['message'] ==
             u'Sending finish_capture command to devices')
+
+
+def test_log_store():
+    import logging
+    from spreadsplug.web.util import LogStore
+    store = LogStore(max_records=5)
+    testlogger = logging.getLogger('spreads_test.logstore')
+    testlogger.propagate = False
+    testlogger.setLevel(logging.DEBUG)
+    testlogger.addHandler(store)
+    try:
+        for idx in xrange(6):
+            testlogger.debug("debug {0}".format(idx))
+            testlogger.warning("warning {0}".format(idx))
+    finally:
+        testlogger.removeHandler(store)
+    assert store.count() == 5
+    assert store.count(logging.WARNING) == 3
+    assert ([r.message for r in store.get_records(logging.DEBUG, 1, 2)] ==
+            ["debug 5", "warning 4"])
+    assert ([r.message for r in store.get_records(logging.WARNING)] ==
+            ["warning 5", "warning 4", "warning 3"])
+
+
+def test_log_store_size():
+    import logging
+    from spreadsplug.web.util import LogStore
+    store = LogStore(max_records=5)
+    testlogger = logging.getLogger('spreads_test.logstore_size')
+    testlogger.propagate = False
+    testlogger.addHandler(store)
+    try:
+        for idx in xrange(10):
+            try:
+                raise ValueError(idx)
+            except ValueError:
+                testlogger.exception("error {0}".format(idx))
+            # Viewing the records renders and drops their tracebacks
+            records = store.get_records()
+            assert "ValueError: {0}".format(idx) in records[0].traceback
+    finally:
+        testlogger.removeHandler(store)
+    assert store.count() == 5
+    assert store._size == sum(r.size for r in store._records)
+
+
+def test_disk_cache(tmpdir):
+    from spreadsplug.web.util import DiskCache
+    cache = DiskCache(unicode(tmpdir.join('cache')), max_size=10)
+    cache.set('foo', b'12345')
+    cache.set('bar', b'67890')
+    assert cache.get('foo') == b'12345'
+    # 'bar' is now the least recently used entry and has to go
+    cache.set('baz', b'abcde')
+    assert cache.get('bar') is None
+    assert not tmpdir.join('cache', 'bar').exists()
+    assert cache.get_or_create('foo', lambda: b'xxx') == b'12345'
+    # The cache should be restored from disk
+    cache = DiskCache(unicode(tmpdir.join('cache')), max_size=10)
+    assert cache.get('baz') == b'abcde'
+
+
+def test_disk_cache_concurrent_create(tmpdir):
+    import threading
+    from spreadsplug.web.util import DiskCache
+    cache = DiskCache(unicode(tmpdir.join('cache')), max_size=1024)
+    calls = []
+
+    def create():
+        calls.append(None)
+        time.sleep(0.1)
+        return b'12345'
+    threads = [threading.Thread(target=cache.get_or_create,
+                                args=('foo', create))
+               for _ in xrange(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert cache.get('foo') == b'12345'
+
+
+def test_workflow_json_cache(client):
+    wfid = create_workflow(client, num_captures=1)
+    data = json.loads(client.get('/api/workflow/{0}'.format(wfid)).data)
+    assert len(data['pages']) == 2
+    # Unchanged fields must be served from the cache
+    with mock.patch.dict('spreadsplug.web.util.WORKFLOW_FIELDS',
+                         config=mock.Mock(side_effect=AssertionError)):
+        client.post('/api/workflow/{0}/prepare_capture'.format(wfid))
+        client.post('/api/workflow/{0}/capture'.format(wfid))
+        data = json.loads(client.get('/api/workflow/{0}'.format(wfid)).data)
+    assert len(data['pages']) == 4
+    assert 'test_output' in data['config']['plugins']
+
+
+def test_event_buffer():
+    import spreads.workflow
+    from spreadsplug.web.handlers import (EventBuffer, CursorTooOld,
+                                          make_event_filter)
+    from spreadsplug.web.util import Event
+    buf = EventBuffer(max_bytes=1024)
+
+    def make_event(wfid):
+        return Event(spreads.workflow.on_removed, None, {'senderId': wfid})
+    received = []
+
+    def callback(events):
+        received.extend(events)
+    buf.wait_for_events(callback,
+                        event_filter=make_event_filter(workflow_id='a'))
+    buf.new_events([make_event('b')])
+    assert not received
+    buf.new_events([make_event('a')])
+    assert [json.loads(e)['id'] for e in received] == [2]
+
+    received = []
+    buf.wait_for_events(callback, cursor=0)
+    assert [json.loads(e)['id'] for e in received] == [1, 2]
+    received = []
+    buf.wait_for_events(
+        callback, cursor=1,
+        event_filter=make_event_filter(event_names=['workflow:*']))
+    assert [json.loads(e)['id'] for e in received] == [2]
+
+    # Fill up the buffer so that the first events are evicted
+    buf.new_events([make_event('c') for _ in xrange(100)])
+    assert buf.cache_bytes <= 1024
+    with pytest.raises(CursorTooOld):
+        buf.wait_for_events(callback, cursor=1)
+    with pytest.raises(CursorTooOld):
+        buf.wait_for_events(callback, cursor=1000)
+
+
+def test_websocket_queue():
+    import spreads.workflow
+    from spreadsplug.web.handlers import WebSocketHandler
+    from spreadsplug.web.util import Event
+    handler = WebSocketHandler.__new__(WebSocketHandler)
+    handler.request = mock.Mock(remote_ip='127.0.0.1')
+    handler.max_queued = 3
+    handler.open()
+    try:
+        status = Event(spreads.workflow.on_modified, None,
+                       {'senderId': 'a', 'changes': {'status': {}}})
+        key = WebSocketHandler._get_merge_key(status)
+        assert key == ('workflow:modified', 'a')
+        handler.enqueue([(key, '1'), (None, '2'), (key, '3')])
+        # The older progress event was replaced by the newer one
+        assert [x[1] for x in handler.queue] == ['2', '3']
+        handler.enqueue([(None, '4'), (None, '5')])
+        assert [x[1] for x in handler.queue] == ['3', '4', '5']
+    finally:
+        handler.on_close()
+
+
+def test_log_forwarder():
+    import logging
+    from spreads.util import EventHandler
+    from spreadsplug.web.handlers import LogForwarder
+    forwarder = LogForwarder()
+    handler = EventHandler()
+    logging.getLogger().addHandler(handler)
+    try:
+        forwarder.update_level()
+        # Nobody is subscribed, so nothing should be emitted
+        assert handler.level > logging.CRITICAL
+        client = mock.Mock()
+        forwarder.subscribe(client, logging.WARNING)
+        assert handler.level == logging.WARNING
+        record = logging.LogRecord('spreads_test', logging.WARNING, __file__,
+                                   0, "Repeated message", None, None)
+        with mock.patch('spreadsplug.web.handlers.WebSocketHandler') as wsh:
+            for _ in xrange(10):
+                forwarder.forward(record=record)
+            assert wsh.send_event.call_count == forwarder.max_rate
+            time.sleep(1.0/forwarder.max_rate)
+            forwarder.forward(record=record)
+            event = wsh.send_event.call_args[0][0]
+            assert event.data['suppressed'] == 5
+        forwarder.unsubscribe(client)
+        assert handler.level > logging.CRITICAL
+    finally:
+        logging.getLogger().removeHandler(handler)
+
+
+@pytest.yield_fixture
+def wsgi_server():
+    import threading
+    from tornado.httpserver import HTTPServer
+    from tornado.ioloop import IOLoop
+    from tornado.testing import bind_unused_port
+    from tornado.web import Application, FallbackHandler
+    from spreadsplug.web.handlers import WSGIStatsHandler
+    from spreadsplug.web.util import ThreadPoolWSGIContainer
+
+    release = threading.Event()
+
+    def wsgi_app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        if environ['PATH_INFO'] == '/stream':
+            yield b'first'
+            # Only continue once the client received the first chunk
+            yield b'second' if release.wait(5) else b'timeout'
+        else:
+            release.wait(5)
+            yield b'done'
+
+    io_loop = IOLoop()
+    io_loop.make_current()
+    container = ThreadPoolWSGIContainer(wsgi_app, max_workers=1,
+                                        max_queued=1)
+    application = Application([
+        (r"/api/stats/wsgi", WSGIStatsHandler, dict(container=container)),
+        (r".*", FallbackHandler, dict(fallback=container))])
+    sock, port = bind_unused_port()
+    server = HTTPServer(application)
+    server.add_sockets([sock])
+    yield io_loop, "http://127.0.0.1:{0}".format(port), release
+    release.set()
+    server.stop()
+    container._executor.shutdown()
+    IOLoop.clear_current()
+    io_loop.close(all_fds=True)
+
+
+def test_wsgi_container_streaming(wsgi_server):
+    from tornado import gen
+    from tornado.httpclient import AsyncHTTPClient
+    io_loop, url, release = wsgi_server
+    chunks = []
+
+    def on_chunk(chunk):
+        chunks.append(chunk)
+        release.set()
+
+    @gen.coroutine
+    def fetch():
+        resp = yield AsyncHTTPClient().fetch(
+            url + '/stream', streaming_callback=on_chunk)
+        raise gen.Return(resp)
+    resp = io_loop.run_sync(fetch, timeout=10)
+    assert resp.code == 200
+    # The first chunk was sent before the application produced the second
+    assert chunks[0] == b'first'
+    assert b''.join(chunks) == b'firstsecond'
+    assert resp.headers['Transfer-Encoding'] == 'chunked'
+    assert 'Content-Length' not in resp.headers
+
+
+def test_wsgi_container_queue(wsgi_server):
+    from tornado import gen
+    from tornado.httpclient import AsyncHTTPClient
+    io_loop, url, release = wsgi_server
+
+    @gen.coroutine
+    def fetch():
+        client = AsyncHTTPClient()
+        # Occupies the only worker
+        active = client.fetch(url + '/a', raise_error=False)
+        yield gen.sleep(0.1)
+        # Waits for the worker
+        queued = client.fetch(url + '/b', raise_error=False)
+        yield gen.sleep(0.1)
+        rejected = yield client.fetch(url + '/c', raise_error=False)
+        stats = yield client.fetch(url + '/api/stats/wsgi')
+        release.set()
+        responses = yield [active, queued]
+        raise gen.Return((responses, rejected, stats))
+    responses, rejected, stats = io_loop.run_sync(fetch, timeout=10)
+    assert rejected.code == 503
+    assert json.loads(stats.body) == {
+        'queued': 1, 'active': 1, 'workers': 1, 'peak_queued': 1}
+    assert [r.code for r in responses] == [200, 200]
+    assert [r.body for r in responses] == [b'done', b'done']
@@ -1,12 +1,17 @@
 from __future__ import division, unicode_literals
 
+import threading
+import time
+
+import concurrent.futures as concfut
 import pytest
 import spreads.vendor.bagit as bagit
 from mock import Mock
+from pathlib import Path
 
 import spreads.util as util
 import spreads.workflow
-from conftest import TestDriver
+from conftest import TestDriver, TestPluginProcess, TestPluginProcessB
 
 
 @pytest.fixture
@@ -117,6 +122,29 @@ def test_capture_flip_target_pages(workflow):
     workflow.finish_capture()
 
 
+def test_capture_background_writes(workflow):
+    written = threading.Event()
+    executor = concfut.ThreadPoolExecutor(max_workers=1)
+    for dev in workflow.devices:
+        dev.capture = (lambda path, capture=dev.capture: executor.submit(
+            lambda: written.wait(5) and capture(path)))
+    succeeded = []
+    spreads.workflow.on_capture_succeeded.connect(
+        lambda sender, **kwargs: succeeded.append(kwargs['pages']),
+        sender=workflow, weak=False)
+    workflow.prepare_capture()
+    workflow.capture()
+    # The capture returned before the images were written
+    assert not succeeded
+    assert len(workflow.pages) == 2
+    written.set()
+    workflow.finish_capture()
+    executor.shutdown()
+    assert succeeded == [workflow.pages]
+    assert all(unicode(p.raw_image) in workflow.bag.payload
+               for p in workflow.pages)
+
+
 def test_finish_capture(workflow):
     workflow.prepare_capture()
     workflow.finish_capture()
@@ -124,10 +152,145 @@ def test_finish_capture(workflow):
 
 
 def test_process(workflow):
+    processed = []
+    spreads.workflow.on_pages_processed.connect(
+        lambda sender, **kwargs: processed.append(kwargs['plugin']),
+        sender=workflow, weak=False)
     workflow.process()
-    # TODO: Verify
+    assert processed == ['test_process', 'test_process2']
+
+
+def test_process_online(workflow, monkeypatch):
+    monkeypatch.setattr(TestPluginProcess, 'per_page', True)
+    monkeypatch.setattr(TestPluginProcessB, 'per_page', False)
+    workflow.config['core']['online_processing'] = True
+    processed = []
+    spreads.workflow.on_pages_processed.connect(
+        lambda sender, **kwargs: processed.append(
+            (kwargs['plugin'], len(kwargs['pages']))),
+        sender=workflow, weak=False)
+    workflow.prepare_capture()
+    workflow.capture()
+    workflow.capture()
+    workflow.finish_capture()
+    assert workflow._online_executor is None
+    workflow.process()
+    # 'test_process2' needs all pages, so it only runs after capturing
+    assert processed[:2] == [('test_process', 2), ('test_process', 2)]
+    assert processed[2:] == [('test_process2', 4)]
+    assert all('test_process' in p.processed_images for p in workflow.pages)
+
+
+def test_concurrent_bag_changes(workflow):
+    paths = []
+    for idx in xrange(40):
+        fpath = workflow.path/'data'/'raw'/'{0:03}.txt'.format(idx)
+        if not fpath.parent.exists():
+            fpath.parent.mkdir(parents=True)
+        with fpath.open('wb') as fp:
+            fp.write(b'x'*idx)
+        paths.append(unicode(fpath))
+    with concfut.ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(workflow.bag.add_payload, path)
+                   for path in paths]
+        futures.extend(executor.submit(workflow._save_pages)
+                       for _ in xrange(10))
+    util.check_futures_exceptions(futures)
+    assert (workflow.bag.info['payload-oxum'] ==
+            "{0}.{1}".format(sum(xrange(40)), 40))
+    workflow.bag.validate()
+
+
+def test_concurrent_find_all(config, tmpdir):
+    Workflow = spreads.workflow.Workflow
+    location = Path(unicode(tmpdir.mkdir('workflows')))
+    for idx in xrange(4):
+        Workflow(config=config, path=location/'wf{0}'.format(idx))
+    Workflow._cache.pop(location, None)
+    with concfut.ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(
+            lambda _: Workflow.find_all(location, key='id'), xrange(8)))
+    assert len(Workflow._cache[location]) == 4
+    for found in results:
+        assert sorted(map(id, found.values())) == sorted(
+            map(id, Workflow._cache[location]))
 
 
 def test_output(workflow):
     workflow.output()
     # TODO: Verify
+
+
+def test_crop_page(workflow, tmpdir):
+    workflow.prepare_capture()
+    workflow.capture()
+    page = workflow.pages[0]
+    with page.raw_image.open('rb') as fp:
+        raw_data = fp.read()
+    workflow.crop_page(page, 10, 20, 100, 50)
+    assert page.transforms == [{'type': 'crop', 'left': 10, 'top': 20,
+                                'width': 100, 'height': 50}]
+    # The raw image must not have been touched
+    with page.raw_image.open('rb') as fp:
+        assert fp.read() == raw_data
+    out_path = page.materialize_transforms(Path(unicode(tmpdir)))
+    assert out_path.exists()
+    assert page.processed_images['transformed'] == out_path
+    # Adding another transform discards the materialized image
+    page.add_transform('rotate', angle=90)
+    assert 'transformed' not in page.processed_images
+    assert not out_path.exists()
+
+
+def test_save_pages_changes(workflow):
+    changes = []
+    spreads.workflow.on_pages_changed.connect(
+        lambda sender, **kwargs: changes.append(kwargs),
+        sender=workflow, weak=False)
+    workflow.prepare_capture()
+    workflow.capture()
+    workflow.capture()
+    workflow.finish_capture()
+    # Saving without any changes must not emit a signal
+    assert len(changes) == 2
+    assert [p.capture_num for p in changes[1]['added']] == [2, 3]
+    assert changes[1]['previous_version'] == changes[0]['version']
+    assert changes[1]['version'] == workflow.pages_version
+
+    workflow.remove_pages(workflow.pages[0])
+    assert changes[-1]['removed'] == [0]
+    assert changes[-1]['added'] == []
+    assert [x['capture_num'] for x in changes[-1]['updated']] == [1, 2, 3]
+    assert set(changes[-1]['updated'][0].keys()) == {
+        'capture_num', 'sequence_num', 'page_label'}
+
+
+def test_update_status_rate_limited(workflow):
+    workflow.config['core']['progress_rate'] = 2
+    updates = []
+    spreads.workflow.on_modified.connect(
+        lambda sender, **kwargs: updates.append(
+            kwargs['changes']['status']['step_progress']),
+        sender=workflow, weak=False)
+    workflow._update_status(step='process', step_progress=0)
+    for progress in (0.1, 0.2, 0.3):
+        workflow._update_status(step_progress=progress)
+    assert updates == [0]
+    # The most recent update is sent out once the interval has passed
+    time.sleep(0.6)
+    assert updates == [0, 0.3]
+    workflow._update_status(step_progress=0.4)
+    workflow._update_status(step_progress=1)
+    assert updates == [0, 0.3, 1]
+    # Without a rate, every update is sent out right away
+    workflow.config['core']['progress_rate'] = 0
+    for progress in (0.1, 0.2):
+        workflow._update_status(step_progress=progress)
+    assert updates == [0, 0.3, 1, 0.1, 0.2]
+
+
+def test_run_hook_disconnects_progress(workflow):
+    workflow.process()
+    workflow.process()
+    for plug in workflow._plugins:
+        assert not any(plug.on_progressed.receivers_for(plug))